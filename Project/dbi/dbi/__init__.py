@@ -1,2 +1,5 @@
 from .dbinterface import *
 from .objectstorage import *
+from .metrics import *
+from .storagebackend import *
+from .staging import *
@@ -1,14 +1,15 @@
-import os, typing as tp
+import os, threading, typing as tp
 
-from .objectstorage import S3Client
+from .objectstorage import S3Client, UploadPipeline, MB
 
 from werkzeug.datastructures import FileStorage
 from celery import Celery
 import pandas as pd
-from sqlalchemy import create_engine, text, Table, Column, Integer, Text, MetaData, ForeignKey, Boolean, Float, DateTime
-from sqlalchemy.sql.expression import Insert, Select
-from sqlalchemy.engine.base import Connection
+from sqlalchemy import create_engine, inspect, text, select, update, func, bindparam, Table, Column, Index, Integer, String, Text, MetaData, ForeignKey, Boolean, Float, DateTime, BigInteger
+from sqlalchemy.sql.expression import Insert, Select, Executable
+from sqlalchemy.engine.base import Connection, Engine
 from datetime import datetime
+from contextlib import contextmanager
 from dataclasses import dataclass
 import pydantic as pyd
 from pathlib import Path
@@ -30,6 +31,23 @@ MARIADB_PORT=int(_MARIADB_PORT_ENV)
 
 DBNAME="morphology_information"
 
+NAME_MAX_LENGTH=255
+""" max length of name columns that are used in lookups (bounded so that they can be indexed) """
+WELL_NAME_MAX_LENGTH=16
+""" max length of a well name, e.g. 'B03' """
+
+# connection pool configuration (shared by all threads of a process, e.g. flask request handlers)
+MARIADB_POOL_SIZE=int(os.getenv('MARIADB_POOL_SIZE') or 5)
+""" number of connections kept open in the pool """
+MARIADB_POOL_MAX_OVERFLOW=int(os.getenv('MARIADB_POOL_MAX_OVERFLOW') or 10)
+""" number of connections that may be opened temporarily on top of the pool size """
+MARIADB_POOL_TIMEOUT_S=int(os.getenv('MARIADB_POOL_TIMEOUT_S') or 30)
+""" time to wait for a free connection before raising """
+MARIADB_POOL_RECYCLE_S=int(os.getenv('MARIADB_POOL_RECYCLE_S') or 3600)
+""" connections older than this are replaced (must be lower than the server side wait_timeout) """
+MARIADB_QUERY_CACHE_SIZE=int(os.getenv('MARIADB_QUERY_CACHE_SIZE') or 1000)
+""" number of compiled statements kept by sqlalchemy, keyed by statement structure (not by object), so it must exceed the number of distinct statements to avoid recompiling """
+
 # deconstruct image naming scheme to get image metadata...
 @dataclass(repr=True,frozen=False)
 class ImageMetadata:
@@ -65,7 +83,8 @@ class ImageMetadata:
         real_filename:str,
         storage_filename:str,
         coords:tp.Optional[tp.Dict[str,tp.Any]],
-        db:"DB"
+        db:"DB",
+        plate_type_id:int,
     ):
         """
             params:
@@ -78,6 +97,9 @@ class ImageMetadata:
                     the filename of the image, as it is stored in the object storage
                     (includes bucket name, i.e. 'bucketname/filename')
 
+                plate_type_id:
+                    id of the plate type the image was taken on (used to resolve the well id)
+
             notes:
                 image name: 
                     example: B03_s1_x0_y0_Fluorescence_405_nm_Ex.tif
@@ -105,24 +127,19 @@ class ImageMetadata:
         # remove underscores from channelname which are only inserted for filename formatting
         channelname=channelname.replace("_"," ")
 
-        # query well id from database based on well name
-        wellid_res=db.dbExec(f"select id from platetype_wells where well_name='{wellname}';")
-        assert type(wellid_res)==list
-        if len(wellid_res)==0:
-            raise ValueError(f"well name {wellname} not found in database")
-        well_id=wellid_res[0][0]
-
-        # query channel id from database based on channel name
-        channelid_res=db.dbExec(f"select id from imaging_channels where name='{channelname}';")
-        assert type(channelid_res)==list
-        if len(channelid_res)==0:
-            available_channels=db.dbExec("select * from imaging_channels;",as_pd=True)
+        # resolve well id from the well name (cached, the platetype_wells table is static)
+        well_id=db.getWellID(wellname,plate_type_id)
+
+        # resolve channel id from the channel name (cached, the imaging_channels table is static)
+        try:
+            channel_id=db.getImagingChannelID(channelname)
+        except ValueError:
+            available_channels=db.dbExec(select(db.dbImagingChannels),as_pd=True)
             assert type(available_channels)==pd.DataFrame
             print("available imaging channels:",available_channels)
             for channel in available_channels["name"]:
                 print(channel,channelname in channel,channelname==channel)
-            raise ValueError(f"channel name {channelname} not found in database")
-        channel_id=channelid_res[0][0]
+            raise
 
         self.wellname=wellname
         self.well_id=well_id
@@ -157,6 +174,14 @@ class WellSite(pyd.BaseModel):
     site:int
     """ site (1-indexed) """
 
+class StageTiming(pyd.BaseModel):
+    stage:str
+    """ name of the stage, e.g. 'download' or 'cellprofiler' """
+    duration_s:float
+    """ wall clock time spent in the stage """
+    num_bytes:tp.Optional[int]=None
+    """ number of bytes processed by the stage (e.g. downloaded), if applicable """
+
 class Result_cp_map(pyd.BaseModel):
     resultfiles:tp.List[ObjectStorageFileReference]
     wells:tp.List[WellSite]
@@ -184,7 +209,62 @@ class Result_processingStatus(pyd.BaseModel):
     num_registered_sites:int
     num_processed_sites:int
 
+class DimensionLookupCache:
+    """
+        process-wide cache for name->id lookups in (effectively) static dimension tables
+
+        each namespace (e.g. the wells of one plate type) is loaded completely on first use,
+        so that all following lookups are dictionary hits.
+        a lookup of a name that is not in the cached namespace reloads that namespace once.
+    """
+
+    def __init__(self):
+        self._lock=threading.Lock()
+        self._namespaces:tp.Dict[tp.Hashable,tp.Dict[str,int]]={}
+        self.hits:int=0
+        """ number of lookups answered from the cache """
+        self.misses:int=0
+        """ number of lookups that required a database query """
+
+    def lookup(self,
+        namespace:tp.Hashable,
+        name:str,
+        load:tp.Callable[[],tp.Dict[str,int]],
+    )->tp.Optional[int]:
+        """
+            get the id for name in namespace, calling load() to (re)fill the namespace on a miss
+
+            :returns: the id, or None if name is not present even after reloading
+        """
+        with self._lock:
+            mapping=self._namespaces.get(namespace)
+            if mapping is not None and name in mapping:
+                self.hits+=1
+                return mapping[name]
+            self.misses+=1
+
+        # query outside of the lock, the result is the same regardless of which thread stores it
+        mapping=load()
+        with self._lock:
+            self._namespaces[namespace]=mapping
+        return mapping.get(name)
+
+    def invalidate(self,namespace:tp.Optional[tp.Hashable]=None):
+        """ drop a single namespace, or all namespaces if none is specified """
+        with self._lock:
+            if namespace is None:
+                self._namespaces.clear()
+            else:
+                self._namespaces.pop(namespace,None)
+
+    def stats(self)->tp.Dict[str,int]:
+        with self._lock:
+            return {"hits":self.hits,"misses":self.misses,"namespaces":len(self._namespaces)}
+
 class DB:
+    lookup_cache:DimensionLookupCache=DimensionLookupCache()
+    """ shared by all DB instances in this process """
+
     @staticmethod
     def createDatabase(
         dbname:str,
@@ -197,7 +277,12 @@ class DB:
             conn.execute(text(f"CREATE DATABASE IF NOT EXISTS {dbname};"))
             conn.execute(text(f"USE {dbname};"))
 
-    def __init__(self,recreate:bool=True):
+    def __init__(self,recreate:bool=True,migrate:bool=False):
+        """
+            :param recreate: drop and recreate the database, then insert the static data
+            :param migrate: bring the schema of an existing database up to date (see migrateSchema).
+                not required after recreate.
+        """
         self.celery_rpc = Celery('dbwatcher', backend='rpc://', broker=os.getenv('APP_BROKER_URI'), broker_pool_limit = 0)
         """ 'request/response, i.e. rpc' task queue """
         self.celery_tasks = Celery('dbwatcher', broker=os.getenv('APP_BROKER_URI'), broker_pool_limit = 0)
@@ -210,7 +295,7 @@ class DB:
             self.dbProjects:Table=Table(
                 "projects", self.dbmetadata,
                 Column("id",Integer,primary_key=True,nullable=False,autoincrement=True,unique=True),
-                Column("name",Text,unique=True,nullable=False),
+                Column("name",String(NAME_MAX_LENGTH),unique=True,nullable=False),
             )
             """
                 contains all projects
@@ -224,7 +309,8 @@ class DB:
                 "plates", self.dbmetadata,
                 Column("id",Integer,primary_key=True,nullable=False,autoincrement=True,unique=True),
                 Column("platetypeid",Integer,ForeignKey("plate_types.id",ondelete="cascade"),nullable=False),
-                Column("barcode",Text,nullable=False),
+                Column("barcode",String(NAME_MAX_LENGTH),nullable=False),
+                Index("ix_plates_barcode","barcode"),
             )
             """
                 all physical plates (actual plates with stuff on them, used for experiments at some point)
@@ -238,7 +324,7 @@ class DB:
                 "experiments", self.dbmetadata,
                 Column("id",Integer,primary_key=True,nullable=False,autoincrement=True,unique=True),
                 Column("projectid",Integer,ForeignKey("projects.id",ondelete="cascade"),nullable=False),
-                Column("name",Text,nullable=False),
+                Column("name",String(NAME_MAX_LENGTH),nullable=False),
                 Column("compound_layout_path",Text,nullable=False),
                 Column("description",Text,nullable=True),
                 Column("plateid",Integer,ForeignKey("plates.id",ondelete="cascade"),nullable=False),
@@ -252,6 +338,7 @@ class DB:
                 Column("delta_y_mm",Float,nullable=False),
                 Column("delta_z_um",Float,nullable=False),
                 Column("delta_t_h",Float,nullable=False),
+                Index("ix_experiments_projectid_name","projectid","name"),
             )
 
             """
@@ -279,11 +366,12 @@ class DB:
             self.dbPlateTypes:Table=Table(
                 "plate_types", self.dbmetadata,
                 Column("id",Integer,primary_key=True,nullable=False,autoincrement=True,unique=True),
-                Column("model_name",Text,nullable=False),
+                Column("model_name",String(NAME_MAX_LENGTH),nullable=False),
                 Column("manufacturer",Text,nullable=False),
                 Column("brand",Text,nullable=False),
                 Column("num_wells",Integer,nullable=False),
                 Column("other_info",Text,nullable=True),
+                Index("ix_plate_types_model_name","model_name"),
             )
             """
                 a list of all plate types, each containing information about:
@@ -297,7 +385,8 @@ class DB:
                 "platetype_wells", self.dbmetadata,
                 Column("id",Integer,primary_key=True,nullable=False,autoincrement=True,unique=True),
                 Column("platetypeid",Integer,ForeignKey("plate_types.id",ondelete="cascade"),nullable=False),
-                Column("well_name",Text,nullable=False),
+                Column("well_name",String(WELL_NAME_MAX_LENGTH),nullable=False),
+                Index("ix_platetype_wells_platetypeid_well_name","platetypeid","well_name"),
             )
             """
                 all wells for each plate type
@@ -309,7 +398,7 @@ class DB:
             self.dbMicroscopes:Table=Table(
                 "microscopes", self.dbmetadata,
                 Column("id",Integer,primary_key=True,nullable=False,autoincrement=True,unique=True),
-                Column("name",Text,nullable=False,unique=True),
+                Column("name",String(NAME_MAX_LENGTH),nullable=False,unique=True),
             )
             """
                 a list of all microscopes
@@ -319,7 +408,8 @@ class DB:
             self.dbObjectives:Table=Table(
                 "objectives", self.dbmetadata,
                 Column("id",Integer,primary_key=True,nullable=False,autoincrement=True,unique=True),
-                Column("name",Text,nullable=False),
+                Column("name",String(NAME_MAX_LENGTH),nullable=False),
+                Index("ix_objectives_name","name"),
             )
             """
                 a list of all available objectives
@@ -351,6 +441,7 @@ class DB:
                 Column("site_y",Integer,nullable=True),
                 Column("site_z",Integer,nullable=True),
                 Column("site_t",Integer,nullable=True),
+                Index("ix_experiment_well_sites_experiment_wellid_site_id","experiment_wellid","site_id"),
             )
             """
             for a well imaged in an experiment, contains information about a site within that well
@@ -367,6 +458,7 @@ class DB:
                 Column("exposure_time_ms",Float,nullable=False),
                 Column("analog_gain",Float,nullable=False),
                 Column("illumination_strength",Float,nullable=False),
+                Index("ix_experiment_imaging_channels_experimentid_channelid","experimentid","channelid"),
             )
             """
                 this table contains a list of all imaging channels used in an experiment
@@ -386,7 +478,8 @@ class DB:
                 Column("fluorescence_wavelength_nm",Integer,nullable=True),
                 Column("is_brightfield",Boolean,nullable=False),
                 Column("brightfield_type",Text,nullable=True),
-                Column("name",Text,nullable=True),
+                Column("name",String(NAME_MAX_LENGTH),nullable=True),
+                Index("ix_imaging_channels_name","name"),
             )
             """
                 contains a list of all the available imaging channels
@@ -430,6 +523,7 @@ class DB:
                 Column("start_time",DateTime,nullable=True),
                 Column("end_time",DateTime,nullable=True),
                 Column("status",Text,nullable=True),
+                Index("ix_profile_results_experimentid_batchid","experimentid","batchid"),
             )
             """
                 contains information about a processing batch
@@ -437,11 +531,23 @@ class DB:
                 processing batch = n sets of c images, where n>=1 and c is the number of imaging channels
             """
 
+            self.dbProcessingBatchCounters:Table=Table(
+                "processing_batch_counters", self.dbmetadata,
+                Column("experimentid",Integer,ForeignKey("experiments.id",ondelete="cascade"),primary_key=True,nullable=False,autoincrement=False),
+                Column("next_batchid",Integer,nullable=False),
+            )
+            """
+                for each experiment, contains the next unused processing batch id
+
+                batch ids are reserved by atomically incrementing next_batchid (see reserveProcessingBatchIDs)
+            """
+
             self.dbProfileResultBatchSites:Table=Table(
                 "profile_result_batch_sites", self.dbmetadata,
                 Column("id",Integer,primary_key=True,nullable=False,autoincrement=True,unique=True),
                 Column("profile_resultid",Integer,ForeignKey("profile_results.id",ondelete="cascade"),nullable=False),
                 Column("siteid",Integer,ForeignKey("experiment_well_sites.id",ondelete="cascade"),nullable=False),
+                Index("ix_profile_result_batch_sites_profile_resultid","profile_resultid"),
             )
             """
                 contains information about the sites that were processed in a batch
@@ -453,56 +559,149 @@ class DB:
                 Column("profile_resultid",Integer,ForeignKey("profile_results.id",ondelete="cascade"),nullable=False),
                 Column("s3path",Text,nullable=False),
                 Column("filename",Text,nullable=True),
+                Index("ix_profile_result_files_profile_resultid","profile_resultid"),
             )
             """
                 contains information about the files that were generated in a processing batch
             """
 
+            self.dbProfileResultStageTimings:Table=Table(
+                "profile_result_stage_timings", self.dbmetadata,
+                Column("id",Integer,primary_key=True,nullable=False,autoincrement=True,unique=True),
+                Column("profile_resultid",Integer,ForeignKey("profile_results.id",ondelete="cascade"),nullable=False),
+                Column("stage",String(NAME_MAX_LENGTH),nullable=False),
+                Column("duration_s",Float,nullable=False),
+                Column("num_bytes",BigInteger,nullable=True),
+                Index("ix_profile_result_stage_timings_profile_resultid","profile_resultid"),
+            )
+            """
+                contains the time spent in (and bytes processed by) each stage of a processing batch, one row per stage
+            """
+
+        self.dbengine:Engine=create_engine(
+            f"mariadb+mariadbconnector://{MARIADB_USER_USERNAME}:{MARIADB_USER_PASSWORD}@{MARIADB_HOSTNAME}:{MARIADB_PORT}/{DBNAME}",
+            pool_size=MARIADB_POOL_SIZE,
+            max_overflow=MARIADB_POOL_MAX_OVERFLOW,
+            pool_timeout=MARIADB_POOL_TIMEOUT_S,
+            pool_recycle=MARIADB_POOL_RECYCLE_S,
+            # check that a connection is still alive before handing it out (e.g. after a database restart)
+            pool_pre_ping=True,
+            query_cache_size=MARIADB_QUERY_CACHE_SIZE,
+        )
+        """ pooled engine, connections are checked out per dbExec call or per session() """
+
+        self._session_state=threading.local()
+        """ holds the connection of the session() currently active in this thread (if any) """
+
+        self._statements:tp.Dict[str,Executable]={}
+        """ statements with bound parameters, built once per statement shape (see _statement) """
+
         if recreate:
-            dbengine=create_engine(f"mariadb+mariadbconnector://{MARIADB_USER_USERNAME}:{MARIADB_USER_PASSWORD}@{MARIADB_HOSTNAME}:{MARIADB_PORT}")
-            conn=dbengine.connect()
-            assert type(conn)==Connection
+            # database may not exist yet, so connect to the server without selecting a database
+            admin_engine=create_engine(f"mariadb+mariadbconnector://{MARIADB_USER_USERNAME}:{MARIADB_USER_PASSWORD}@{MARIADB_HOSTNAME}:{MARIADB_PORT}")
+            with admin_engine.connect() as conn:
+                assert type(conn)==Connection
 
-            DB.createDatabase(dbname=DBNAME,conn=conn)
+                DB.createDatabase(dbname=DBNAME,conn=conn)
 
             # creates the tables, if they dont exist already
-            self.dbmetadata.create_all(dbengine)
+            self.dbmetadata.create_all(admin_engine)
+            admin_engine.dispose()
 
-            self.conn=conn
-            self.insertStaticData()
+            # connections in the pool may have been opened before the database was recreated
+            self.dbengine.dispose()
 
-            conn.close()
+            self.insertStaticData()
 
             print("-- db init done")
+        elif migrate:
+            self.migrateSchema()
 
-        dbengine=create_engine(f"mariadb+mariadbconnector://{MARIADB_USER_USERNAME}:{MARIADB_USER_PASSWORD}@{MARIADB_HOSTNAME}:{MARIADB_PORT}/{DBNAME}")
-        conn=dbengine.connect()
-        assert type(conn)==Connection
+        self.s3client=S3Client()
 
-        self.conn=conn
+    @contextmanager
+    def session(self)->tp.Iterator[Connection]:
+        """
+            group several dbExec calls into a single transaction on a single connection
 
-        self.s3client=S3Client()
+            all dbExec calls made by the current thread inside the with-block use the same connection.
+            the transaction is committed when the block exits normally, and rolled back on exception.
+            nested session() calls join the outermost session.
+
+            example:
+                with db.session():
+                    db.dbExec(...)
+                    db.dbExec(...)
+        """
+        conn:tp.Optional[Connection]=getattr(self._session_state,"conn",None)
+        if conn is not None:
+            # already inside a session in this thread, join it
+            yield conn
+            return
+
+        with self.dbengine.connect() as conn:
+            with conn.begin():
+                self._session_state.conn=conn
+                try:
+                    yield conn
+                finally:
+                    self._session_state.conn=None
+
+    def _statement(self,
+        key:str,
+        build:tp.Callable[[],Executable],
+    )->Executable:
+        """
+            get the statement stored under key, building it on first use
+
+            statements must use bindparam (or :name in text) for all values, so that the same
+            object can be executed with different parameters. reusing the object saves building the
+            statement (and parsing the sql of text statements) on every call. compilation is cached
+            by sqlalchemy itself (by cache key, see MARIADB_QUERY_CACHE_SIZE), which only works
+            because no values are rendered into the statement.
+
+            example:
+                stmt=self._statement("projects.id_by_name",lambda:
+                    select(self.dbProjects.c.id).where(self.dbProjects.c.name==bindparam("name"))
+                )
+                self.dbExec(stmt,{"name":project_name})
+        """
+        stmt=self._statements.get(key)
+        if stmt is None:
+            # building the same statement twice in concurrent threads is harmless
+            stmt=build()
+            self._statements[key]=stmt
+        return stmt
 
     def dbExec(self,
-        query:tp.Union[str,Insert,Select],
+        query:tp.Union[str,Insert,Select,Executable],
         *args,
         as_pd:bool=False,
-    )->tp.Optional[tp.Union[tp.List[tp.Tuple],pd.DataFrame]]:
+    )->tp.Optional[tp.Union[tp.List[tp.Tuple],pd.DataFrame,int]]:
         """
-            execute a query and return the results
+            execute a query and return the results: rows for queries, primary keys for inserts,
+            and the number of affected rows for other statements (e.g. update, delete)
 
-            :param query: the query to execute
+            :param query: the query to execute. prefer statements from _statement with parameters
+                passed in args, which are built once and hit sqlalchemy's compiled cache on every call
+                (strings are wrapped in text() on every call, and values formatted into them miss the cache)
             :param as_pd: if True, return the result as a pandas dataframe
         """
         if isinstance(query,str):
             query=text(query)
 
-        # commit changes to the database
-        transaction=self.conn.begin()
-        assert transaction is not None
-        res=None
-        with transaction:
-            res=self.conn.execute(query,*args)
+        conn:tp.Optional[Connection]=getattr(self._session_state,"conn",None)
+        if conn is not None:
+            # part of the transaction of the surrounding session
+            return self._fetchResult(conn.execute(query,*args),as_pd=as_pd)
+
+        # check out a connection from the pool for this call only, and commit changes to the database
+        with self.dbengine.begin() as conn:
+            return self._fetchResult(conn.execute(query,*args),as_pd=as_pd)
+
+    @staticmethod
+    def _fetchResult(res,as_pd:bool)->tp.Optional[tp.Union[tp.List[tp.Tuple],pd.DataFrame,int]]:
+        """ read the result of a query while its connection is still checked out """
         assert res is not None
 
         # for select statements, return all rows
@@ -523,9 +722,59 @@ class DB:
             else:
                 return key_list
         
-        # for other cases, return whatever the result is
-        return res
+        # for other cases, return the number of affected rows
+        return res.rowcount
     
+    def migrateSchema(self):
+        """
+            update the schema of an existing database in place to match the table definitions in __init__, i.e.:
+            - change the type of name columns that are TEXT in the database but bounded VARCHAR in the definition
+            - create indexes that are defined but do not exist yet (matched by column list, not by name)
+
+            existing data is kept. tables that do not exist yet are created.
+            safe to call repeatedly, does nothing if the schema is already up to date.
+        """
+
+        # create missing tables (does not touch existing ones)
+        self.dbmetadata.create_all(self.dbengine)
+
+        with self.dbengine.connect() as conn:
+            inspector=inspect(conn)
+
+            for table in self.dbmetadata.tables.values():
+                existing_columns={
+                    column_info["name"]:column_info
+                    for column_info
+                    in inspector.get_columns(table.name,schema=DBNAME)
+                }
+                for column in table.columns:
+                    if not isinstance(column.type,String) or isinstance(column.type,Text):
+                        continue
+                    existing_column=existing_columns.get(column.name)
+                    if existing_column is None or not isinstance(existing_column["type"],Text):
+                        continue
+
+                    column_type=column.type.compile(dialect=conn.dialect)
+                    nullability="NULL" if column.nullable else "NOT NULL"
+                    print(f"migrating {table.name}.{column.name} to {column_type}")
+                    # identifiers cannot be bound as parameters, but they come from the table definitions
+                    with conn.begin():
+                        conn.execute(text(f"ALTER TABLE {DBNAME}.{table.name} MODIFY COLUMN {column.name} {column_type} {nullability};"))
+
+                existing_indexes={
+                    tuple(index_info["column_names"])
+                    for index_info
+                    in inspector.get_indexes(table.name,schema=DBNAME)
+                }
+                for index in table.indexes:
+                    index_columns=tuple(column.name for column in index.columns)
+                    if index_columns in existing_indexes:
+                        continue
+
+                    print(f"creating index {index.name} on {table.name}{index_columns}")
+                    with conn.begin():
+                        index.create(conn)
+
     def insertStaticData(self):
         """ insert some static data, e.g. imaging channels, plate types, wells for each plate type """
 
@@ -550,7 +799,7 @@ class DB:
 
         # for each plate type, insert the wells
         # so: query the plate type id and the number of wells, then insert wells accordingly (can be somewhat hardcoded knowing that a plate has either 96 or 384 wells)
-        res=self.dbExec("select id,num_wells from plate_types;")
+        res=self.dbExec(select(self.dbPlateTypes.c.id,self.dbPlateTypes.c.num_wells))
         assert type(res)==list
         for platetypeid,num_wells in res:
             plate_well_list=[]
@@ -570,6 +819,9 @@ class DB:
 
             self.dbExec(self.dbPlateTypeWells.insert(),plate_well_list)
 
+        # ids of the static tables have changed
+        DB.lookup_cache.invalidate()
+
         self.dumpDatabaseHead()
 
     def insertExperimentMetadata(self,
@@ -578,6 +830,8 @@ class DB:
         compound_layout_s3_filename:str,
         images:tp.List[FileStorage],
         image_s3_bucketname:str,
+        upload_concurrency:tp.Optional[int]=None,
+        skipped_files:tp.Optional[tp.List[str]]=None,
     )->tp.Dict[str,tp.List[ImageMetadata]]:
         """
             insert experiment metadata into the database
@@ -586,6 +840,9 @@ class DB:
             :param coordinates: the coordinates of each well in the plate
             :param images: the images to upload
             :param image_s3_bucketname: the bucket name to upload the images to
+            :param upload_concurrency: number of images uploaded at the same time (see UploadPipeline)
+            :param skipped_files: if provided, the storage paths (incl. bucket) of images that were not uploaded
+                because identical objects already exist (e.g. when re-uploading a plate) are appended to it
 
             :returns: a list of image sets, where each image is translated into an ImageMetadata object
                 i.e. returns something like splitIntoSets([ImageMetadata(image) for image in images])
@@ -593,56 +850,48 @@ class DB:
 
         # create experiment if none exists with the name
         proj_name:str=experiment["project_name"]
-        res=self.dbExec(f"select id from projects where name='{proj_name}';")
-        assert type(res)==list
-        if len(res)==0:
+        if self._selectIDByName(self.dbProjects,"name",proj_name) is None:
             self.dbExec(self.dbProjects.insert(),{"name":proj_name})
         proj_id:int=self.getProjectID(proj_name)
 
         # get plate type id, throw if it does not exist
         plate_type_name:str=experiment["plate_type"]
-        res=self.dbExec(f"select id from plate_types where model_name='{plate_type_name}';")
-        assert type(res)==list
-        if len(res)==0:
+        res_id=self._selectIDByName(self.dbPlateTypes,"model_name",plate_type_name)
+        if res_id is None:
             raise ValueError(f"plate type {plate_type_name} not found in database")
-        plate_type_id:int=res[0][0]
+        plate_type_id:int=res_id
 
         # create plate if none exists with the barcode
         plate_name:str=experiment["plate_name"]
-        res=self.dbExec(f"select id from plates where barcode='{plate_name}';")
-        assert type(res)==list
-        if len(res)==0:
+        res_id=self._selectIDByName(self.dbPlates,"barcode",plate_name)
+        if res_id is None:
             self.dbExec(self.dbPlates.insert().prefix_with("ignore"),{"projectid":proj_id,"platetypeid":plate_type_id,"barcode":plate_name})
-        res=self.dbExec(f"select id from plates where barcode='{plate_name}';")
-        assert type(res)==list
-        plate_id:int=res[0][0]
+            res_id=self._selectIDByName(self.dbPlates,"barcode",plate_name)
+        assert res_id is not None
+        plate_id:int=res_id
 
         # get microscope id, and create it if it does not exist
         microscope_name:str=experiment["microscope_name"]
-        res=self.dbExec(f"select id from microscopes where name='{microscope_name}';")
-        assert type(res)==list
-        if len(res)==0:
+        res_id=self._selectIDByName(self.dbMicroscopes,"name",microscope_name)
+        if res_id is None:
             self.dbExec(self.dbMicroscopes.insert(),{"name":microscope_name})
-        res=self.dbExec(f"select id from microscopes where name='{microscope_name}';")
-        assert type(res)==list
-        microscope_id:int=res[0][0]
+            res_id=self._selectIDByName(self.dbMicroscopes,"name",microscope_name)
+        assert res_id is not None
+        microscope_id:int=res_id
 
         # get objective id, and create it if it does not exist
         objective_name:str=experiment["objective"]
-        res=self.dbExec(f"select id from objectives where name='{objective_name}';")
-        assert type(res)==list
-        if len(res)==0:
+        res_id=self._selectIDByName(self.dbObjectives,"name",objective_name)
+        if res_id is None:
             self.dbExec(self.dbObjectives.insert(),{"name":objective_name})
-        res=self.dbExec(f"select id from objectives where name='{objective_name}';")
-        assert type(res)==list
-        objective_id:int=res[0][0]
+            res_id=self._selectIDByName(self.dbObjectives,"name",objective_name)
+        assert res_id is not None
+        objective_id:int=res_id
 
         # create experiment
         exp_name:str=experiment["experiment_name"]
         # check if there is an experiment in this project already in the database:
-        res=self.dbExec(f"select id from experiments where name='{exp_name}' and projectid={proj_id};")
-        assert type(res)==list
-        experiment_already_exists:bool=len(res)>0
+        experiment_already_exists:bool=self._selectExperimentID(proj_id,exp_name) is not None
         if experiment_already_exists:
             print(f"info - experiment {exp_name} in project {proj_name} already exists in database")
 
@@ -697,45 +946,48 @@ class DB:
 
         cell_line:str=experiment["cell_line"]
 
-        # create experiment wells
-        for wellname in experiment["well_list"]:
-            res=self.dbExec(f"""
-                select id
-                from platetype_wells
-                where well_name='{wellname}'
-                    and platetypeid={plate_type_id};
-            """)
-
-            assert type(res)==list
-            if len(res)==0:
-                raise ValueError(f"well name {wellname} not found in database")
-            well_id=res[0][0]
+        # resolve all well ids of this plate type (one query to fill the lookup cache, if at all)
+        # (duplicate entries in the well list are only inserted once)
+        well_names:tp.List[str]=list(dict.fromkeys(experiment["well_list"]))
+        well_ids:tp.Dict[str,int]={wellname:self.getWellID(wellname,plate_type_id) for wellname in well_names}
 
+        # create experiment wells, and the sites within each well
+        if not experiment_already_exists and len(well_names)>0:
             num_sites=grid_num_x*grid_num_y*grid_num_z
 
-            if not experiment_already_exists:
+            # site grid is the same for every well, so compute it once
+            site_grid:tp.List[tp.Dict[str,int]]=[]
+            for site_id in range(num_sites):
+                site_id+=1 # sites are 1-indexed
+                site_grid.append({
+                    "site_id":site_id,
+                    "site_x":site_id%grid_num_x,
+                    "site_y":(site_id//grid_num_x)%grid_num_y,
+                    "site_z":(site_id//(grid_num_x*grid_num_y))%grid_num_z,
+                    "site_t":(site_id//(grid_num_x*grid_num_y*grid_num_z))%grid_num_t,
+                })
+
+            # insert all wells and all sites as multi-row inserts within one transaction
+            with self.session():
+                self.dbExec(self.dbExperimentWells.insert(),[
+                    {"experimentid":exp_id,"wellid":well_ids[wellname],"cell_line":cell_line}
+                    for wellname in well_names
+                ])
+
+                # the experiment is new, so all of its wells have just been inserted
                 res=self.dbExec(
-                    self.dbExperimentWells.insert(),
-                    {"experimentid":exp_id,"wellid":well_id,"cell_line":cell_line}
+                    select(self.dbExperimentWells.c.wellid,self.dbExperimentWells.c.id)
+                    .where(self.dbExperimentWells.c.experimentid==exp_id)
                 )
                 assert type(res)==list
-                experiment_wellid:int=res[0][0]
-
-                for site_id in range(num_sites):
-                    site_id+=1 # sites are 1-indexed
-                    site_x=site_id%grid_num_x
-                    site_y=(site_id//grid_num_x)%grid_num_y
-                    site_z=(site_id//(grid_num_x*grid_num_y))%grid_num_z
-                    site_t=(site_id//(grid_num_x*grid_num_y*grid_num_z))%grid_num_t
-
-                    self.dbExec(self.dbExperimentWellSites.insert(),{
-                        "experiment_wellid":experiment_wellid,
-                        "site_id":site_id,
-                        "site_x":site_x,
-                        "site_y":site_y,
-                        "site_z":site_z,
-                        "site_t":site_t,
-                    })
+                experiment_well_ids:tp.Dict[int,int]={well_id:experiment_wellid for well_id,experiment_wellid in res}
+
+                if len(site_grid)>0:
+                    self.dbExec(self.dbExperimentWellSites.insert(),[
+                        {"experiment_wellid":experiment_well_ids[well_ids[wellname]],**site}
+                        for wellname in well_names
+                        for site in site_grid
+                    ])
 
         imaging_channel_ids={}
 
@@ -749,18 +1001,15 @@ class DB:
             assert current_channel_config is not None, f"channel {channel} not found in experiment config"
 
             # get channel id
-            res=self.dbExec(f"select id from imaging_channels where name='{channel}';")
-            assert type(res)==list
-            if len(res)==0:
-                raise ValueError(f"channel name {channel} not found in database")
-            
-            channel_id:int=res[0][0]
+            channel_id:int=self.getImagingChannelID(channel)
 
             if experiment_already_exists:
-                res=self.dbExec(f"""
-                    select id from experiment_imaging_channels
-                    where experimentid={exp_id} and channelid={channel_id};
-                """)
+                stmt=self._statement("experiment_imaging_channels.id",lambda:
+                    select(self.dbExperimentImagingChannels.c.id)
+                    .where(self.dbExperimentImagingChannels.c.experimentid==bindparam("experiment_id"))
+                    .where(self.dbExperimentImagingChannels.c.channelid==bindparam("channel_id"))
+                )
+                res=self.dbExec(stmt,{"experiment_id":exp_id,"channel_id":channel_id})
                 assert type(res)==list
                 if len(res)==0:
                     raise ValueError(f"channel {channel} not found in experiment {exp_name}")
@@ -783,43 +1032,52 @@ class DB:
         # insert image metadata
         imageInsertionList=[]
         imageMetadataList:tp.List[ImageMetadata]=[]
-        for file in images:
-            # If the user does not select a file, the browser may submit an empty file without a filename.
-            if file.filename == '':
-                raise ValueError("No selected file (empty filename)")
+        # images are uploaded in the background while the metadata of the next images is parsed.
+        # if any upload fails, UploadError (with all failed files) is raised before anything is written to the images table
+        # (create the bucket up front, so that concurrent uploads do not race to create it)
+        self.s3client.ensureBucket(image_s3_bucketname)
+        # unchanged images (e.g. from a previous, partially failed upload of the same plate) are not uploaded again
+        with UploadPipeline(self.s3client,max_concurrency=upload_concurrency,skip_unchanged=True) as uploads:
+            for file in images:
+                # If the user does not select a file, the browser may submit an empty file without a filename.
+                if file.filename == '':
+                    raise ValueError("No selected file (empty filename)")
+
+                filename=str(file.filename)
+                sec_filename = secure_filename(Path(filename).name)
+                save_filepath=os.path.join(experiment["project_name"],experiment["experiment_name"],sec_filename)
+
+                savePathInclBucket=f"{image_s3_bucketname}/{save_filepath}"
+
+                # forward file to s3 storage (in the background)
+                uploads.submit(file,save_filepath,bucket_override=image_s3_bucketname)
+
+                image_metadata=ImageMetadata(
+                    real_filename=filename,
+                    storage_filename=savePathInclBucket,
+                    coords=None,
+                    db=self,
+                    plate_type_id=plate_type_id,
+                )
+                imageMetadataList.append(image_metadata)
+
+                imageInsertionList.append({
+                    "plateid":plate_id,
+                    "s3path":savePathInclBucket,
+                    "wellid":image_metadata.well_id,
+                    "site_x":image_metadata.site_x,
+                    "site_y":image_metadata.site_y,
+                    "site_z":image_metadata.site_z,
+                    "site_t":image_metadata.site_t,
+                    "experimentchannelid":imaging_channel_ids[image_metadata.channelname],
+                    "coord_x_mm":image_metadata.coord_x_mm,
+                    "coord_y_mm":image_metadata.coord_y_mm,
+                    "coord_z_um":image_metadata.coord_z_um,
+                    "coord_t":image_metadata.coord_t,
+                })
 
-            filename=str(file.filename)
-            sec_filename = secure_filename(Path(filename).name)
-            save_filepath=os.path.join(experiment["project_name"],experiment["experiment_name"],sec_filename)
-
-            savePathInclBucket=f"{image_s3_bucketname}/{save_filepath}"
-            
-            # forward file to s3 storage
-            success=self.s3client.uploadFile(file,save_filepath,bucket_override=image_s3_bucketname)
-            assert success, f"uploading {save_filepath} to bucket {image_s3_bucketname} failed with {success}"
-
-            image_metadata=ImageMetadata(
-                real_filename=filename,
-                storage_filename=savePathInclBucket,
-                coords=None,
-                db=self
-            )
-            imageMetadataList.append(image_metadata)
-
-            imageInsertionList.append({
-                "plateid":plate_id,
-                "s3path":savePathInclBucket,
-                "wellid":image_metadata.well_id,
-                "site_x":image_metadata.site_x,
-                "site_y":image_metadata.site_y,
-                "site_z":image_metadata.site_z,
-                "site_t":image_metadata.site_t,
-                "experimentchannelid":imaging_channel_ids[image_metadata.channelname],
-                "coord_x_mm":image_metadata.coord_x_mm,
-                "coord_y_mm":image_metadata.coord_y_mm,
-                "coord_z_um":image_metadata.coord_z_um,
-                "coord_t":image_metadata.coord_t,
-            })
+        if skipped_files is not None:
+            skipped_files.extend(f"{image_s3_bucketname}/{object_name}" for object_name in uploads.skipped)
 
         print(f"inserting {len(imageMetadataList)} images")
         self.dbExec(self.dbImages.insert(),imageInsertionList)
@@ -856,11 +1114,12 @@ class DB:
         experiment_id=self.getExperimentID(project_name,experiment_name)
 
         # check if batch is already registered
-        res=self.dbExec(f"""
-            select id,status from profile_results
-            where experimentid={experiment_id}
-            and batchid={batchid};
-        """)
+        stmt=self._statement("profile_results.id_status",lambda:
+            select(self.dbProfileResults.c.id,self.dbProfileResults.c.status)
+            .where(self.dbProfileResults.c.experimentid==bindparam("experiment_id"))
+            .where(self.dbProfileResults.c.batchid==bindparam("batch_id"))
+        )
+        res=self.dbExec(stmt,{"experiment_id":experiment_id,"batch_id":batchid})
         assert type(res)==list
         if len(res)>0:
             if res[0][1]!=initial_status:
@@ -876,6 +1135,33 @@ class DB:
         assert type(res)==list
         assert len(res)==1, len(res)
 
+    def registerBatches(self,
+        project_name:str,
+        experiment_name:str,
+        batchids:tp.List[int],
+        initial_status:str="registered"
+    ):
+        """
+        register several new batches in the database with a single multi-row insert
+
+        the batch ids must not be registered yet, i.e. should come from reserveProcessingBatchIDs
+        """
+
+        if len(batchids)==0:
+            return
+
+        experiment_id=self.getExperimentID(project_name,experiment_name)
+
+        self.dbExec(self.dbProfileResults.insert(),[
+            {
+                "experimentid":experiment_id,
+                "batchid":batchid,
+                "status":initial_status,
+            }
+            for batchid
+            in batchids
+        ])
+
     def insertProfileResultBatch(self,
         project_name:str,
         experiment_name:str,
@@ -885,54 +1171,159 @@ class DB:
     ):
         
         experiment_id=self.getExperimentID(project_name,experiment_name)
-        profile_result_id_res=self.dbExec(f"""
-            select id from profile_results
-            where experimentid={experiment_id}
-            and batchid={batchid};
-        """)
+        stmt=self._statement("profile_results.id_status",lambda:
+            select(self.dbProfileResults.c.id,self.dbProfileResults.c.status)
+            .where(self.dbProfileResults.c.experimentid==bindparam("experiment_id"))
+            .where(self.dbProfileResults.c.batchid==bindparam("batch_id"))
+        )
+        profile_result_id_res=self.dbExec(stmt,{"experiment_id":experiment_id,"batch_id":batchid})
         assert type(profile_result_id_res)==list
         assert len(profile_result_id_res)==1, len(profile_result_id_res)
         profile_result_id:int=profile_result_id_res[0][0]
 
-        # write result file paths
-        for result_file in result_file_paths:
-            self.dbExec(self.dbProfileResultFiles.insert(),{
-                "profile_resultid":profile_result_id,
-                "s3path":result_file.s3path,
-                "filename":result_file.filename,
-            })
-
-        # write well list
-        for well_info in well_site_list:
-            well,site=well_info.well,well_info.site
-
-            # get experiment well site id by joining some tables
-            res=self.dbExec(f"""
-                select ews.id from experiment_wells ew
+        # each site is registered once per batch, even if it is listed once per cell
+        well_sites:tp.List[tp.Tuple[str,int]]=list(dict.fromkeys(
+            (well_info.well,well_info.site)
+            for well_info
+            in well_site_list
+        ))
+
+        # get experiment well site ids for all listed wells at once by joining some tables
+        site_ids:tp.Dict[tp.Tuple[str,int],int]={}
+        if len(well_sites)>0:
+            stmt=self._statement("experiment_well_sites.id_by_wells",lambda:text("""
+                select pw.well_name,ews.site_id,ews.id from experiment_wells ew
                 join platetype_wells pw on ew.wellid=pw.id
-                join experiments e on ew.experimentid=e.id
                 join experiment_well_sites ews on ew.id=ews.experiment_wellid
-                where pw.well_name='{well}' and e.id={experiment_id} and ews.site_id={site};
-                """)
+                where ew.experimentid=:experiment_id and pw.well_name in :well_names;
+                """).bindparams(bindparam("well_names",expanding=True)))
+            res=self.dbExec(stmt,{
+                "experiment_id":experiment_id,
+                "well_names":list({well for well,_site in well_sites}),
+            })
             assert type(res)==list
-            if len(res)==0:
+            for well,site,well_site_id in res:
+                # keep the first entry, like a single-row lookup would
+                site_ids.setdefault((well,site),well_site_id)
+
+        for well,site in well_sites:
+            if (well,site) not in site_ids:
                 # get all sites (with name) and site ids for this experiment
-                res=self.dbExec(f"""
+                res=self.dbExec(text("""
                     select pw.well_name,ews.site_id from experiment_wells ew
                     join platetype_wells pw on ew.wellid=pw.id
                     join experiments e on ew.experimentid=e.id
                     join experiment_well_sites ews on ew.id=ews.experiment_wellid
-                    where e.id={experiment_id};
-                """,as_pd=True)
+                    where e.id=:experiment_id;
+                """),{"experiment_id":experiment_id},as_pd=True)
                 assert type(res)==pd.DataFrame
                 print(res)
                 raise ValueError(f"well {well} site {site} not found in database")
-            well_site_id=res[0][0]
 
-            self.dbExec(self.dbProfileResultBatchSites.insert(),{
+        # write result file paths and well list with multi-row inserts, in one transaction
+        with self.session():
+            if len(result_file_paths)>0:
+                self.dbExec(self.dbProfileResultFiles.insert(),[
+                    {
+                        "profile_resultid":profile_result_id,
+                        "s3path":result_file.s3path,
+                        "filename":result_file.filename,
+                    }
+                    for result_file
+                    in result_file_paths
+                ])
+
+            if len(well_sites)>0:
+                self.dbExec(self.dbProfileResultBatchSites.insert(),[
+                    {
+                        "profile_resultid":profile_result_id,
+                        "siteid":site_ids[well_site],
+                    }
+                    for well_site
+                    in well_sites
+                ])
+
+    def insertBatchStageTimings(self,
+        experiment_id:int,
+        batchid:int,
+        timings:tp.List[StageTiming],
+    ):
+        """
+        store the time spent in each stage of a processing batch (see getStageTimingStatistics)
+
+        the batch must have been registered before (see registerBatch)
+        """
+
+        if len(timings)==0:
+            return
+
+        stmt=self._statement("profile_results.id_status",lambda:
+            select(self.dbProfileResults.c.id,self.dbProfileResults.c.status)
+            .where(self.dbProfileResults.c.experimentid==bindparam("experiment_id"))
+            .where(self.dbProfileResults.c.batchid==bindparam("batch_id"))
+        )
+        profile_result_id_res=self.dbExec(stmt,{"experiment_id":experiment_id,"batch_id":batchid})
+        assert type(profile_result_id_res)==list
+        assert len(profile_result_id_res)==1, len(profile_result_id_res)
+        profile_result_id:int=profile_result_id_res[0][0]
+
+        self.dbExec(self.dbProfileResultStageTimings.insert(),[
+            {
                 "profile_resultid":profile_result_id,
-                "siteid":well_site_id,
-            })
+                "stage":timing.stage,
+                "duration_s":timing.duration_s,
+                "num_bytes":timing.num_bytes,
+            }
+            for timing
+            in timings
+        ])
+
+    def getStageTimingStatistics(self,
+        project_name:str,
+        experiment_name:str,
+        percentiles:tp.Sequence[int]=(50,90,99),
+    )->pd.DataFrame:
+        """
+        aggregate the stage timings of all processing batches of an experiment, e.g. to find the stage that
+        limits the throughput of a whole plate
+
+        inherits behaviour from getExperimentID
+
+        :param percentiles: percentiles of the stage durations to compute, each in [0,100]
+        :returns: one row per stage, sorted by total time spent in the stage (descending), with columns
+            stage, num_batches, total_s, fraction_of_total, mean_s, p<percentile>_s (for each percentile),
+            max_s, total_bytes and mb_per_s (total_bytes/total_s, NaN for stages without byte counts)
+        """
+
+        experiment_id=self.getExperimentID(project_name,experiment_name)
+
+        stmt=self._statement("profile_result_stage_timings.by_experiment",lambda:text("""
+            select st.stage,st.duration_s,st.num_bytes from profile_result_stage_timings st
+            join profile_results pr on st.profile_resultid=pr.id
+            where pr.experimentid=:experiment_id;
+        """))
+        res=self.dbExec(stmt,{"experiment_id":experiment_id},as_pd=True)
+        assert type(res)==pd.DataFrame
+
+        # mariadb has no aggregate percentile function, so aggregate here
+        res["duration_s"]=res["duration_s"].astype(float)
+        res["num_bytes"]=pd.to_numeric(res["num_bytes"])
+        stages=res.groupby("stage")
+        durations=stages["duration_s"]
+
+        stats=pd.DataFrame({
+            "num_batches":durations.count(),
+            "total_s":durations.sum(),
+        })
+        stats["fraction_of_total"]=stats["total_s"]/stats["total_s"].sum()
+        stats["mean_s"]=durations.mean()
+        for percentile in percentiles:
+            stats[f"p{percentile}_s"]=durations.quantile(percentile/100)
+        stats["max_s"]=durations.max()
+        stats["total_bytes"]=stages["num_bytes"].sum(min_count=1)
+        stats["mb_per_s"]=stats["total_bytes"]/MB/stats["total_s"]
+
+        return stats.sort_values("total_s",ascending=False).reset_index()
 
     def checkExperimentProcessingStatus(self,
         project_name:str,
@@ -948,11 +1339,12 @@ class DB:
         experiment_id=self.getExperimentID(project_name,experiment_name)
 
         # get list of wells and number of sites per well from experiment definition
-        experiment=self.dbExec(f"""
+        stmt=self._statement("experiments.grid_size",lambda:text("""
             select e.num_images_x,e.num_images_y,e.num_images_z,e.num_images_t
             from experiments e
-            where e.id={experiment_id};
-        """,as_pd=True)
+            where e.id=:experiment_id;
+        """))
+        experiment=self.dbExec(stmt,{"experiment_id":experiment_id},as_pd=True)
         assert type(experiment)==pd.DataFrame
         assert len(experiment)==1, f"experiment {experiment_name} not found in database"
         experiment=experiment.iloc[0]
@@ -960,123 +1352,119 @@ class DB:
         assert num_sites>0, f"no sites found for experiment {experiment_name}, which is a bug in the ingest code"
 
         # get list of well names from experiment_wells, using experimentid and wellid
-        wells=self.dbExec(f"""
+        stmt=self._statement("experiment_wells.well_names",lambda:text("""
             select pw.well_name
             from experiment_wells ew
             join platetype_wells pw
                 on ew.wellid=pw.id
-            where ew.experimentid={experiment_id};
-        """,as_pd=True)
+            where ew.experimentid=:experiment_id;
+        """))
+        wells=self.dbExec(stmt,{"experiment_id":experiment_id},as_pd=True)
         assert type(wells)==pd.DataFrame
         assert len(wells)>0, f"no wells found for experiment {experiment_name}"
-        wells=wells["well_name"].tolist()
-
-        res=Result_processingStatus(
-            wells={
-                well:{(s_i+1):0 for s_i in range(num_sites)}
-                for well
-                in wells
-            },
-            batch_information=[],
-            resultfiles={},
-            total_sites=0,
-            num_processed_sites=0,
-            num_registered_sites=0,
-        )
-
-        registered_sites=set()
-
-        # check if all sites in all wells have been processed
-        batches=self.dbExec(f"select batchid from profile_results where experimentid={experiment_id};")
+        # an experiment may list the same well more than once
+        wells=list(dict.fromkeys(wells["well_name"].tolist()))
+
+        # status information of all batches in this experiment
+        stmt=self._statement("profile_results.status_by_experiment",lambda:text("""
+            select batchid,status,start_time,end_time
+            from profile_results
+            where experimentid=:experiment_id
+            order by batchid;
+        """))
+        batches=self.dbExec(stmt,{"experiment_id":experiment_id})
         assert type(batches)==list
-        for batch in batches:
-            batch_id=batch[0]
-
-            # get batch status information
-            batch_status_res=self.dbExec(f"""
-                select status,start_time,end_time
-                from profile_results
-                where experimentid={experiment_id}
-                    and batchid={batch_id};
-            """)
-            assert type(batch_status_res)==list
-            assert len(batch_status_res)==1, len(batch_status_res)
-            batch_status_text,batch_status_startTime,batch_status_endTime=batch_status_res[0]
-            
-            res.batch_information.append(BatchStatusInformation(
+        batch_information=[
+            BatchStatusInformation(
                 batchid=batch_id,
                 status=batch_status_text,
                 start_time=batch_status_startTime,
                 end_time=batch_status_endTime,
-            ))
-
-            # get list of well+site that have been processed for this batch
-            # also get the file locations of the results
-            processed_sites=self.dbExec(f"""
-                select pw.well_name,ews.site_id,prf.s3path,prf.filename
-                from profile_result_batch_sites prbs
-                join experiment_well_sites ews
-                    on prbs.siteid=ews.id
-                join experiment_wells ew
-                    on ews.experiment_wellid=ew.id
-                join platetype_wells pw 
-                    on ew.wellid=pw.id
-                join profile_results pr
-                    on prbs.profile_resultid=pr.id
-                join profile_result_files prf 
-                    on prf.profile_resultid=pr.id
-                where prbs.profile_resultid = (
-                    select id
-                    from profile_results
-                    where experimentid={experiment_id}
-                        and batchid={batch_id}
+            )
+            for batch_id,batch_status_text,batch_status_startTime,batch_status_endTime
+            in batches
+        ]
+
+        # get list of well+site that have been processed by any batch of this experiment
+        # (a site only counts as processed if its batch has registered result files)
+        stmt=self._statement("profile_result_batch_sites.processed_sites",lambda:text("""
+            select distinct pw.well_name,ews.site_id
+            from profile_result_batch_sites prbs
+            join experiment_well_sites ews
+                on prbs.siteid=ews.id
+            join experiment_wells ew
+                on ews.experiment_wellid=ew.id
+            join platetype_wells pw
+                on ew.wellid=pw.id
+            join profile_results pr
+                on prbs.profile_resultid=pr.id
+            where pr.experimentid=:experiment_id
+                and exists (
+                    select 1
+                    from profile_result_files prf
+                    where prf.profile_resultid=pr.id
                 );
-            """,as_pd=True)
-            assert type(processed_sites)==pd.DataFrame
-
-            for _rowindex,row in processed_sites.iterrows():
-                well=row["well_name"]
-                site=row["site_id"]
-                s3path=row["s3path"]
-                filename=row["filename"]
-                res.wells[well][site]=1
-
-                registered_sites.add(site)
-
-                if get_merged_frames:
-                    file=BytesIO()
-
-                    # get merged frames from s3 as in-memory file
-                    self.s3client.downloadFileObj(object_name=s3path,fileobj=file)
-                    file.seek(0)
-
-                    # read file into memory dataframe with pandas, based on file ending .csv/.parquet
-                    if filename.endswith(".csv"):
-                        df=pd.read_csv(file)
-                    elif filename.endswith(".parquet"):
-                        df=pd.read_parquet(file)
-                    else:
-                        raise ValueError(f"unknown file ending for {filename}")
-                    
-                    # strip file ending
-                    filename=Path(filename).stem
-
-                    # if filename is not already in res, add it
-                    if filename not in res.resultfiles:
-                        res.resultfiles[filename]=df
-                    else:
-                        assert type(res.resultfiles[filename])==pd.DataFrame
-                        res.resultfiles[filename]=pd.concat([res.resultfiles[filename],df],axis=1)
-    
+        """))
+        processed_sites=self.dbExec(stmt,{"experiment_id":experiment_id},as_pd=True)
+        assert type(processed_sites)==pd.DataFrame
 
-        # TODO currently does not work because a batch only registers its wells/sites after finishing processing
-        for site in registered_sites:
-            res.num_registered_sites+=1
+        # flag each well+site of the experiment grid as processed (1) or not (0)
+        site_grid=pd.MultiIndex.from_product([wells,range(1,num_sites+1)],names=["well_name","site_id"])
+        processed_index=pd.MultiIndex.from_frame(processed_sites[["well_name","site_id"]].astype({"site_id":"int64"}))
+        site_flags=pd.Series(site_grid.isin(processed_index).astype(int),index=site_grid)
+        well_flags=site_flags.unstack(level="well_name").reindex(columns=wells)
 
-        for well,sites in res.wells.items():
-            for site,c in sites.items():
-                res.total_sites+=1
-                res.num_processed_sites+=c
+        res=Result_processingStatus(
+            wells=well_flags.to_dict(),
+            batch_information=batch_information,
+            resultfiles={},
+            total_sites=len(site_grid),
+            num_processed_sites=int(site_flags.sum()),
+            # TODO currently does not work because a batch only registers its wells/sites after finishing processing
+            num_registered_sites=int(processed_sites["site_id"].nunique()),
+        )
+
+        if get_merged_frames:
+            # get the file locations of the results of all batches that have processed sites
+            stmt=self._statement("profile_result_files.by_processed_experiment",lambda:text("""
+                select prf.s3path,prf.filename
+                from profile_result_files prf
+                join profile_results pr
+                    on prf.profile_resultid=pr.id
+                where pr.experimentid=:experiment_id
+                    and exists (
+                        select 1
+                        from profile_result_batch_sites prbs
+                        where prbs.profile_resultid=pr.id
+                    );
+            """))
+            result_files=self.dbExec(stmt,{"experiment_id":experiment_id})
+            assert type(result_files)==list
+
+            frames:tp.Dict[str,tp.List[pd.DataFrame]]={}
+            for s3path,filename in result_files:
+                file=BytesIO()
+
+                # get merged frames from s3 as in-memory file
+                self.s3client.downloadFileObj(object_name=s3path,fileobj=file)
+                file.seek(0)
+
+                # read file into memory dataframe with pandas, based on file ending .csv/.parquet
+                if filename.endswith(".csv"):
+                    df=pd.read_csv(file)
+                elif filename.endswith(".parquet"):
+                    df=pd.read_parquet(file)
+                else:
+                    raise ValueError(f"unknown file ending for {filename}")
+
+                # strip file ending
+                frames.setdefault(Path(filename).stem,[]).append(df)
+
+            res.resultfiles={
+                filename:pd.concat(dfs,axis=1)
+                for filename,dfs
+                in frames.items()
+            }
 
         return res
 
@@ -1084,7 +1472,7 @@ class DB:
         """ print forst n rows of each table in database, if they exist """
         assert self.dbmetadata.tables is not None
         for table in self.dbmetadata.tables.values():
-            res=self.dbExec(f"select * from {table.name} limit {n};",as_pd=True)
+            res=self.dbExec(select(table).limit(n),as_pd=True)
             assert type(res)==pd.DataFrame
             if res is not None:
                 print(table.name,res,sep="\n")
@@ -1092,12 +1480,130 @@ class DB:
     def getExperimentCompoundLayout(self,project_name:str,experiment_name:str)->str:
         project_id=self.getProjectID(project_name)
         experiment_id=self.getExperimentID(project_id,experiment_name)
-        res=self.dbExec(f"select compound_layout_path from experiments where projectid={project_id} and id={experiment_id};")
+        stmt=self._statement("experiments.compound_layout_path",lambda:
+            select(self.dbExperiments.c.compound_layout_path)
+            .where(self.dbExperiments.c.projectid==bindparam("project_id"))
+            .where(self.dbExperiments.c.id==bindparam("experiment_id"))
+        )
+        res=self.dbExec(stmt,{"project_id":project_id,"experiment_id":experiment_id})
         assert type(res)==list
         assert len(res)==1, f"expected 1 result, got {len(res)}"
         
         return res[0][0]
 
+    def _selectIDByName(self,table:Table,column:str,value:str)->tp.Optional[int]:
+        """ get id of the (first) row in table where column==value, or None if there is no such row """
+
+        stmt=self._statement(f"{table.name}.id_by_{column}",lambda:
+            select(table.c.id).where(table.c[column]==bindparam("value"))
+        )
+        res=self.dbExec(stmt,{"value":value})
+        assert type(res)==list
+        if len(res)==0:
+            return None
+        return res[0][0]
+
+    def _selectExperimentID(self,project_id:int,experiment_name:str)->tp.Optional[int]:
+        """ get id of an experiment in a project, or None if it does not exist """
+
+        stmt=self._statement("experiments.id_by_project_name",lambda:
+            select(self.dbExperiments.c.id)
+            .where(self.dbExperiments.c.projectid==bindparam("project_id"))
+            .where(self.dbExperiments.c.name==bindparam("experiment_name"))
+        )
+        res=self.dbExec(stmt,{"project_id":project_id,"experiment_name":experiment_name})
+        assert type(res)==list
+        if len(res)==0:
+            return None
+        return res[0][0]
+
+    def setBatchStatus(self,
+        experiment_id:int,
+        batchid:int,
+        status:str,
+        set_start_time:bool=False,
+        set_end_time:bool=False,
+    ):
+        """
+        update the status of a processing batch
+
+        :param set_start_time: if True, also set start_time of the batch to the current time
+        :param set_end_time: if True, also set end_time of the batch to the current time
+        """
+
+        def build()->Executable:
+            values:tp.Dict[str,tp.Any]={"status":bindparam("new_status")}
+            if set_start_time:
+                values["start_time"]=func.current_timestamp()
+            if set_end_time:
+                values["end_time"]=func.current_timestamp()
+
+            return (
+                update(self.dbProfileResults)
+                .where(self.dbProfileResults.c.experimentid==bindparam("experiment_id"))
+                .where(self.dbProfileResults.c.batchid==bindparam("batch_id"))
+                .values(**values)
+            )
+
+        stmt=self._statement(f"profile_results.set_status.{set_start_time:d}{set_end_time:d}",build)
+        self.dbExec(stmt,{"experiment_id":experiment_id,"batch_id":batchid,"new_status":status})
+
+    def getResultFiles(self,experiment_id:int)->tp.List[ObjectStorageFileReference]:
+        """ get references to the result files of all processing batches of an experiment """
+
+        stmt=self._statement("profile_result_files.by_experiment",lambda:
+            select(self.dbProfileResultFiles.c.s3path,self.dbProfileResultFiles.c.filename)
+            .join(self.dbProfileResults,self.dbProfileResultFiles.c.profile_resultid==self.dbProfileResults.c.id)
+            .where(self.dbProfileResults.c.experimentid==bindparam("experiment_id"))
+        )
+        res=self.dbExec(stmt,{"experiment_id":experiment_id})
+        assert type(res)==list
+
+        return [
+            ObjectStorageFileReference(s3path=s3path,filename=filename)
+            for s3path,filename
+            in res
+        ]
+
+    def getWellID(self,well_name:str,platetype_id:int)->int:
+        """
+        get id of a well (in platetype_wells) by its name, e.g. 'B03', on a plate type
+
+        served from DB.lookup_cache, raises if not found
+        """
+
+        def load()->tp.Dict[str,int]:
+            res=self.dbExec(
+                select(self.dbPlateTypeWells.c.well_name,self.dbPlateTypeWells.c.id)
+                .where(self.dbPlateTypeWells.c.platetypeid==platetype_id)
+            )
+            assert type(res)==list
+            return {name:id for name,id in res}
+
+        well_id=DB.lookup_cache.lookup(("platetype_wells",platetype_id),well_name,load)
+        if well_id is None:
+            raise ValueError(f"well name {well_name} not found in database")
+
+        return well_id
+
+    def getImagingChannelID(self,channel_name:str)->int:
+        """
+        get id of an imaging channel by its name, e.g. 'Fluorescence 405 nm Ex'
+
+        served from DB.lookup_cache, raises if not found
+        """
+
+        def load()->tp.Dict[str,int]:
+            res=self.dbExec(select(self.dbImagingChannels.c.name,self.dbImagingChannels.c.id))
+            assert type(res)==list
+            return {name:id for name,id in res if name is not None}
+
+        channel_id=DB.lookup_cache.lookup("imaging_channels",channel_name,load)
+        if channel_id is None:
+            raise ValueError(f"channel name {channel_name} not found in database")
+
+        return channel_id
+
     def getProjectID(self,project_name:str)->int:
         """
         get project id by project name
@@ -1105,13 +1611,11 @@ class DB:
         raises if not found
         """
 
-        res=self.dbExec(f"select id from projects where name='{project_name}';")
-        assert type(res)==list
-    
-        if len(res)==0:
+        project_id=self._selectIDByName(self.dbProjects,"name",project_name)
+        if project_id is None:
             raise ValueError(f"project '{project_name}' not found in database")
         
-        return res[0][0]
+        return project_id
     
     def getExperimentID(self,
         project:tp.Union[str,int],
@@ -1128,33 +1632,57 @@ class DB:
         else:
             project_id=project
         
-        res=self.dbExec(f"select id from experiments where projectid={project_id} and name='{experiment_name}';")
-        assert type(res)==list
-        if len(res)==0:
+        experiment_id=self._selectExperimentID(project_id,experiment_name)
+        if experiment_id is None:
             raise ValueError(f"experiment {experiment_name} not found in database")
         
-        return res[0][0]
+        return experiment_id
 
-    def getProcessingBatchID(self,project_name:str,experiment_name:str)->int:
+    def reserveProcessingBatchIDs(self,project_name:str,experiment_name:str,count:int)->tp.List[int]:
         """
-        get processing batch id for this experiment, by increasing the maximum batch id for this experiment by 1, and using 0 if none already exist
+        atomically reserve count consecutive processing batch ids for this experiment
+
+        concurrent callers (e.g. the web frontend and workers retrying a batch) never receive the same id.
+        the counter for an experiment starts after the highest batch id already registered for it (or at 0).
         """
-        
+        assert count>0, count
+
         experiment_id=self.getExperimentID(project_name,experiment_name)
+        params={"experiment_id":experiment_id,"count":count}
+
+        # create or increment the counter, and remember its new value for this connection, in a single statement.
+        # (a separate update and insert of a missing counter could deadlock on each other's gap locks. here,
+        # concurrent first reservations wait for the lock on the inserted row, then take the update branch)
+        reserve_stmt=self._statement("processing_batch_counters.reserve",lambda:text("""
+            insert into processing_batch_counters (experimentid,next_batchid)
+            select :experiment_id,last_insert_id(coalesce(max(batchid)+1,0)+:count)
+            from profile_results
+            where experimentid=:experiment_id
+            on duplicate key update next_batchid=last_insert_id(next_batchid+:count);
+        """))
+
+        with self.session():
+            self.dbExec(reserve_stmt,params)
+
+            res=self.dbExec(self._statement("last_insert_id",lambda:text("select last_insert_id();")))
+            assert type(res)==list
+            next_batchid:int=res[0][0]
 
-        res=self.dbExec(f"select max(batchid) from profile_results where experimentid={experiment_id};")
-        assert type(res)==list
-        if len(res)==0 or res[0][0] is None:
-            return 0
+        return list(range(next_batchid-count,next_batchid))
+
+    def getProcessingBatchID(self,project_name:str,experiment_name:str)->int:
+        """
+        reserve a single new processing batch id for this experiment (see reserveProcessingBatchIDs)
+        """
         
-        return res[0][0]+1
+        return self.reserveProcessingBatchIDs(project_name,experiment_name,1)[0]
 
     def getProjectNames(self)->Result_getProjectNames:
         """
         get a list of all project names
         """
 
-        res=self.dbExec("select name from projects;",as_pd=True)
+        res=self.dbExec(select(self.dbProjects.c.name),as_pd=True)
         assert type(res)==pd.DataFrame
         
         return Result_getProjectNames(
@@ -1169,7 +1697,11 @@ class DB:
         """
 
         projectid=self.getProjectID(projectname)
-        res=self.dbExec(f"select name from experiments where projectid={projectid};",as_pd=True)
+        stmt=self._statement("experiments.names",lambda:
+            select(self.dbExperiments.c.name)
+            .where(self.dbExperiments.c.projectid==bindparam("project_id"))
+        )
+        res=self.dbExec(stmt,{"project_id":projectid},as_pd=True)
         assert type(res)==pd.DataFrame
 
         return Result_getExperiments(
@@ -0,0 +1,181 @@
+import time, threading, contextvars, typing as tp
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+LATENCY_BUCKETS_S:tp.Tuple[float,...]=(0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0,30.0,60.0)
+""" upper bounds of the latency histogram buckets (an implicit +Inf bucket follows) """
+
+@dataclass(frozen=True)
+class OperationLabels:
+    operation:str
+    """ e.g. upload, download, head_bucket """
+    bucket:str
+    tag:str
+    """ set by the caller, e.g. the name of the task that uses the client """
+    outcome:str
+    """ ok or error """
+
+@dataclass
+class OperationStats:
+    count:int=0
+    num_bytes:int=0
+    duration_s:float=0.0
+    latency_bucket_counts:tp.List[int]=field(default_factory=lambda:[0]*(len(LATENCY_BUCKETS_S)+1))
+    """ number of requests per latency bucket (not cumulative), last entry is +Inf """
+
+class MetricsSink(ABC):
+    """ receives one record per object storage request """
+
+    @abstractmethod
+    def record(self,labels:OperationLabels,num_bytes:int,duration_s:float):
+        pass
+
+class InMemoryMetricsSink(MetricsSink):
+    """
+        aggregates records in memory, per set of labels
+
+        the aggregate can be inspected (snapshot, e.g. in tests) or rendered in the prometheus
+        text exposition format (renderText, e.g. for a /metrics endpoint)
+    """
+
+    def __init__(self,prefix:str="dbi_object_storage"):
+        self.prefix=prefix
+        self._lock=threading.Lock()
+        self._stats:tp.Dict[OperationLabels,OperationStats]={}
+
+    def record(self,labels:OperationLabels,num_bytes:int,duration_s:float):
+        bucket_index=len(LATENCY_BUCKETS_S)
+        for i,upper_bound in enumerate(LATENCY_BUCKETS_S):
+            if duration_s<=upper_bound:
+                bucket_index=i
+                break
+
+        with self._lock:
+            stats=self._stats.get(labels)
+            if stats is None:
+                stats=self._stats[labels]=OperationStats()
+            stats.count+=1
+            stats.num_bytes+=num_bytes
+            stats.duration_s+=duration_s
+            stats.latency_bucket_counts[bucket_index]+=1
+
+    def snapshot(self)->tp.Dict[OperationLabels,OperationStats]:
+        """ get a copy of the current aggregates """
+        with self._lock:
+            return {
+                labels:OperationStats(
+                    count=stats.count,
+                    num_bytes=stats.num_bytes,
+                    duration_s=stats.duration_s,
+                    latency_bucket_counts=list(stats.latency_bucket_counts),
+                )
+                for labels,stats
+                in self._stats.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def renderText(self,extra_labels:tp.Optional[tp.Dict[str,str]]=None)->str:
+        """
+            render all aggregates in the prometheus text exposition format
+
+            :param extra_labels: added to every series, e.g. to tell apart the metrics of several processes
+        """
+        snapshot=self.snapshot()
+
+        def labelString(labels:OperationLabels,**extra:str)->str:
+            label_values={
+                "operation":labels.operation,
+                "bucket":labels.bucket,
+                "tag":labels.tag,
+                "outcome":labels.outcome,
+                **(extra_labels or {}),
+                **extra,
+            }
+            escaped=(
+                name+'="'+value.replace("\\","\\\\").replace('"','\\"').replace("\n","\\n")+'"'
+                for name,value
+                in label_values.items()
+            )
+            return "{"+",".join(escaped)+"}"
+
+        lines:tp.List[str]=[]
+
+        lines.append(f"# HELP {self.prefix}_requests_total number of object storage requests")
+        lines.append(f"# TYPE {self.prefix}_requests_total counter")
+        for labels,stats in snapshot.items():
+            lines.append(f"{self.prefix}_requests_total{labelString(labels)} {stats.count}")
+
+        lines.append(f"# HELP {self.prefix}_bytes_total number of bytes transferred")
+        lines.append(f"# TYPE {self.prefix}_bytes_total counter")
+        for labels,stats in snapshot.items():
+            lines.append(f"{self.prefix}_bytes_total{labelString(labels)} {stats.num_bytes}")
+
+        lines.append(f"# HELP {self.prefix}_request_duration_seconds duration of object storage requests")
+        lines.append(f"# TYPE {self.prefix}_request_duration_seconds histogram")
+        for labels,stats in snapshot.items():
+            cumulative_count=0
+            for upper_bound,bucket_count in zip([*LATENCY_BUCKETS_S,float("inf")],stats.latency_bucket_counts):
+                cumulative_count+=bucket_count
+                le="+Inf" if upper_bound==float("inf") else repr(upper_bound)
+                lines.append(f"{self.prefix}_request_duration_seconds_bucket{labelString(labels,le=le)} {cumulative_count}")
+            lines.append(f"{self.prefix}_request_duration_seconds_sum{labelString(labels)} {stats.duration_s}")
+            lines.append(f"{self.prefix}_request_duration_seconds_count{labelString(labels)} {stats.count}")
+
+        return "\n".join(lines)+"\n"
+
+STORAGE_METRICS=InMemoryMetricsSink()
+""" default sink of all S3Client instances in this process """
+
+_metrics_tag:contextvars.ContextVar[tp.Optional[str]]=contextvars.ContextVar("metrics_tag",default=None)
+
+@contextmanager
+def metricsTag(tag:str)->tp.Iterator[None]:
+    """
+        label all object storage requests inside the with-block with tag (instead of the default tag of the client)
+
+        can also be used as a function decorator, e.g. on a celery task:
+            @metricsTag("cp_map")
+            def cp_map(...):
+    """
+    token=_metrics_tag.set(tag)
+    try:
+        yield
+    finally:
+        _metrics_tag.reset(token)
+
+def currentMetricsTag(default:str)->str:
+    """ get the tag set by the innermost metricsTag, or default if there is none """
+    tag=_metrics_tag.get()
+    return tag if tag is not None else default
+
+class RequestMeasurement:
+    """ handed to the with-block of measureRequest, which sets num_bytes once it is known """
+
+    def __init__(self):
+        self.num_bytes:int=0
+
+@contextmanager
+def measureRequest(
+    sink:MetricsSink,
+    operation:str,
+    bucket:str,
+    tag:str,
+)->tp.Iterator[RequestMeasurement]:
+    """ time the with-block and record it in sink, with outcome=error if it raises """
+    measurement=RequestMeasurement()
+    outcome="error"
+    start=time.perf_counter()
+    try:
+        yield measurement
+        outcome="ok"
+    finally:
+        duration_s=time.perf_counter()-start
+        sink.record(
+            OperationLabels(operation=operation,bucket=bucket,tag=tag,outcome=outcome),
+            num_bytes=measurement.num_bytes,
+            duration_s=duration_s,
+        )
@@ -1,45 +1,416 @@
-import os, boto3, typing as tp
+import os, mmap, time, asyncio, threading, contextvars, hashlib, shutil, tempfile, boto3, typing as tp
+from pathlib import Path
+import contextlib
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future
 
 from werkzeug.datastructures import FileStorage
 from botocore.exceptions import NoCredentialsError, ClientError
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from dataclasses import dataclass
 from botocore.client import Config
 
-_BUCKET_NAME_ENV=os.getenv("S3_BUCKET_NAME") ; assert _BUCKET_NAME_ENV is not None
-BUCKET_NAME=_BUCKET_NAME_ENV
+from .metrics import MetricsSink, RequestMeasurement, STORAGE_METRICS, measureRequest, currentMetricsTag
+from .storagebackend import StorageBackend, InMemoryBackend, LocalFilesystemBackend
 
-S3_HOSTNAME=os.getenv("S3_HOSTNAME") ; assert S3_HOSTNAME is not None
-_S3_PORT_ENV=os.getenv("S3_PORT") ; assert _S3_PORT_ENV is not None
-S3_PORT=int(_S3_PORT_ENV)
-S3_ACCESS_KEY_ID=os.getenv("S3_ACCESS_KEY_ID") ; assert S3_ACCESS_KEY_ID is not None
-S3_SECRET_ACCESS_KEY=os.getenv("S3_SECRET_ACCESS_KEY") ; assert S3_SECRET_ACCESS_KEY is not None
+STORAGE_BACKEND=os.getenv("STORAGE_BACKEND") or "s3"
+""" storage used by S3Client: s3 (boto3, the S3_* variables are required), filesystem (see STORAGE_ROOT_DIR) or memory (per process) """
+assert STORAGE_BACKEND in ("s3","filesystem","memory"), f"unknown STORAGE_BACKEND {STORAGE_BACKEND}"
+STORAGE_ROOT_DIR=os.getenv("STORAGE_ROOT_DIR")
+""" directory that contains the buckets of the filesystem backend """
+assert STORAGE_BACKEND!="filesystem" or STORAGE_ROOT_DIR is not None, "STORAGE_ROOT_DIR is required for STORAGE_BACKEND=filesystem"
 
-class S3Client:
-    def __init__(self):
-        self.session=boto3.session.Session(
-            aws_access_key_id=S3_ACCESS_KEY_ID,
-            aws_secret_access_key=S3_SECRET_ACCESS_KEY,
-        )
-        self.handle=self.session.client(
-            "s3",
-            endpoint_url=f'http://{S3_HOSTNAME}:{S3_PORT}',
-            config=Config(signature_version='s3v4'),
-            use_ssl=False, verify=False, # Disable SSL
+_BUCKET_NAME_ENV=os.getenv("S3_BUCKET_NAME") ; assert STORAGE_BACKEND!="s3" or _BUCKET_NAME_ENV is not None
+BUCKET_NAME=_BUCKET_NAME_ENV or "default"
+
+S3_HOSTNAME=os.getenv("S3_HOSTNAME") ; assert STORAGE_BACKEND!="s3" or S3_HOSTNAME is not None
+_S3_PORT_ENV=os.getenv("S3_PORT") ; assert STORAGE_BACKEND!="s3" or _S3_PORT_ENV is not None
+S3_PORT:tp.Optional[int]=int(_S3_PORT_ENV) if _S3_PORT_ENV else None
+S3_ACCESS_KEY_ID=os.getenv("S3_ACCESS_KEY_ID") ; assert STORAGE_BACKEND!="s3" or S3_ACCESS_KEY_ID is not None
+S3_SECRET_ACCESS_KEY=os.getenv("S3_SECRET_ACCESS_KEY") ; assert STORAGE_BACKEND!="s3" or S3_SECRET_ACCESS_KEY is not None
+
+_S3_BUCKET_CACHE_TTL_S_ENV=os.getenv("S3_BUCKET_CACHE_TTL_S")
+S3_BUCKET_CACHE_TTL_S:tp.Optional[float]=float(_S3_BUCKET_CACHE_TTL_S_ENV) if _S3_BUCKET_CACHE_TTL_S_ENV else None
+""" default time after which the existence of a known bucket is checked again (None: never) """
+
+S3_CACHE_DIR=os.getenv("S3_CACHE_DIR")
+""" directory of the local download cache (see ObjectCache), caching is disabled if not set """
+S3_CACHE_MAX_MB=float(os.getenv("S3_CACHE_MAX_MB") or 1024)
+""" size limit of the local download cache """
+
+S3_UPLOAD_CONCURRENCY=int(os.getenv("S3_UPLOAD_CONCURRENCY") or 8)
+""" default number of concurrent uploads in an UploadPipeline """
+
+S3_ASYNC_CONCURRENCY=int(os.getenv("S3_ASYNC_CONCURRENCY") or 32)
+""" default number of concurrent transfers of an AsyncS3Client """
+
+S3_MAX_POOL_CONNECTIONS=int(os.getenv("S3_MAX_POOL_CONNECTIONS") or 64)
+""" number of http connections kept open by an S3Client (should not be lower than the number of concurrent transfers) """
+
+S3_METRICS_TAG=os.getenv("S3_METRICS_TAG") or "default"
+""" tag of object storage requests that are not inside a metricsTag block """
+
+MB=1024*1024
+
+CONTENT_SHA256_METADATA_KEY="sha256"
+""" user metadata key under which uploadFileIfChanged stores the sha256 of the object contents """
+
+@dataclass(frozen=True)
+class TransferSettings:
+    """
+        settings for a single object transfer (upload or download)
+
+        objects larger than multipart_threshold_bytes are transferred in parts of multipart_chunksize_bytes,
+        with up to max_concurrency parts in flight at the same time (multipart uploads, ranged GETs for downloads).
+    """
+
+    multipart_threshold_bytes:int=int(float(os.getenv("S3_MULTIPART_THRESHOLD_MB") or 8)*MB)
+    """ objects at least this large are transferred in parts """
+    multipart_chunksize_bytes:int=int(float(os.getenv("S3_MULTIPART_CHUNKSIZE_MB") or 8)*MB)
+    """ size of each part """
+    max_concurrency:int=int(os.getenv("S3_TRANSFER_MAX_CONCURRENCY") or 10)
+    """ number of parts transferred at the same time """
+    parallel_ranged_get:bool=True
+    """ if False, downloads always use a single GET request, regardless of size """
+
+    def transferConfig(self,download:bool)->TransferConfig:
+        """ get boto3 transfer configuration for an upload (download=False) or a download (download=True) """
+        multipart_threshold=self.multipart_threshold_bytes
+        if download and not self.parallel_ranged_get:
+            # boto3 splits downloads into ranged GETs above the multipart threshold
+            multipart_threshold=2**63-1
+
+        return TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=self.multipart_chunksize_bytes,
+            max_concurrency=self.max_concurrency,
+            use_threads=self.max_concurrency>1,
         )
+
+TRANSFER_DEFAULT=TransferSettings()
+""" settings from environment (S3_MULTIPART_THRESHOLD_MB, S3_MULTIPART_CHUNKSIZE_MB, S3_TRANSFER_MAX_CONCURRENCY) """
+TRANSFER_SMALL_OBJECTS=TransferSettings(
+    multipart_threshold_bytes=64*MB,
+    multipart_chunksize_bytes=64*MB,
+    max_concurrency=1,
+    parallel_ranged_get=False,
+)
+""" for many small objects, e.g. single images: one request per object, no transfer threads """
+TRANSFER_LARGE_OBJECTS=TransferSettings(
+    multipart_threshold_bytes=16*MB,
+    multipart_chunksize_bytes=16*MB,
+    max_concurrency=32,
+    parallel_ranged_get=True,
+)
+""" for large objects, e.g. image stacks or result tables: many parts in flight at the same time """
+
+def _isNoSuchBucketError(e:Exception)->bool:
+    """ check if an exception raised by boto3 indicates that the bucket does not exist """
+    if isinstance(e,ClientError):
+        return e.response.get("Error",{}).get("Code")=="NoSuchBucket"
+    if isinstance(e,S3UploadFailedError):
+        # upload errors only contain the message of the underlying ClientError
+        return "NoSuchBucket" in str(e)
+    return False
+
+def _streamPosition(stream:tp.Any)->tp.Optional[int]:
+    """ get the current position in a stream, or None if it is not seekable """
+    try:
+        return stream.tell()
+    except (AttributeError,OSError,ValueError):
+        return None
+
+def _hashStream(stream:tp.Any,chunk_size_bytes:int=1*MB)->tp.Optional[tp.Tuple[str,str,int]]:
+    """
+        hash a stream from its current position to the end, then seek back to that position
+
+        :returns: (sha256 hex digest, md5 hex digest, number of bytes), or None if the stream is not seekable
+    """
+    start_pos=_streamPosition(stream)
+    if start_pos is None:
+        return None
+
+    sha256=hashlib.sha256()
+    md5=hashlib.md5()
+    num_bytes=0
+    while True:
+        chunk=stream.read(chunk_size_bytes)
+        if not chunk:
+            break
+        sha256.update(chunk)
+        md5.update(chunk)
+        num_bytes+=len(chunk)
+
+    stream.seek(start_pos)
+    return sha256.hexdigest(),md5.hexdigest(),num_bytes
+
+def _readIntoBuffer(stream:tp.Any,view:memoryview,chunk_size_bytes:int=1*MB)->int:
+    """
+        fill view with at most chunk_size_bytes from stream, without intermediate copies if stream supports readinto
+
+        :returns: number of bytes read (0 at the end of the stream)
+    """
+    view=view[:chunk_size_bytes]
+    readinto=getattr(stream,"readinto",None)
+    if readinto is not None:
+        return readinto(view)
+
+    chunk=stream.read(len(view))
+    view[:len(chunk)]=chunk
+    return len(chunk)
+
+def _fillBuffer(stream:tp.Any,num_bytes:int,chunk_size_bytes:int=1*MB)->memoryview:
+    """ read exactly num_bytes from stream into a single, newly allocated buffer """
+    view=memoryview(bytearray(num_bytes))
+    pos=0
+    while pos<num_bytes:
+        num_read=_readIntoBuffer(stream,view[pos:],chunk_size_bytes)
+        if num_read==0:
+            raise IOError(f"stream ended after {pos} of {num_bytes} bytes")
+        pos+=num_read
+    return view
+
+def _mapFile(path:Path)->memoryview:
+    """ map a file into memory (read-only), the mapping stays valid even if the file is replaced or removed """
+    try:
+        with path.open("rb") as f:
+            if os.fstat(f.fileno()).st_size==0:
+                # empty files cannot be mapped
+                return memoryview(b"")
+            return memoryview(mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ))
+    except FileNotFoundError as e:
+        raise ClientError({"Error":{"Code":"NoSuchKey","Message":str(e)}},"GetObject") from e
+
+class ObjectCache:
+    """
+        local disk cache for downloaded objects, keyed by bucket, key and ETag (i.e. by content)
+
+        may be shared by several processes (e.g. celery worker processes in the same container):
+        - entries are filled by downloading into a temporary file, which is then atomically renamed
+        - readers get an open file handle, which stays valid even if the entry is evicted concurrently
+        - entries are evicted least recently used first (by mtime, which is updated on every hit)
+          once the cache directory grows beyond max_bytes
+    """
+
+    FILL_PREFIX=".fill-"
+    STALE_FILL_AGE_S=24*3600
+    """ temporary files of (crashed) fills older than this are removed during eviction """
+
+    def __init__(self,directory:tp.Union[str,Path],max_bytes:int):
+        self.directory=Path(directory)
+        self.directory.mkdir(parents=True,exist_ok=True)
+        self.max_bytes=max_bytes
+        self.hits:int=0
+        self.misses:int=0
+
+    @staticmethod
+    def fromEnvironment()->tp.Optional["ObjectCache"]:
+        """ create cache from S3_CACHE_DIR and S3_CACHE_MAX_MB, returns None if S3_CACHE_DIR is not set """
+        if not S3_CACHE_DIR:
+            return None
+        return ObjectCache(S3_CACHE_DIR,max_bytes=int(S3_CACHE_MAX_MB*MB))
+
+    def _entryPath(self,bucket:str,object_name:str,etag:str)->Path:
+        key=hashlib.sha256(f"{bucket}/{object_name}\0{etag}".encode()).hexdigest()
+        return self.directory/key
+
+    def open(self,bucket:str,object_name:str,etag:str)->tp.Optional[tp.BinaryIO]:
+        """ open cached object for reading, returns None if it is not cached """
+        path=self._entryPath(bucket,object_name,etag)
+        try:
+            f=path.open("rb")
+        except FileNotFoundError:
+            self.misses+=1
+            return None
+
+        # mark as recently used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        self.hits+=1
+        return f
+
+    def fill(self,
+        bucket:str,
+        object_name:str,
+        etag:str,
+        download:tp.Callable[[str],None],
+    )->tp.BinaryIO:
+        """
+            add an object to the cache, and open it for reading
+
+            :param download: called with a local filename, must write the object contents to it
+        """
+        path=self._entryPath(bucket,object_name,etag)
+
+        fd,fill_filename=tempfile.mkstemp(dir=self.directory,prefix=ObjectCache.FILL_PREFIX)
+        os.close(fd)
+        try:
+            download(fill_filename)
+            f=open(fill_filename,"rb")
+            # if another process filled the same entry in the meantime, this replaces it with identical content
+            os.replace(fill_filename,path)
+        except BaseException:
+            try:
+                os.remove(fill_filename)
+            except FileNotFoundError:
+                pass
+            raise
+
+        self.evict()
+
+        return f
+
+    def evict(self):
+        """ remove least recently used entries until the cache is within its size limit """
+        now=time.time()
+        entries:tp.List[tp.Tuple[float,int,Path]]=[]
+        total_bytes=0
+        for path in self.directory.iterdir():
+            try:
+                stat=path.stat()
+            except FileNotFoundError:
+                continue
+
+            if path.name.startswith(ObjectCache.FILL_PREFIX):
+                # fills in progress are not evicted, unless they were left behind
+                if now-stat.st_mtime>ObjectCache.STALE_FILL_AGE_S:
+                    path.unlink(missing_ok=True)
+                continue
+
+            entries.append((stat.st_mtime,stat.st_size,path))
+            total_bytes+=stat.st_size
+
+        entries.sort()
+        for _mtime,size,path in entries:
+            if total_bytes<=self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total_bytes-=size
+
+_IN_MEMORY_BACKEND:tp.Optional[InMemoryBackend]=None
+_IN_MEMORY_BACKEND_LOCK=threading.Lock()
+
+def storageBackendFromEnvironment()->tp.Optional[StorageBackend]:
+    """
+        create the storage backend configured through STORAGE_BACKEND
+
+        :returns: None for s3 (i.e. use a boto3 client), otherwise the backend. all clients in a
+            process share the same in-memory backend.
+    """
+    global _IN_MEMORY_BACKEND
+
+    if STORAGE_BACKEND=="filesystem":
+        assert STORAGE_ROOT_DIR is not None
+        return LocalFilesystemBackend(STORAGE_ROOT_DIR)
+    if STORAGE_BACKEND=="memory":
+        with _IN_MEMORY_BACKEND_LOCK:
+            if _IN_MEMORY_BACKEND is None:
+                _IN_MEMORY_BACKEND=InMemoryBackend()
+            return _IN_MEMORY_BACKEND
+    return None
+
+CACHE_FROM_ENVIRONMENT=object()
+""" S3Client cache argument: create a cache from S3_CACHE_DIR (see ObjectCache.fromEnvironment) when the client is created """
+
+class S3Client:
+    def __init__(self,
+        bucket_cache_ttl_s:tp.Optional[float]=S3_BUCKET_CACHE_TTL_S,
+        transfer:TransferSettings=TRANSFER_DEFAULT,
+        cache:tp.Union[ObjectCache,None,object]=CACHE_FROM_ENVIRONMENT,
+        metrics_sink:MetricsSink=STORAGE_METRICS,
+        metrics_tag:str=S3_METRICS_TAG,
+        backend:tp.Optional[StorageBackend]=None,
+    ):
+        """
+            :param bucket_cache_ttl_s: buckets verified by ensureBucket are assumed to exist for this
+                many seconds without checking again (None: until a request fails with NoSuchBucket)
+            :param transfer: transfer settings used by all transfers that do not override them
+            :param cache: if set, downloads are served from (and added to) this local cache. None disables
+                caching. defaults to a cache configured through S3_CACHE_DIR, if set.
+            :param metrics_sink: receives count, size and latency of every request
+            :param metrics_tag: tag of requests that are not inside a metricsTag block
+            :param backend: store objects in this backend instead of s3. defaults to the backend
+                configured through STORAGE_BACKEND (see storageBackendFromEnvironment).
+        """
+        if backend is None:
+            backend=storageBackendFromEnvironment()
+
+        if cache is CACHE_FROM_ENVIRONMENT:
+            cache=ObjectCache.fromEnvironment() if backend is None else None
+        assert cache is None or isinstance(cache,ObjectCache), cache
+
+        self.transfer=transfer
+        # objects of a local backend are already local, caching them would only duplicate them
+        self.cache:tp.Optional[ObjectCache]=cache if backend is None else None
+        self.metrics_sink=metrics_sink
+        self.metrics_tag=metrics_tag
+        self.bucket_cache_ttl_s=bucket_cache_ttl_s
+        self._known_buckets:tp.Dict[str,float]={}
+        """ bucket name -> time.monotonic() when its existence was last verified """
+        self._known_buckets_lock=threading.Lock()
+
+        self.handle:tp.Any
+        """ boto3 s3 client, or a StorageBackend with the same interface """
+        if backend is not None:
+            self.handle=backend
+        else:
+            assert S3_HOSTNAME is not None and S3_PORT is not None
+            self.session=boto3.session.Session(
+                aws_access_key_id=S3_ACCESS_KEY_ID,
+                aws_secret_access_key=S3_SECRET_ACCESS_KEY,
+            )
+            self.handle=self.session.client(
+                "s3",
+                endpoint_url=f'http://{S3_HOSTNAME}:{S3_PORT}',
+                config=Config(signature_version='s3v4',max_pool_connections=S3_MAX_POOL_CONNECTIONS),
+                use_ssl=False, verify=False, # Disable SSL
+            )
         assert self.handle is not None
 
+    def localPath(self,object_name:str,bucket_override:tp.Optional[str]=None)->tp.Optional[Path]:
+        """
+            get the path of the file that contains an object, if objects are stored in the local filesystem
+            (i.e. the file can be read or memory mapped directly instead of downloading the object)
+
+            :returns: None if the backend does not store objects as local files
+        """
+        if not isinstance(self.handle,LocalFilesystemBackend):
+            return None
+        bucket:str=bucket_override if bucket_override is not None else BUCKET_NAME
+        return self.handle.localPath(bucket,object_name)
+
+    def _measure(self,operation:str,bucket:str)->tp.ContextManager[RequestMeasurement]:
+        """ record the request inside the with-block in the metrics sink """
+        return measureRequest(self.metrics_sink,operation,bucket,currentMetricsTag(self.metrics_tag))
+
     def ensureBucket(self,bucket_name:str, region=None)->bool:
         """
         ensure the bucket exists in the region, i.e. create it if it does not exist.
         If no region is specified, the bucket is created in the S3 default region (us-east-1).
 
+        buckets that have been verified before are remembered (see bucket_cache_ttl_s), so that
+        only the first call for a bucket sends a request.
+
         :param bucket_name: Bucket to create
         :param region: String region to create bucket in, e.g., 'us-west-2'
         :return: True if bucket created, False is bucket already existed
         """
+
+        with self._known_buckets_lock:
+            verified_time=self._known_buckets.get(bucket_name)
+        if verified_time is not None:
+            if self.bucket_cache_ttl_s is None or time.monotonic()-verified_time<self.bucket_cache_ttl_s:
+                return False
         
         # Check if the bucket already exists
         try:
-            self.handle.head_bucket(Bucket=bucket_name)
+            with self._measure("head_bucket",bucket_name):
+                self.handle.head_bucket(Bucket=bucket_name)
+            self._rememberBucket(bucket_name)
             return False
         except ClientError as e:
             assert "Error" in e.response
@@ -48,15 +419,17 @@ class S3Client:
             if error_code == '404':
                 # The bucket does not exist, create it
                 try:
-                    if region is None:
-                        self.handle.create_bucket(Bucket=bucket_name)
-                    else:
-                        location = {'LocationConstraint': region}
-                        self.handle.create_bucket(
-                            Bucket=bucket_name,
-                            CreateBucketConfiguration=location, # type: ignore # the argument type is dict!
-                        )
+                    with self._measure("create_bucket",bucket_name):
+                        if region is None:
+                            self.handle.create_bucket(Bucket=bucket_name)
+                        else:
+                            location = {'LocationConstraint': region}
+                            self.handle.create_bucket(
+                                Bucket=bucket_name,
+                                CreateBucketConfiguration=location, # type: ignore # the argument type is dict!
+                            )
 
+                    self._rememberBucket(bucket_name)
                     return True
                 except ClientError as e:
                     print(f"Failed to create bucket: {e}")
@@ -65,12 +438,35 @@ class S3Client:
                 print(f"Failed to check bucket existence: {e}")
                 raise RuntimeError(f"Failed to check bucket existence: {e}")
 
+    def _rememberBucket(self,bucket_name:str):
+        with self._known_buckets_lock:
+            self._known_buckets[bucket_name]=time.monotonic()
+
+    def invalidateBucket(self,bucket_name:tp.Optional[str]=None):
+        """ forget that a bucket (or all buckets, if none is specified) exists, so that ensureBucket checks again """
+        with self._known_buckets_lock:
+            if bucket_name is None:
+                self._known_buckets.clear()
+            else:
+                self._known_buckets.pop(bucket_name,None)
+
+    @contextmanager
+    def _invalidateOnMissingBucket(self,bucket_name:str):
+        """ forget about the bucket if a request inside the with-block fails because it does not exist (anymore) """
+        try:
+            yield
+        except (ClientError,S3UploadFailedError) as e:
+            if _isNoSuchBucketError(e):
+                self.invalidateBucket(bucket_name)
+            raise
+
 
     def uploadFile(
         self,
         file:tp.Union[str,FileStorage], 
         object_name:str,
         bucket_override:tp.Optional[str]=None, 
+        transfer:tp.Optional[TransferSettings]=None,
     )->bool:
         """
         Uploads a file to the specified S3 bucket on LocalStack
@@ -78,38 +474,497 @@ class S3Client:
         :param file_name: File to upload
         :param bucket: Bucket to upload to
         :param object_name: S3 object name. If not specified, file_name is used
+        :param transfer: override the transfer settings of this client for this upload
         :return: True if file was uploaded, else False
         """
 
         bucket:str =bucket_override if bucket_override is not None else BUCKET_NAME
         self.ensureBucket(bucket)
+        config=(transfer or self.transfer).transferConfig(download=False)
 
         try:
-            if isinstance(file, str):
-                self.handle.upload_file(file, bucket, object_name)
-            elif isinstance(file, FileStorage):
-                self.handle.upload_fileobj(file.stream, bucket, object_name)
-            else:
-                raise ValueError(f"file must be either a string or a FileStorage object, not {type(file)}")
+            with self._invalidateOnMissingBucket(bucket), self._measure("upload",bucket) as measurement:
+                if isinstance(file, str):
+                    self.handle.upload_file(file, bucket, object_name, Config=config)
+                    measurement.num_bytes=os.path.getsize(file)
+                elif isinstance(file, FileStorage):
+                    start_pos=_streamPosition(file.stream)
+                    self.handle.upload_fileobj(file.stream, bucket, object_name, Config=config)
+                    end_pos=_streamPosition(file.stream)
+                    if start_pos is not None and end_pos is not None:
+                        measurement.num_bytes=end_pos-start_pos
+                else:
+                    raise ValueError(f"file must be either a string or a FileStorage object, not {type(file)}")
         except NoCredentialsError:
             print("Credentials not available")
             return False
         return True
     
+    def uploadFileIfChanged(
+        self,
+        file:tp.Union[str,FileStorage],
+        object_name:str,
+        bucket_override:tp.Optional[str]=None,
+        transfer:tp.Optional[TransferSettings]=None,
+    )->bool:
+        """
+        upload a file, unless an object with identical contents already exists under the same name
+
+        the contents are hashed locally, then compared to the sha256 stored in the metadata of the
+        existing object (see CONTENT_SHA256_METADATA_KEY), or to its ETag (md5, for objects that were
+        uploaded in a single part without this metadata). if an upload is required, the hash is stored
+        with the new object.
+
+        :return: True if the file was uploaded, False if it was skipped because it is unchanged
+        :raises RuntimeError: if the upload failed
+        """
+
+        bucket:str=bucket_override if bucket_override is not None else BUCKET_NAME
+        self.ensureBucket(bucket)
+        config=(transfer or self.transfer).transferConfig(download=False)
+
+        stream:tp.Any=None
+        try:
+            if isinstance(file,str):
+                stream=open(file,"rb")
+            elif isinstance(file,FileStorage):
+                stream=file.stream
+            else:
+                raise ValueError(f"file must be either a string or a FileStorage object, not {type(file)}")
+
+            digests=_hashStream(stream)
+            if digests is None:
+                # cannot read the contents twice, so upload without comparing
+                if not self.uploadFile(file,object_name,bucket_override=bucket,transfer=transfer):
+                    raise RuntimeError(f"uploading {object_name} failed")
+                return True
+            sha256,md5,num_bytes=digests
+
+            existing=self._headObject(bucket,object_name)
+            if existing is not None and existing["ContentLength"]==num_bytes:
+                existing_sha256=existing.get("Metadata",{}).get(CONTENT_SHA256_METADATA_KEY)
+                existing_etag=str(existing.get("ETag","")).strip('"')
+                if existing_sha256==sha256 or (existing_sha256 is None and existing_etag==md5):
+                    with self._measure("upload_skipped",bucket) as measurement:
+                        measurement.num_bytes=num_bytes
+                    return False
+
+            with self._invalidateOnMissingBucket(bucket), self._measure("upload",bucket) as measurement:
+                self.handle.upload_fileobj(
+                    stream, bucket, object_name,
+                    ExtraArgs={"Metadata":{CONTENT_SHA256_METADATA_KEY:sha256}},
+                    Config=config,
+                )
+                measurement.num_bytes=num_bytes
+            return True
+        except NoCredentialsError as e:
+            raise RuntimeError(f"uploading {object_name} failed: credentials not available") from e
+        finally:
+            if isinstance(file,str) and stream is not None:
+                stream.close()
+
+    def _headObject(self,bucket:str,object_name:str)->tp.Optional[tp.Dict[str,tp.Any]]:
+        """ get the metadata of an object, or None if it does not exist """
+        try:
+            with self._invalidateOnMissingBucket(bucket), self._measure("head_object",bucket):
+                return self.handle.head_object(Bucket=bucket,Key=object_name)
+        except ClientError as e:
+            if e.response.get("Error",{}).get("Code") in ("404","NoSuchKey","NotFound"):
+                return None
+            raise
+
     def downloadFile(self,
         object_name:str,
         local_filename:str,
         bucket_override:tp.Optional[str]=None,
+        transfer:tp.Optional[TransferSettings]=None,
     ):
         bucket:str=bucket_override if bucket_override is not None else BUCKET_NAME
         self.ensureBucket(bucket)
-        self.handle.download_file(bucket, object_name, local_filename)
+        config=(transfer or self.transfer).transferConfig(download=True)
+        with self._invalidateOnMissingBucket(bucket), self._measure("download",bucket) as measurement:
+            if self.cache is not None:
+                with self._openCached(bucket,object_name,config) as cached_file, open(local_filename,"wb") as f:
+                    shutil.copyfileobj(cached_file,f)
+            else:
+                self.handle.download_file(bucket, object_name, local_filename, Config=config)
+
+            measurement.num_bytes=os.path.getsize(local_filename)
 
     def downloadFileObj(self,
         object_name:str,
         fileobj:tp.BinaryIO,
         bucket_override:tp.Optional[str]=None,
+        transfer:tp.Optional[TransferSettings]=None,
     ):
         bucket:str=bucket_override if bucket_override is not None else BUCKET_NAME
         self.ensureBucket(bucket)
-        self.handle.download_fileobj(bucket, object_name, fileobj)
+        config=(transfer or self.transfer).transferConfig(download=True)
+        with self._invalidateOnMissingBucket(bucket), self._measure("download",bucket) as measurement:
+            start_pos=_streamPosition(fileobj)
+            if self.cache is not None:
+                with self._openCached(bucket,object_name,config) as cached_file:
+                    shutil.copyfileobj(cached_file,fileobj)
+            else:
+                self.handle.download_fileobj(bucket, object_name, fileobj, Config=config)
+
+            end_pos=_streamPosition(fileobj)
+            if start_pos is not None and end_pos is not None:
+                measurement.num_bytes=end_pos-start_pos
+
+    def getBuffer(self,
+        object_name:str,
+        bucket_override:tp.Optional[str]=None,
+    )->memoryview:
+        """
+        download an object into memory
+
+        allocates a single buffer of exactly the size of the object and reads into it directly,
+        i.e. the contents are not copied again and the buffer never grows.
+        the returned memoryview can be consumed without copies, e.g. with pyarrow.BufferReader(view)
+        (for pd.read_parquet) or by a flask Response.
+        with the filesystem backend, the object file is memory mapped instead (read-only).
+        """
+        bucket:str=bucket_override if bucket_override is not None else BUCKET_NAME
+        self.ensureBucket(bucket)
+        local_path=self.localPath(object_name,bucket_override=bucket)
+        if local_path is not None:
+            with self._measure("mmap",bucket) as measurement:
+                view=_mapFile(local_path)
+                measurement.num_bytes=len(view)
+                return view
+
+        with self._invalidateOnMissingBucket(bucket), self._measure("download",bucket) as measurement:
+            if self.cache is not None:
+                config=self.transfer.transferConfig(download=True)
+                with self._openCached(bucket,object_name,config) as cached_file:
+                    view=_fillBuffer(cached_file,os.fstat(cached_file.fileno()).st_size)
+            else:
+                response=self.handle.get_object(Bucket=bucket,Key=object_name)
+                body=response["Body"]
+                try:
+                    view=_fillBuffer(body,response["ContentLength"])
+                finally:
+                    body.close()
+
+            measurement.num_bytes=len(view)
+            return view
+
+    def _openCached(self,bucket:str,object_name:str,config:TransferConfig)->tp.BinaryIO:
+        """ open an object from the local cache, downloading it into the cache first if its current version is not cached """
+        assert self.cache is not None
+
+        # the ETag changes when the object is overwritten, so stale entries are never returned
+        with self._measure("head_object",bucket):
+            etag:str=self.handle.head_object(Bucket=bucket,Key=object_name)["ETag"]
+
+        cached_file=self.cache.open(bucket,object_name,etag)
+        if cached_file is None:
+            def download(filename:str):
+                with self._measure("cache_fill",bucket) as measurement:
+                    self.handle.download_file(bucket,object_name,filename,Config=config)
+                    measurement.num_bytes=os.path.getsize(filename)
+
+            cached_file=self.cache.fill(bucket,object_name,etag,download=download)
+        return cached_file
+
+class UploadError(RuntimeError):
+    """ raised by UploadPipeline when at least one upload failed """
+
+    def __init__(self,failures:tp.Dict[str,BaseException]):
+        self.failures=failures
+        """ object name -> exception raised while uploading it """
+        failure_list="\n".join(f"  {object_name}: {e!r}" for object_name,e in failures.items())
+        super().__init__(f"{len(failures)} upload(s) failed:\n{failure_list}")
+
+class UploadPipeline:
+    """
+        upload files to object storage in background threads, while the caller keeps preparing the next files
+
+        submit blocks while max_pending uploads are in flight (backpressure, limits memory use and open streams).
+        all failures are collected, and raised together as UploadError when the pipeline is closed.
+
+        example:
+            with UploadPipeline(s3client) as uploads:
+                for file in files:
+                    uploads.submit(file,object_name)
+                    ... # do other work while the upload runs
+    """
+
+    def __init__(self,
+        client:S3Client,
+        max_concurrency:tp.Optional[int]=None,
+        max_pending:tp.Optional[int]=None,
+        transfer:tp.Optional[TransferSettings]=None,
+        skip_unchanged:bool=False,
+    ):
+        """
+            :param max_concurrency: number of uploads that run at the same time (defaults to S3_UPLOAD_CONCURRENCY)
+            :param max_pending: number of submitted uploads that are not finished yet, before submit blocks (defaults to 2*max_concurrency)
+            :param transfer: transfer settings for each upload (defaults to the settings of the client)
+            :param skip_unchanged: skip files whose contents already exist under the same object name (see S3Client.uploadFileIfChanged)
+        """
+        self.client=client
+        self.transfer=transfer
+        self.skip_unchanged=skip_unchanged
+        self.max_concurrency=max_concurrency if max_concurrency is not None else S3_UPLOAD_CONCURRENCY
+        assert self.max_concurrency>0, self.max_concurrency
+        self.max_pending=max_pending if max_pending is not None else 2*self.max_concurrency
+        assert self.max_pending>=self.max_concurrency, (self.max_pending,self.max_concurrency)
+
+        self._executor=ThreadPoolExecutor(max_workers=self.max_concurrency,thread_name_prefix="s3upload")
+        self._pending_slots=threading.BoundedSemaphore(self.max_pending)
+        self._lock=threading.Lock()
+        self.failures:tp.Dict[str,BaseException]={}
+        """ object name -> exception, for all finished uploads that failed """
+        self.num_uploaded:int=0
+        self.skipped:tp.List[str]=[]
+        """ object names of files that were not uploaded because they are unchanged (in order of completion) """
+
+    def _upload(self,file:tp.Union[str,FileStorage],object_name:str,bucket_override:tp.Optional[str])->bool:
+        """ returns False if the upload was skipped """
+        if self.skip_unchanged:
+            return self.client.uploadFileIfChanged(file,object_name,bucket_override=bucket_override,transfer=self.transfer)
+
+        success=self.client.uploadFile(file,object_name,bucket_override=bucket_override,transfer=self.transfer)
+        if not success:
+            raise RuntimeError(f"uploading {object_name} failed")
+        return True
+
+    def _finished(self,object_name:str,future:Future):
+        self._pending_slots.release()
+        e=future.exception()
+        with self._lock:
+            if e is not None:
+                self.failures[object_name]=e
+            elif future.result():
+                self.num_uploaded+=1
+            else:
+                self.skipped.append(object_name)
+
+    def submit(self,
+        file:tp.Union[str,FileStorage],
+        object_name:str,
+        bucket_override:tp.Optional[str]=None,
+    ):
+        """ queue an upload (same arguments as S3Client.uploadFile), blocks while max_pending uploads are in flight """
+        self._pending_slots.acquire()
+        try:
+            # run in the context of the caller, e.g. to keep its metricsTag
+            context=contextvars.copy_context()
+            future=self._executor.submit(context.run,self._upload,file,object_name,bucket_override)
+        except BaseException:
+            self._pending_slots.release()
+            raise
+        future.add_done_callback(lambda future:self._finished(object_name,future))
+
+    def close(self,raise_on_failure:bool=True):
+        """ wait for all submitted uploads to finish, then raise UploadError if any of them failed """
+        self._executor.shutdown(wait=True)
+        if raise_on_failure and len(self.failures)>0:
+            raise UploadError(dict(self.failures))
+
+    def __enter__(self)->"UploadPipeline":
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        # if the caller failed, still wait for running uploads, but report the original exception
+        self.close(raise_on_failure=exc_type is None)
+
+class AsyncS3Client:
+    """
+        asyncio interface for bulk transfers, e.g. to fetch hundreds of objects from a single thread
+
+        uses the (thread-safe) boto3 client, credentials, endpoint, bucket cache and transfer settings
+        of an S3Client. blocking boto3 calls run on a dedicated thread pool of max_concurrency threads,
+        which also bounds the number of requests in flight.
+
+        object bodies are streamed in chunks, so cancelling a transfer (or a get_many/put_many call)
+        takes effect after the current chunk.
+
+        example:
+            async_client=AsyncS3Client(s3client)
+            contents=asyncio.run(async_client.get_many(["a/b.parquet","a/c.parquet"]))
+    """
+
+    def __init__(self,
+        client:tp.Optional[S3Client]=None,
+        max_concurrency:int=S3_ASYNC_CONCURRENCY,
+        chunk_size_bytes:int=1*MB,
+    ):
+        self.client=client if client is not None else S3Client()
+        assert max_concurrency>0, max_concurrency
+        self.max_concurrency=max_concurrency
+        self.chunk_size_bytes=chunk_size_bytes
+
+        self._executor=ThreadPoolExecutor(max_workers=max_concurrency,thread_name_prefix="s3async")
+
+        # limits the number of open transfers (the semaphore is bound to the event loop it is first used in)
+        self._slots:tp.Optional[asyncio.Semaphore]=None
+        self._slots_loop:tp.Optional[asyncio.AbstractEventLoop]=None
+
+    def _transferSlots(self)->asyncio.Semaphore:
+        loop=asyncio.get_running_loop()
+        if self._slots is None or self._slots_loop is not loop:
+            self._slots=asyncio.Semaphore(self.max_concurrency)
+            self._slots_loop=loop
+        return self._slots
+
+    async def _run(self,func:tp.Callable[...,tp.Any],*args,**kwargs)->tp.Any:
+        loop=asyncio.get_running_loop()
+        # run_in_executor does not propagate context variables (e.g. the metricsTag)
+        context=contextvars.copy_context()
+        return await loop.run_in_executor(self._executor,lambda:context.run(func,*args,**kwargs))
+
+    async def _ensureBucket(self,bucket_override:tp.Optional[str])->str:
+        bucket:str=bucket_override if bucket_override is not None else BUCKET_NAME
+        # ensureBucket does not send a request for known buckets
+        await self._run(self.client.ensureBucket,bucket)
+        return bucket
+
+    async def get(self,
+        object_name:str,
+        dest:tp.Union[str,tp.BinaryIO,None]=None,
+        bucket_override:tp.Optional[str]=None,
+    )->tp.Optional[memoryview]:
+        """
+            download an object
+
+            :param dest: local filename or writable file object to stream the object into.
+                if None, the object contents are returned in a single buffer (see S3Client.getBuffer)
+        """
+        async with self._transferSlots():
+            return await self._get(object_name,dest,bucket_override)
+
+    async def _get(self,
+        object_name:str,
+        dest:tp.Union[str,tp.BinaryIO,None],
+        bucket_override:tp.Optional[str],
+    )->tp.Optional[memoryview]:
+        bucket=await self._ensureBucket(bucket_override)
+
+        if self.client.cache is not None or isinstance(self.client.handle,StorageBackend):
+            # go through the local cache of the client, or the local backend (whole objects, not streamed)
+            if dest is None:
+                return await self._run(self.client.getBuffer,object_name,bucket_override=bucket)
+            elif isinstance(dest,str):
+                await self._run(self.client.downloadFile,object_name,dest,bucket_override=bucket)
+            else:
+                await self._run(self.client.downloadFileObj,object_name,dest,bucket_override=bucket)
+            return None
+
+        with self.client._measure("download",bucket) as measurement:
+            with self.client._invalidateOnMissingBucket(bucket):
+                response=await self._run(self.client.handle.get_object,Bucket=bucket,Key=object_name)
+            body=response["Body"]
+
+            try:
+                if dest is None:
+                    # stream into a single buffer of the final size
+                    num_bytes:int=response["ContentLength"]
+                    view=memoryview(bytearray(num_bytes))
+                    pos=0
+                    while pos<num_bytes:
+                        num_read=await self._run(_readIntoBuffer,body,view[pos:],self.chunk_size_bytes)
+                        if num_read==0:
+                            raise IOError(f"{object_name} ended after {pos} of {num_bytes} bytes")
+                        pos+=num_read
+                        measurement.num_bytes=pos
+                    return view
+
+                with (open(dest,"wb") if isinstance(dest,str) else contextlib.nullcontext(dest)) as out:
+                    def transferChunk()->int:
+                        chunk=body.read(self.chunk_size_bytes)
+                        out.write(chunk)
+                        return len(chunk)
+
+                    while True:
+                        num_read=await self._run(transferChunk)
+                        if num_read==0:
+                            break
+                        measurement.num_bytes+=num_read
+                return None
+            finally:
+                body.close()
+
+    async def put(self,
+        object_name:str,
+        source:tp.Union[str,bytes,tp.BinaryIO],
+        bucket_override:tp.Optional[str]=None,
+        transfer:tp.Optional[TransferSettings]=None,
+    ):
+        """
+            upload an object
+
+            :param source: local filename, bytes, or readable file object (streamed, in parts if large)
+        """
+        async with self._transferSlots():
+            bucket=await self._ensureBucket(bucket_override)
+            config=(transfer or self.client.transfer).transferConfig(download=False)
+
+            with self.client._invalidateOnMissingBucket(bucket), self.client._measure("upload",bucket) as measurement:
+                if isinstance(source,str):
+                    await self._run(self.client.handle.upload_file,source,bucket,object_name,Config=config)
+                    measurement.num_bytes=os.path.getsize(source)
+                elif isinstance(source,bytes):
+                    await self._run(self.client.handle.put_object,Bucket=bucket,Key=object_name,Body=source)
+                    measurement.num_bytes=len(source)
+                else:
+                    start_pos=_streamPosition(source)
+                    await self._run(self.client.handle.upload_fileobj,source,bucket,object_name,Config=config)
+                    end_pos=_streamPosition(source)
+                    if start_pos is not None and end_pos is not None:
+                        measurement.num_bytes=end_pos-start_pos
+
+    async def _gatherBounded(self,coroutines:tp.List[tp.Awaitable[tp.Any]])->tp.List[tp.Any]:
+        """ run all coroutines, cancel the remaining ones as soon as one fails (or if the caller is cancelled) """
+        tasks=[asyncio.ensure_future(coroutine) for coroutine in coroutines]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            # wait for cancellations to finish, so that no transfer outlives this call
+            await asyncio.gather(*tasks,return_exceptions=True)
+            raise
+
+    async def get_many(self,
+        object_names:tp.Iterable[str],
+        dests:tp.Optional[tp.Iterable[tp.Union[str,tp.BinaryIO]]]=None,
+        bucket_override:tp.Optional[str]=None,
+    )->tp.Dict[str,tp.Optional[memoryview]]:
+        """
+            download many objects concurrently (at most max_concurrency at the same time)
+
+            :param dests: one destination per object (see get), if None the contents of all objects are returned
+            :returns: object name -> contents (None for objects written to a destination)
+        """
+        object_names=list(object_names)
+        dest_list:tp.List[tp.Union[str,tp.BinaryIO,None]]=list(dests) if dests is not None else [None]*len(object_names)
+        assert len(dest_list)==len(object_names), (len(dest_list),len(object_names))
+
+        results=await self._gatherBounded([
+            self.get(object_name,dest,bucket_override=bucket_override)
+            for object_name,dest
+            in zip(object_names,dest_list)
+        ])
+        return dict(zip(object_names,results))
+
+    async def put_many(self,
+        items:tp.Iterable[tp.Tuple[str,tp.Union[str,bytes,tp.BinaryIO]]],
+        bucket_override:tp.Optional[str]=None,
+        transfer:tp.Optional[TransferSettings]=None,
+    ):
+        """
+            upload many objects concurrently (at most max_concurrency at the same time)
+
+            :param items: (object name, source) pairs, see put
+        """
+        await self._gatherBounded([
+            self.put(object_name,source,bucket_override=bucket_override,transfer=transfer)
+            for object_name,source
+            in items
+        ])
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,251 @@
+import os, time, errno, shutil, hashlib, threading, typing as tp
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from .objectstorage import S3Client, MB
+from .metrics import metricsTag
+
+INPUT_STAGING_DIR=os.getenv("INPUT_STAGING_DIR")
+""" directory of the input staging area (see InputStaging), prefetching is disabled if not set """
+INPUT_STAGING_MAX_MB=float(os.getenv("INPUT_STAGING_MAX_MB") or 4096)
+""" size limit of the input staging area, objects are not prefetched while it is full """
+INPUT_STAGING_CONCURRENCY=int(os.getenv("INPUT_STAGING_CONCURRENCY") or 4)
+""" number of objects prefetched at the same time """
+
+class InputStaging:
+    """
+        bounded staging area on local disk for objects that a task will need soon
+
+        objects are prefetched in background threads (e.g. the inputs of the next reserved task, while
+        the current task is still computing), and then taken (moved) out of the staging area by the task
+        that needs them. a task that finds an object not staged (not prefetched yet, or removed because
+        the staging area was full) downloads it itself, so prefetching never changes results.
+
+        may be shared by several processes (e.g. the main celery worker process prefetches, the pool
+        process that runs the task takes):
+        - an object is downloaded into a fill file with a name derived from the object, which is created
+          exclusively, so each object is fetched at most once at a time
+        - take waits for a fill in progress to finish instead of downloading the same object again
+        - finished objects are renamed atomically into place
+        - a task that downloaded an object itself discards it (see discard), so that a prefetch that was
+          requested earlier, but finishes (or starts) later, does not leave behind an object that is never taken
+
+        objects that are never taken for other reasons (e.g. the task was revoked, or ran elsewhere) are removed
+        after STALE_ENTRY_AGE_S, or earlier when the staging area is full: then the least recently staged objects
+        are removed to make room. (if the area is too small for the inputs of all reserved tasks, this may remove
+        objects that a task would have taken, which it then downloads itself.)
+    """
+
+    FILL_PREFIX=".fill-"
+    DISCARD_PREFIX=".discarded-"
+    STALE_FILL_AGE_S=3600
+    """ fill files (and discard markers) older than this are assumed to be left behind by a crashed process (or no longer needed) """
+    STALE_ENTRY_AGE_S=6*3600
+    """ staged objects older than this are assumed to be no longer needed (e.g. their task ran elsewhere) """
+
+    def __init__(self,
+        client:S3Client,
+        directory:tp.Union[str,Path],
+        max_bytes:int,
+        max_concurrency:int=INPUT_STAGING_CONCURRENCY,
+    ):
+        self.client=client
+        self.directory=Path(directory)
+        self.directory.mkdir(parents=True,exist_ok=True)
+        self.max_bytes=max_bytes
+
+        self._executor=ThreadPoolExecutor(max_workers=max_concurrency,thread_name_prefix="inputstaging")
+        self._lock=threading.Lock()
+        self.num_prefetched:int=0
+        self.num_skipped:int=0
+        """ number of objects that were not prefetched because the staging area was full """
+
+        self._removeStale()
+
+    @staticmethod
+    def fromEnvironment(client:S3Client)->tp.Optional["InputStaging"]:
+        """ create staging area from INPUT_STAGING_DIR and INPUT_STAGING_MAX_MB, returns None if INPUT_STAGING_DIR is not set """
+        if not INPUT_STAGING_DIR:
+            return None
+        return InputStaging(client,INPUT_STAGING_DIR,max_bytes=int(INPUT_STAGING_MAX_MB*MB))
+
+    def _entryName(self,bucket:str,object_name:str)->str:
+        return hashlib.sha256(f"{bucket}/{object_name}".encode()).hexdigest()
+
+    def _entryPath(self,bucket:str,object_name:str)->Path:
+        return self.directory/self._entryName(bucket,object_name)
+
+    def _fillPath(self,bucket:str,object_name:str)->Path:
+        return self.directory/(InputStaging.FILL_PREFIX+self._entryName(bucket,object_name))
+
+    def _discardPath(self,bucket:str,object_name:str)->Path:
+        return self.directory/(InputStaging.DISCARD_PREFIX+self._entryName(bucket,object_name))
+
+    def _discardedSince(self,bucket:str,object_name:str,timestamp:float)->bool:
+        """ check if the object was discarded after timestamp (time.time()) """
+        try:
+            return self._discardPath(bucket,object_name).stat().st_mtime>=timestamp
+        except FileNotFoundError:
+            return False
+
+    def _removeStale(self,required_bytes:int=0):
+        """
+            remove fills left behind by crashed processes, and objects that were never taken
+
+            :param required_bytes: also remove the least recently staged objects (regardless of age) until this
+                much space is free
+        """
+        now=time.time()
+        entries:tp.List[tp.Tuple[float,int,Path]]=[]
+        total_bytes=0
+        for path in self.directory.iterdir():
+            is_entry=not path.name.startswith((InputStaging.FILL_PREFIX,InputStaging.DISCARD_PREFIX))
+            max_age_s=InputStaging.STALE_ENTRY_AGE_S if is_entry else InputStaging.STALE_FILL_AGE_S
+            try:
+                stat=path.stat()
+                if now-stat.st_mtime>max_age_s:
+                    path.unlink(missing_ok=True)
+                    continue
+            except FileNotFoundError:
+                continue
+            total_bytes+=stat.st_size
+            if is_entry:
+                entries.append((stat.st_mtime,stat.st_size,path))
+
+        entries.sort()
+        for _mtime,size,path in entries:
+            if total_bytes+required_bytes<=self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total_bytes-=size
+
+    def stagedBytes(self)->int:
+        """ total size of the staging area, including fills in progress """
+        total_bytes=0
+        for path in self.directory.iterdir():
+            try:
+                total_bytes+=path.stat().st_size
+            except FileNotFoundError:
+                pass
+        return total_bytes
+
+    def prefetch(self,objects:tp.Iterable[tp.Tuple[str,str]]):
+        """
+            stage objects in the background (does not block)
+
+            :param objects: (bucket, object name) pairs
+        """
+        requested_at=time.time()
+        for bucket,object_name in objects:
+            self._executor.submit(self._fetch,bucket,object_name,requested_at)
+
+    @metricsTag("prefetch")
+    def _fetch(self,bucket:str,object_name:str,requested_at:float):
+        entry_path=self._entryPath(bucket,object_name)
+        if entry_path.exists() or self._discardedSince(bucket,object_name,requested_at):
+            return
+
+        if self.stagedBytes()>=self.max_bytes:
+            self._removeStale(required_bytes=1)
+        if self.stagedBytes()>=self.max_bytes:
+            # full of fills in progress
+            with self._lock:
+                self.num_skipped+=1
+            return
+
+        fill_path=self._fillPath(bucket,object_name)
+        try:
+            fd=os.open(fill_path,os.O_CREAT|os.O_EXCL|os.O_WRONLY)
+        except FileExistsError:
+            # already being fetched
+            return
+        os.close(fd)
+
+        try:
+            self.client.downloadFile(object_name,str(fill_path),bucket_override=bucket)
+            os.replace(fill_path,entry_path)
+        except BaseException as e:
+            fill_path.unlink(missing_ok=True)
+            # the task downloads the object itself if prefetching failed
+            print(f"warning - prefetching {bucket}/{object_name} failed: {e!r}")
+            return
+
+        if self._discardedSince(bucket,object_name,requested_at):
+            # the task did not wait for this prefetch
+            entry_path.unlink(missing_ok=True)
+            return
+
+        with self._lock:
+            self.num_prefetched+=1
+
+    def take(self,bucket:str,object_name:str,dest:Path,timeout_s:float=600.0)->bool:
+        """
+            move a staged object to dest
+
+            waits for up to timeout_s if the object is currently being prefetched.
+
+            :returns: False if the object is not staged (then dest is not touched)
+        """
+        fill_path=self._fillPath(bucket,object_name)
+        deadline=time.monotonic()+timeout_s
+        while fill_path.exists() and time.monotonic()<deadline:
+            time.sleep(0.05)
+
+        entry_path=self._entryPath(bucket,object_name)
+        try:
+            os.replace(entry_path,dest)
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            if e.errno!=errno.EXDEV:
+                raise
+            # dest is on another filesystem
+            try:
+                shutil.move(str(entry_path),str(dest))
+            except FileNotFoundError:
+                return False
+        return True
+
+    def put(self,bucket:str,object_name:str,path:Path)->bool:
+        """
+            move a local copy of an object back into the staging area, e.g. so that a retry of a task
+            does not have to download it again
+
+            :returns: False if the staging area is full (then path is not touched)
+        """
+        size=path.stat().st_size
+        if size>self.max_bytes:
+            return False
+        if self.stagedBytes()+size>self.max_bytes:
+            self._removeStale(required_bytes=size)
+        if self.stagedBytes()+size>self.max_bytes:
+            return False
+
+        # staged again on purpose, e.g. for a retry, so an earlier discard no longer applies
+        self._discardPath(bucket,object_name).unlink(missing_ok=True)
+        entry_path=self._entryPath(bucket,object_name)
+        try:
+            os.replace(path,entry_path)
+        except OSError as e:
+            if e.errno!=errno.EXDEV:
+                raise
+            shutil.move(str(path),str(entry_path))
+        # the age of an entry counts from when it was staged
+        os.utime(entry_path)
+        return True
+
+    def discard(self,bucket:str,object_name:str):
+        """
+            remove an object that is no longer needed, e.g. because the task that needed it downloaded it
+            itself (take returned False), including a copy that is still being prefetched (or will be, if
+            prefetching was requested before this call)
+        """
+        discard_path=self._discardPath(bucket,object_name)
+        discard_path.touch()
+        # mtime is compared with the time a prefetch was requested
+        os.utime(discard_path)
+        self._entryPath(bucket,object_name).unlink(missing_ok=True)
+
+    def close(self):
+        """ stop prefetching (fills in progress are finished) """
+        self._executor.shutdown(wait=True,cancel_futures=True)
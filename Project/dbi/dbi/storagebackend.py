@@ -0,0 +1,265 @@
+import os, io, json, shutil, hashlib, tempfile, threading, typing as tp
+from abc import ABC, abstractmethod
+from pathlib import Path, PurePosixPath
+
+from botocore.exceptions import ClientError
+
+def _clientError(code:str,operation_name:str,message:str)->ClientError:
+    """ create an error like the one the boto3 s3 client raises for the same condition """
+    return ClientError({"Error":{"Code":code,"Message":message}},operation_name)
+
+class _HashingWriter:
+    """ writes to a file object while computing the md5 (i.e. the single part ETag) of everything written """
+
+    def __init__(self,fileobj:tp.BinaryIO):
+        self.fileobj=fileobj
+        self.md5=hashlib.md5()
+
+    def write(self,data:bytes)->int:
+        self.md5.update(data)
+        return self.fileobj.write(data)
+
+class StorageBackend(ABC):
+    """
+        object storage that is not accessed through the network
+
+        implements the subset of the boto3 s3 client interface that S3Client and AsyncS3Client use,
+        so that an instance can replace the boto3 client (S3Client.handle), including the error codes
+        of the ClientErrors raised for missing buckets and objects. transfer configurations
+        (Config=...) are accepted, and ignored.
+
+        subclasses implement the primitives below (buckets, objects as file objects, object info).
+    """
+
+    @abstractmethod
+    def _bucketExists(self,bucket:str)->bool:
+        pass
+
+    @abstractmethod
+    def _createBucket(self,bucket:str):
+        pass
+
+    @abstractmethod
+    def _objectInfo(self,bucket:str,key:str)->tp.Optional[tp.Dict[str,tp.Any]]:
+        """ returns dict with ContentLength, ETag and Metadata, or None if the object does not exist """
+
+    @abstractmethod
+    def _openObject(self,bucket:str,key:str)->tp.BinaryIO:
+        """ open an existing object for reading """
+
+    @abstractmethod
+    def _writeObject(self,bucket:str,key:str,fileobj:tp.BinaryIO,metadata:tp.Dict[str,str]):
+        """ create or replace an object with the contents of fileobj (read until the end) """
+
+    def _checkBucket(self,bucket:str,operation_name:str):
+        if not self._bucketExists(bucket):
+            raise _clientError("NoSuchBucket",operation_name,f"bucket {bucket} does not exist")
+
+    def _checkObject(self,bucket:str,key:str,operation_name:str)->tp.Dict[str,tp.Any]:
+        self._checkBucket(bucket,operation_name)
+        info=self._objectInfo(bucket,key)
+        if info is None:
+            raise _clientError("NoSuchKey",operation_name,f"object {key} does not exist in bucket {bucket}")
+        return info
+
+    # boto3 client interface
+
+    def head_bucket(self,Bucket:str,**kwargs)->tp.Dict[str,tp.Any]:
+        if not self._bucketExists(Bucket):
+            # like s3, head requests only report the http status
+            raise _clientError("404","HeadBucket","Not Found")
+        return {}
+
+    def create_bucket(self,Bucket:str,**kwargs)->tp.Dict[str,tp.Any]:
+        if self._bucketExists(Bucket):
+            raise _clientError("BucketAlreadyOwnedByYou","CreateBucket",f"bucket {Bucket} already exists")
+        self._createBucket(Bucket)
+        return {}
+
+    def head_object(self,Bucket:str,Key:str,**kwargs)->tp.Dict[str,tp.Any]:
+        if not self._bucketExists(Bucket):
+            raise _clientError("404","HeadObject","Not Found")
+        info=self._objectInfo(Bucket,Key)
+        if info is None:
+            raise _clientError("404","HeadObject","Not Found")
+        return info
+
+    def get_object(self,Bucket:str,Key:str,**kwargs)->tp.Dict[str,tp.Any]:
+        info=self._checkObject(Bucket,Key,"GetObject")
+        return {**info,"Body":self._openObject(Bucket,Key)}
+
+    def put_object(self,Bucket:str,Key:str,Body:tp.Union[bytes,tp.BinaryIO]=b"",Metadata:tp.Optional[tp.Dict[str,str]]=None,**kwargs)->tp.Dict[str,tp.Any]:
+        self._checkBucket(Bucket,"PutObject")
+        fileobj=io.BytesIO(Body) if isinstance(Body,(bytes,bytearray,memoryview)) else Body
+        self._writeObject(Bucket,Key,fileobj,dict(Metadata or {}))
+        return {}
+
+    def upload_fileobj(self,Fileobj:tp.BinaryIO,Bucket:str,Key:str,ExtraArgs:tp.Optional[tp.Dict[str,tp.Any]]=None,**kwargs):
+        self._checkBucket(Bucket,"PutObject")
+        self._writeObject(Bucket,Key,Fileobj,dict((ExtraArgs or {}).get("Metadata",{})))
+
+    def upload_file(self,Filename:str,Bucket:str,Key:str,ExtraArgs:tp.Optional[tp.Dict[str,tp.Any]]=None,**kwargs):
+        with open(Filename,"rb") as f:
+            self.upload_fileobj(f,Bucket,Key,ExtraArgs=ExtraArgs)
+
+    def download_fileobj(self,Bucket:str,Key:str,Fileobj:tp.BinaryIO,**kwargs):
+        self._checkObject(Bucket,Key,"GetObject")
+        with self._openObject(Bucket,Key) as f:
+            shutil.copyfileobj(f,Fileobj)
+
+    def download_file(self,Bucket:str,Key:str,Filename:str,**kwargs):
+        # like boto3, download into a temporary file that is renamed once complete, so that no (partial)
+        # file is left behind if the object does not exist or the download fails
+        self._checkObject(Bucket,Key,"GetObject")
+        path=Path(Filename)
+        fd,tmp_filename=tempfile.mkstemp(dir=path.parent,prefix=f".{path.name}.")
+        try:
+            with os.fdopen(fd,"wb") as f:
+                self.download_fileobj(Bucket,Key,f)
+            os.replace(tmp_filename,path)
+        except BaseException:
+            try:
+                os.remove(tmp_filename)
+            except FileNotFoundError:
+                pass
+            raise
+
+class InMemoryBackend(StorageBackend):
+    """ keeps all objects in memory of the current process, e.g. for tests and offline benchmarks """
+
+    def __init__(self):
+        self._lock=threading.Lock()
+        self._buckets:tp.Dict[str,tp.Dict[str,tp.Tuple[bytes,tp.Dict[str,tp.Any]]]]={}
+        """ bucket -> key -> (contents, info) """
+
+    def _bucketExists(self,bucket:str)->bool:
+        with self._lock:
+            return bucket in self._buckets
+
+    def _createBucket(self,bucket:str):
+        with self._lock:
+            self._buckets.setdefault(bucket,{})
+
+    def _objectInfo(self,bucket:str,key:str)->tp.Optional[tp.Dict[str,tp.Any]]:
+        with self._lock:
+            entry=self._buckets.get(bucket,{}).get(key)
+        if entry is None:
+            return None
+        return dict(entry[1])
+
+    def _openObject(self,bucket:str,key:str)->tp.BinaryIO:
+        with self._lock:
+            contents,_info=self._buckets[bucket][key]
+        return io.BytesIO(contents)
+
+    def _writeObject(self,bucket:str,key:str,fileobj:tp.BinaryIO,metadata:tp.Dict[str,str]):
+        contents=fileobj.read()
+        info={
+            "ContentLength":len(contents),
+            "ETag":f'"{hashlib.md5(contents).hexdigest()}"',
+            "Metadata":metadata,
+        }
+        with self._lock:
+            self._buckets[bucket][key]=(contents,info)
+
+class LocalFilesystemBackend(StorageBackend):
+    """
+        stores each object as a regular file below root_dir, at root_dir/<bucket>/<key>
+
+        object files can be used directly (see localPath), e.g. memory mapped instead of downloaded.
+        objects are written to a temporary file first and then renamed, so readers never see partial objects.
+        ETag and user metadata are kept in root_dir/.metadata/<bucket>/<key>.json
+    """
+
+    METADATA_DIR=".metadata"
+
+    def __init__(self,root_dir:tp.Union[str,Path]):
+        self.root_dir=Path(root_dir)
+        self.root_dir.mkdir(parents=True,exist_ok=True)
+
+    @staticmethod
+    def _checkName(name:str,what:str)->PurePosixPath:
+        """ make sure a bucket or key cannot point outside of its directory """
+        path=PurePosixPath(name)
+        if name=="" or path.is_absolute() or any(part in ("..",".") for part in path.parts) or name.startswith(LocalFilesystemBackend.METADATA_DIR):
+            raise _clientError("InvalidArgument","",f"invalid {what}: {name!r}")
+        return path
+
+    def _bucketDir(self,bucket:str)->Path:
+        return self.root_dir/self._checkName(bucket,"bucket name")
+
+    def localPath(self,bucket:str,key:str)->Path:
+        """ path of the file that contains the object (which may not exist) """
+        return self._bucketDir(bucket)/self._checkName(key,"object key")
+
+    def _metadataPath(self,bucket:str,key:str)->Path:
+        return self.root_dir/LocalFilesystemBackend.METADATA_DIR/self._checkName(bucket,"bucket name")/f"{self._checkName(key,'object key')}.json"
+
+    def _bucketExists(self,bucket:str)->bool:
+        return self._bucketDir(bucket).is_dir()
+
+    def _createBucket(self,bucket:str):
+        self._bucketDir(bucket).mkdir(parents=True,exist_ok=True)
+
+    def _objectInfo(self,bucket:str,key:str)->tp.Optional[tp.Dict[str,tp.Any]]:
+        path=self.localPath(bucket,key)
+        try:
+            size=path.stat().st_size
+        except (FileNotFoundError,NotADirectoryError):
+            return None
+        if not path.is_file():
+            return None
+
+        try:
+            stored=json.loads(self._metadataPath(bucket,key).read_text())
+        except FileNotFoundError:
+            # e.g. file placed into the directory by hand
+            stored={"ETag":None,"Metadata":{}}
+        if stored["ETag"] is None:
+            with path.open("rb") as f:
+                stored["ETag"]=f'"{_md5OfFile(f)}"'
+
+        return {"ContentLength":size,"ETag":stored["ETag"],"Metadata":stored["Metadata"]}
+
+    def _openObject(self,bucket:str,key:str)->tp.BinaryIO:
+        return self.localPath(bucket,key).open("rb")
+
+    def _writeObject(self,bucket:str,key:str,fileobj:tp.BinaryIO,metadata:tp.Dict[str,str]):
+        path=self.localPath(bucket,key)
+        path.parent.mkdir(parents=True,exist_ok=True)
+        metadata_path=self._metadataPath(bucket,key)
+        metadata_path.parent.mkdir(parents=True,exist_ok=True)
+
+        tmp_filenames:tp.List[str]=[]
+        try:
+            fd,tmp_filename=tempfile.mkstemp(dir=path.parent,prefix=".upload-")
+            tmp_filenames.append(tmp_filename)
+            with os.fdopen(fd,"wb") as f:
+                writer=_HashingWriter(f)
+                shutil.copyfileobj(fileobj,writer)
+
+            metadata_fd,tmp_metadata_filename=tempfile.mkstemp(dir=metadata_path.parent,prefix=".upload-")
+            tmp_filenames.append(tmp_metadata_filename)
+            with os.fdopen(metadata_fd,"w") as f:
+                json.dump({"ETag":f'"{writer.md5.hexdigest()}"',"Metadata":metadata},f)
+
+            # contents first: a reader may briefly see the new contents with the old ETag, but never
+            # the new ETag with old contents (which could e.g. be cached under the new ETag)
+            os.replace(tmp_filename,path)
+            os.replace(tmp_metadata_filename,metadata_path)
+        except BaseException:
+            for filename in tmp_filenames:
+                try:
+                    os.remove(filename)
+                except FileNotFoundError:
+                    pass
+            raise
+
+def _md5OfFile(f:tp.BinaryIO,chunk_size_bytes:int=1024*1024)->str:
+    md5=hashlib.md5()
+    while True:
+        chunk=f.read(chunk_size_bytes)
+        if not chunk:
+            break
+        md5.update(chunk)
+    return md5.hexdigest()
@@ -0,0 +1,71 @@
+"""
+    check that the hot lookups of DB are served by the indexes declared in the table definitions
+
+    requires a reachable mariadb server (configured through the same environment variables as DB),
+    skipped otherwise. the schema of the existing database is migrated (see DB.migrateSchema), no data is changed.
+"""
+
+import os, socket
+
+import pytest
+
+_MARIADB_ENV=("MARIADB_USER_USERNAME","MARIADB_HOSTNAME","MARIADB_PORT")
+
+def _mariadbReachable()->bool:
+    if any(os.getenv(name) is None for name in _MARIADB_ENV):
+        return False
+    try:
+        with socket.create_connection((os.environ["MARIADB_HOSTNAME"],int(os.environ["MARIADB_PORT"])),timeout=2):
+            return True
+    except OSError:
+        return False
+
+pytestmark=pytest.mark.skipif(not _mariadbReachable(),reason="no mariadb server reachable (see MARIADB_* environment variables)")
+
+HOT_LOOKUPS=[
+    # (table, query, expected index)
+    (
+        "profile_results",
+        "select id,status from profile_results where experimentid=1 and batchid=1",
+        "ix_profile_results_experimentid_batchid",
+    ),
+    (
+        "experiments",
+        "select id from experiments where projectid=1 and name='experiment'",
+        "ix_experiments_projectid_name",
+    ),
+    (
+        "platetype_wells",
+        "select id from platetype_wells where platetypeid=1 and well_name='B03'",
+        "ix_platetype_wells_platetypeid_well_name",
+    ),
+    (
+        "experiment_well_sites",
+        "select id from experiment_well_sites where experiment_wellid=1 and site_id=1",
+        "ix_experiment_well_sites_experiment_wellid_site_id",
+    ),
+    (
+        "profile_result_files",
+        "select s3path,filename from profile_result_files where profile_resultid=1",
+        "ix_profile_result_files_profile_resultid",
+    ),
+]
+
+@pytest.fixture(scope="module")
+def db():
+    # the object storage is not used by these tests
+    os.environ.setdefault("STORAGE_BACKEND","memory")
+    dbi=pytest.importorskip("dbi")
+
+    db=dbi.DB(recreate=False)
+    db.migrateSchema()
+    yield db
+    db.dbengine.dispose()
+
+@pytest.mark.parametrize("table,query,expected_index",HOT_LOOKUPS,ids=[table for table,_query,_index in HOT_LOOKUPS])
+def test_hot_lookup_uses_index(db,table:str,query:str,expected_index:str):
+    plan=db.dbExec(f"EXPLAIN {query};",as_pd=True)
+    row=plan[plan["table"]==table].iloc[0]
+
+    assert row["type"]!="ALL", f"full table scan for {query!r}:\n{plan}"
+    assert row["key"]==expected_index, f"{query!r} uses index {row['key']!r}:\n{plan}"
@@ -0,0 +1,67 @@
+"""
+    measure upload and download throughput of S3Client for several object sizes and transfer settings
+
+    runs against the localstack s3 container by default (see docker-compose.yaml), i.e. start it first, then run:
+        python3 benchmark-transfers.py [--sizes-mb 0.1 1 16 128] [--repeats 3]
+
+    the S3_* environment variables can be set to benchmark another endpoint.
+    with STORAGE_BACKEND=filesystem (and STORAGE_ROOT_DIR) or STORAGE_BACKEND=memory, no s3 service is required.
+"""
+
+import os, io, time, argparse, typing as tp
+
+# defaults for a local localstack container
+os.environ.setdefault("S3_HOSTNAME","localhost")
+os.environ.setdefault("S3_PORT","4566")
+os.environ.setdefault("S3_ACCESS_KEY_ID","test")
+os.environ.setdefault("S3_SECRET_ACCESS_KEY","test")
+os.environ.setdefault("S3_BUCKET_NAME","benchmark")
+# not used here, but required to import dbi
+os.environ.setdefault("MARIADB_USER_USERNAME","unused")
+os.environ.setdefault("MARIADB_HOSTNAME","unused")
+os.environ.setdefault("MARIADB_PORT","0")
+
+from dbi import S3Client, TransferSettings, TRANSFER_DEFAULT, TRANSFER_SMALL_OBJECTS, TRANSFER_LARGE_OBJECTS, MB
+
+SETTINGS:tp.Dict[str,TransferSettings]={
+    "default":TRANSFER_DEFAULT,
+    "small_objects":TRANSFER_SMALL_OBJECTS,
+    "large_objects":TRANSFER_LARGE_OBJECTS,
+}
+
+def main():
+    parser=argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes-mb",type=float,nargs="+",default=[0.1,1,16,128])
+    parser.add_argument("--repeats",type=int,default=3)
+    args=parser.parse_args()
+
+    s3client=S3Client()
+    s3client.ensureBucket(os.environ["S3_BUCKET_NAME"])
+
+    print(f"{'size [MB]':>10} {'settings':>14} {'upload [MB/s]':>14} {'download [MB/s]':>16}")
+    for size_mb in args.sizes_mb:
+        num_bytes=int(size_mb*MB)
+        local_filename=f"benchmark-{num_bytes}.bin"
+        with open(local_filename,"wb") as f:
+            f.write(os.urandom(num_bytes))
+
+        try:
+            for settings_name,settings in SETTINGS.items():
+                object_name=f"benchmark/{settings_name}/{num_bytes}.bin"
+
+                start=time.perf_counter()
+                for _ in range(args.repeats):
+                    s3client.uploadFile(local_filename,object_name,transfer=settings)
+                upload_s=(time.perf_counter()-start)/args.repeats
+
+                start=time.perf_counter()
+                for _ in range(args.repeats):
+                    s3client.downloadFileObj(object_name,io.BytesIO(),transfer=settings)
+                download_s=(time.perf_counter()-start)/args.repeats
+
+                print(f"{size_mb:>10} {settings_name:>14} {size_mb/upload_s:>14.1f} {size_mb/download_s:>16.1f}")
+        finally:
+            os.remove(local_filename)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+    long-lived cellprofiler process, which keeps the JVM and the parsed pipeline loaded between batches
+
+    the server side (run as a script) loads the project once, then runs one batch per request.
+    the client side (CellProfilerEngine) starts the server, sends batches over its stdin/stdout
+    (one json object per line), checks its health and replaces it after a number of batches or
+    when its memory use has grown too much.
+"""
+
+import os, sys, json, time, select, traceback, subprocess as sp, typing as tp
+from pathlib import Path
+
+CP_ENGINE_MAX_BATCHES=int(os.getenv("CP_ENGINE_MAX_BATCHES") or 50)
+""" number of batches after which the engine process is replaced """
+CP_ENGINE_MAX_RSS_GROWTH_MB=float(os.getenv("CP_ENGINE_MAX_RSS_GROWTH_MB") or 1024)
+""" the engine process is replaced once its memory use grew by this much since it finished starting up """
+CP_ENGINE_STARTUP_TIMEOUT_S=float(os.getenv("CP_ENGINE_STARTUP_TIMEOUT_S") or 300)
+CP_ENGINE_PING_TIMEOUT_S=float(os.getenv("CP_ENGINE_PING_TIMEOUT_S") or 30)
+
+OOM_EXIT_CODE=137
+""" exit code of a process killed by the OOM killer (128+SIGKILL), as reported by the shell """
+STARTUP_FAILED_EXIT_CODE=2
+""" exit code reported by CellProfilerEngine.run if the engine process could not be started """
+
+def _rssBytes(pid:int)->tp.Optional[int]:
+    """ resident memory of a process, or None if it cannot be read (e.g. not on linux) """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])*1024
+    except (FileNotFoundError,ProcessLookupError):
+        pass
+    return None
+
+class CellProfilerEngineError(RuntimeError):
+    """ the engine process did not respond as expected """
+
+class CellProfilerEngine:
+    """
+        client of a long-lived cellprofiler process
+
+        example:
+            engine=CellProfilerEngine("cellprofilerinput/morphology_pipeline.cpproj")
+            exit_code=engine.run("cellprofilerinput/imagefilelist.txt","cellprofilerinput/","cellprofileroutput/")
+            engine.close()
+    """
+
+    def __init__(self,
+        project_file:tp.Union[str,Path],
+        max_batches:int=CP_ENGINE_MAX_BATCHES,
+        max_rss_growth_bytes:int=int(CP_ENGINE_MAX_RSS_GROWTH_MB*1024*1024),
+    ):
+        self.project_file=Path(project_file).absolute()
+        self.max_batches=max_batches
+        self.max_rss_growth_bytes=max_rss_growth_bytes
+
+        self._process:tp.Optional[sp.Popen]=None
+        self._num_batches:int=0
+        self._baseline_rss_bytes:tp.Optional[int]=None
+
+    def _start(self):
+        self._process=sp.Popen(
+            [sys.executable,str(Path(__file__).absolute()),str(self.project_file)],
+            stdin=sp.PIPE,stdout=sp.PIPE,
+            text=True,
+        )
+        self._num_batches=0
+
+        try:
+            response=self._receive(timeout_s=CP_ENGINE_STARTUP_TIMEOUT_S)
+            if not response.get("ready"):
+                raise CellProfilerEngineError(f"engine failed to start: {response.get('error')}")
+        except BaseException:
+            # do not keep a half started process around (e.g. after a startup timeout)
+            self._kill()
+            raise
+        self._baseline_rss_bytes=_rssBytes(self._process.pid)
+
+    def _kill(self):
+        process=self._process
+        self._process=None
+        if process is not None and process.poll() is None:
+            process.kill()
+            process.wait()
+
+    def _stop(self):
+        process=self._process
+        self._process=None
+        if process is None:
+            return
+
+        if process.poll() is None:
+            try:
+                self._send({"cmd":"exit"},process)
+                process.wait(timeout=30)
+            except (OSError,sp.TimeoutExpired):
+                process.kill()
+                process.wait()
+
+    def _send(self,request:dict,process:tp.Optional[sp.Popen]=None):
+        process=process or self._process
+        assert process is not None and process.stdin is not None
+        process.stdin.write(json.dumps(request)+"\n")
+        process.stdin.flush()
+
+    def _receive(self,timeout_s:tp.Optional[float]=None)->dict:
+        """ read the next response, raises CellProfilerEngineError if the process exited or did not respond in time """
+        assert self._process is not None and self._process.stdout is not None
+        if timeout_s is not None:
+            readable,_,_=select.select([self._process.stdout],[],[],timeout_s)
+            if len(readable)==0:
+                raise CellProfilerEngineError(f"engine did not respond within {timeout_s}s")
+
+        line=self._process.stdout.readline()
+        if line=="":
+            returncode=self._process.wait()
+            raise CellProfilerEngineError(f"engine exited with code {returncode}")
+        return json.loads(line)
+
+    def healthy(self)->bool:
+        """ check that the engine process is running and responds """
+        if self._process is None or self._process.poll() is not None:
+            return False
+        try:
+            self._send({"cmd":"ping"})
+            return self._receive(timeout_s=CP_ENGINE_PING_TIMEOUT_S).get("pong",False)
+        except (OSError,CellProfilerEngineError):
+            return False
+
+    def _needsRecycling(self)->bool:
+        if self._num_batches>=self.max_batches:
+            return True
+        if self._process is not None and self._baseline_rss_bytes is not None:
+            rss_bytes=_rssBytes(self._process.pid)
+            if rss_bytes is not None and rss_bytes-self._baseline_rss_bytes>self.max_rss_growth_bytes:
+                return True
+        return False
+
+    def run(self,
+        file_list:tp.Union[str,Path],
+        image_directory:tp.Union[str,Path],
+        output_directory:tp.Union[str,Path],
+    )->int:
+        """
+            run the pipeline on the images in file_list (one path per line)
+
+            (re)starts the engine process if it is not running, not healthy, or due to be recycled.
+
+            :returns: exit code like the cellprofiler command line: 0 on success, OOM_EXIT_CODE if the
+                engine process was killed (most likely by the OOM killer), 1 if the pipeline failed,
+                STARTUP_FAILED_EXIT_CODE if the engine process could not be started
+        """
+        if self._process is not None and (self._needsRecycling() or not self.healthy()):
+            self._stop()
+        if self._process is None:
+            try:
+                self._start()
+            except (OSError,ValueError,CellProfilerEngineError) as e:
+                print(f"cellprofiler engine error - {e}")
+                return STARTUP_FAILED_EXIT_CODE
+        assert self._process is not None
+
+        self._send({
+            "cmd":"run",
+            "file_list":str(Path(file_list).absolute()),
+            "image_directory":str(Path(image_directory).absolute()),
+            "output_directory":str(Path(output_directory).absolute()),
+        })
+        self._num_batches+=1
+
+        try:
+            response=self._receive()
+        except CellProfilerEngineError as e:
+            returncode=self._process.poll()
+            self._stop()
+            print(f"cellprofiler engine error - {e}")
+            if returncode is not None and returncode<0:
+                # killed by a signal, i.e. SIGKILL from the OOM killer
+                return OOM_EXIT_CODE
+            return returncode or 1
+
+        if not response.get("ok"):
+            print(f"cellprofiler engine error - {response.get('error')}")
+            return 1
+        return 0
+
+    def close(self):
+        self._stop()
+
+def _serve(project_file:str):
+    # the protocol uses the original stdout, everything printed by cellprofiler (or java) goes to stderr
+    protocol_out=os.fdopen(os.dup(sys.stdout.fileno()),"w")
+    os.dup2(sys.stderr.fileno(),sys.stdout.fileno())
+
+    def respond(response:dict):
+        protocol_out.write(json.dumps(response)+"\n")
+        protocol_out.flush()
+
+    try:
+        import cellprofiler_core.preferences as cpprefs
+        cpprefs.set_headless()
+        cpprefs.set_conserve_memory(True)
+
+        import cellprofiler_core.utilities.java as cpjava
+        from cellprofiler_core.pipeline import Pipeline
+
+        cpjava.start_java()
+
+        pipeline=Pipeline()
+        pipeline.load(project_file)
+    except Exception:
+        respond({"ready":False,"error":traceback.format_exc()})
+        return
+
+    respond({"ready":True})
+
+    try:
+        for line in sys.stdin:
+            request=json.loads(line)
+            cmd=request["cmd"]
+            if cmd=="ping":
+                respond({"pong":True})
+            elif cmd=="exit":
+                break
+            elif cmd=="run":
+                start_time=time.time()
+                try:
+                    cpprefs.set_default_image_directory(request["image_directory"])
+                    cpprefs.set_default_output_directory(request["output_directory"])
+
+                    # the loaded pipeline is not modified, each batch gets its own file list
+                    batch_pipeline=pipeline.copy()
+                    batch_pipeline.read_file_list(request["file_list"])
+                    batch_pipeline.run()
+                except Exception:
+                    respond({"ok":False,"error":traceback.format_exc()})
+                else:
+                    respond({"ok":True,"duration_s":time.time()-start_time})
+            else:
+                respond({"ok":False,"error":f"unknown command {cmd}"})
+    finally:
+        cpjava.stop_java()
+
+if __name__=="__main__":
+    _serve(sys.argv[1])
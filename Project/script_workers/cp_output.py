@@ -0,0 +1,134 @@
+"""
+    conversion of cellprofiler output tables (csv) to parquet, and reading the wells and sites they cover
+
+    the conversion streams the csv file block by block, so its memory use does not depend on the file size.
+"""
+
+import os, re, typing as tp
+from pathlib import Path
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+MAP_PARQUET_ROW_GROUP_ROWS=int(os.getenv("MAP_PARQUET_ROW_GROUP_ROWS") or 65536)
+""" number of rows per row group in the parquet files written by cp_map (bounds the memory used during conversion) """
+MAP_PARQUET_COMPRESSION=os.getenv("MAP_PARQUET_COMPRESSION") or "zstd"
+MAP_PARQUET_FLOAT32=(os.getenv("MAP_PARQUET_FLOAT32") or "1")=="1"
+""" store floating point columns as float32 instead of float64 """
+CSV_BLOCK_SIZE_BYTES=16*1024*1024
+
+def _convert_csv_to_parquet(file_csv:Path,file_parquet:Path,widen_types:bool,string_columns:tp.Set[str]):
+    read_options=pa_csv.ReadOptions(block_size=CSV_BLOCK_SIZE_BYTES)
+
+    # infer column types once, from the first block
+    with pa_csv.open_csv(file_csv,read_options=read_options) as schema_reader:
+        first_block_schema=schema_reader.schema
+
+    column_types:tp.Dict[str,pa.DataType]={}
+    for field in first_block_schema:
+        if field.name in string_columns:
+            column_types[field.name]=pa.string()
+        elif widen_types and (pa.types.is_integer(field.type) or pa.types.is_null(field.type)):
+            column_types[field.name]=pa.float64()
+    convert_options=pa_csv.ConvertOptions(column_types=column_types)
+
+    with pa_csv.open_csv(file_csv,read_options=read_options,convert_options=convert_options) as reader:
+        file_schema=pa.schema([
+            field.with_type(pa.float32()) if MAP_PARQUET_FLOAT32 and pa.types.is_floating(field.type) else field
+            for field
+            in reader.schema
+        ])
+
+        with pq.ParquetWriter(file_parquet,file_schema,compression=MAP_PARQUET_COMPRESSION) as writer:
+            # collect blocks until they fill a row group, then write exactly one row group per MAP_PARQUET_ROW_GROUP_ROWS rows
+            pending:tp.List[pa.Table]=[]
+            num_pending_rows=0
+            for batch in reader:
+                pending.append(pa.Table.from_batches([batch]).cast(file_schema))
+                num_pending_rows+=batch.num_rows
+                if num_pending_rows>=MAP_PARQUET_ROW_GROUP_ROWS:
+                    pending_table=pa.concat_tables(pending)
+                    while pending_table.num_rows>=MAP_PARQUET_ROW_GROUP_ROWS:
+                        writer.write_table(pending_table.slice(0,MAP_PARQUET_ROW_GROUP_ROWS),row_group_size=MAP_PARQUET_ROW_GROUP_ROWS)
+                        pending_table=pending_table.slice(MAP_PARQUET_ROW_GROUP_ROWS)
+                    # the remainder starts the next row group
+                    pending=[pending_table]
+                    num_pending_rows=pending_table.num_rows
+            if num_pending_rows>0:
+                writer.write_table(pa.concat_tables(pending),row_group_size=MAP_PARQUET_ROW_GROUP_ROWS)
+
+def _failed_csv_column(error:pa.ArrowInvalid,file_csv:Path)->tp.Optional[str]:
+    """ get the name of the column that a csv conversion error refers to, e.g. 'In CSV column #3: ...' """
+    match=re.match(r"In CSV column #(\d+)",str(error))
+    if match is None:
+        return None
+    with pa_csv.open_csv(file_csv,read_options=pa_csv.ReadOptions(block_size=CSV_BLOCK_SIZE_BYTES)) as reader:
+        column_names=reader.schema.names
+    column_index=int(match.group(1))
+    if column_index>=len(column_names):
+        return None
+    return column_names[column_index]
+
+def convert_csv_to_parquet(file_csv:Path,file_parquet:Path):
+    """
+        convert a csv file to a compressed parquet file, block by block (memory use does not depend on the file size)
+
+        column types are inferred from the first block. if a later block does not fit them (e.g. an integer
+        column contains a fraction further down), the conversion is repeated with all integer and empty
+        columns read as floating point. columns that do not fit that either (e.g. text further down) are
+        then read as strings, one failing column per repetition.
+    """
+    widen_types=False
+    string_columns:tp.Set[str]=set()
+    while True:
+        try:
+            _convert_csv_to_parquet(file_csv,file_parquet,widen_types=widen_types,string_columns=string_columns)
+            return
+        except pa.ArrowInvalid as e:
+            print(f"warning - converting {file_csv} to parquet with {'widened' if widen_types else 'inferred'} column types (string columns: {sorted(string_columns)}) failed: {e}")
+            if not widen_types:
+                widen_types=True
+                continue
+
+            failed_column=_failed_csv_column(e,file_csv)
+            if failed_column is None or failed_column in string_columns:
+                raise
+            string_columns.add(failed_column)
+
+def extract_well_sites(file_parquet:Path)->tp.Optional[pd.DataFrame]:
+    """
+        get the unique (well, site) pairs covered by a cellprofiler output table
+
+        uses the Metadata_Well and Metadata_Site columns if the table has them, otherwise parses
+        FileName_nucleus (<well>_s<site>_<rest>). only the required columns are read.
+
+        :returns: dataframe with columns well (str) and site (int), or None if the table has neither
+    """
+    column_names=pq.read_schema(file_parquet).names
+
+    if "Metadata_Well" in column_names and "Metadata_Site" in column_names:
+        metadata=pd.read_parquet(file_parquet,columns=["Metadata_Well","Metadata_Site"]).drop_duplicates()
+        sites=metadata["Metadata_Site"]
+        if not pd.api.types.is_numeric_dtype(sites):
+            # e.g. 's3'
+            sites=pd.to_numeric(sites.astype(str).str.lstrip("s"))
+        # the column may have been widened to floating point during the parquet conversion
+        return pd.DataFrame({
+            "well":metadata["Metadata_Well"].astype(str),
+            "site":sites.astype(int),
+        }).drop_duplicates()
+
+    target_colname="FileName_nucleus"
+    if target_colname in column_names:
+        filenames=pd.read_parquet(file_parquet,columns=[target_colname])[target_colname].drop_duplicates()
+        well_site=filenames.str.extract(r"^([^_]+)_s(\d+)_")
+        unparsed=filenames[well_site.isna().any(axis=1)]
+        if len(unparsed)>0:
+            raise ValueError(f"cannot get well and site from {target_colname} {unparsed.iloc[0]!r}")
+        return pd.DataFrame({
+            "well":well_site[0],
+            "site":well_site[1].astype(int),
+        }).drop_duplicates()
+
+    return None
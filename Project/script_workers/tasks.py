@@ -1,20 +1,29 @@
 from celery import Celery
+from celery.signals import task_postrun, task_received, worker_process_shutdown
 import traceback as tb
-import os, io, signal, sys
+import os, io, signal, sys, time, shutil, tempfile, asyncio, fcntl
 import subprocess as sp
 import typing as tp
 from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import polars as pl
+import pyarrow as pa
 pd.set_option('display.width', None)
 pd.set_option('display.max_columns', None)
 pd.set_option('display.max_colwidth', None)
 
-from dbi import DB, BUCKET_NAME, S3Client, WellSite, ObjectStorageFileReference, Result_cp_map
+from dbi import DB, BUCKET_NAME, S3Client, AsyncS3Client, WellSite, ObjectStorageFileReference, Result_cp_map, StageTiming, TRANSFER_DEFAULT, STORAGE_METRICS, metricsTag, InputStaging
 
 from cell_profile import PlateMetadata, print_time
 
+from cellprofiler_engine import CellProfilerEngine, OOM_EXIT_CODE
+from cp_output import convert_csv_to_parquet, extract_well_sites
+
 s3client=S3Client()
+async_s3client=AsyncS3Client(s3client)
+input_staging=InputStaging.fromEnvironment(s3client)
 mydb=DB(recreate=False)
 
 tasks = Celery('tasks', broker=os.getenv('APP_BROKER_URI'), broker_pool_limit = 0, broker_connection_retry_on_startup = True)
@@ -22,7 +31,256 @@ tasks = Celery('tasks', broker=os.getenv('APP_BROKER_URI'), broker_pool_limit =
 rpc = Celery('tasks', backend="rpc://", broker=os.getenv('APP_BROKER_URI'), broker_pool_limit = 0, broker_connection_retry_on_startup = True)
 #rpc.conf.broker_connection_retry_on_startup = True
 
+S3_METRICS_FILE=os.getenv("S3_METRICS_FILE")
+"""
+    if set, the object storage metrics of each worker process are written after every task (prometheus text format),
+    to <S3_METRICS_FILE without suffix>.<pid>.prom, with a pid label on every series (e.g. for the node exporter textfile collector)
+"""
+
+def _process_exists(pid:int)->bool:
+    try:
+        os.kill(pid,0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # process exists, but belongs to another user
+        pass
+    return True
+
+def _storage_metrics_file(pid:int)->Path:
+    assert S3_METRICS_FILE is not None
+    metrics_file=Path(S3_METRICS_FILE)
+    return metrics_file.with_name(f"{metrics_file.stem}.{pid}.prom")
+
+@task_postrun.connect
+def write_storage_metrics(**kwargs):
+    if S3_METRICS_FILE is None:
+        return
+
+    # each (pool) process has its own counters, so each writes its own file
+    metrics_file=_storage_metrics_file(os.getpid())
+    metrics_file.parent.mkdir(parents=True,exist_ok=True)
+
+    # write atomically, so that a scraper never reads a partial file
+    tmp_file=metrics_file.with_name(f".{metrics_file.name}")
+    tmp_file.write_text(STORAGE_METRICS.renderText(extra_labels={"pid":str(os.getpid())}))
+    os.replace(tmp_file,metrics_file)
+
+    # remove the files of processes that were killed (e.g. by the OOM killer) instead of shutting down
+    for path in metrics_file.parent.glob(f"{Path(S3_METRICS_FILE).stem}.*.prom"):
+        try:
+            pid=int(path.name.rsplit(".",2)[1])
+        except ValueError:
+            continue
+        if not _process_exists(pid):
+            path.unlink(missing_ok=True)
+
+@worker_process_shutdown.connect
+def remove_storage_metrics_file(**kwargs):
+    if S3_METRICS_FILE is None:
+        return
+    _storage_metrics_file(os.getpid()).unlink(missing_ok=True)
+
+CELLPROFILER_ENGINE=(os.getenv("CELLPROFILER_ENGINE") or "1")=="1"
+""" run batches in a long-lived cellprofiler process (see CellProfilerEngine), instead of starting cellprofiler for every batch """
+
+cellprofiler_engine:tp.Optional[CellProfilerEngine]=None
+""" started on first use in each worker (pool) process """
+
+CELLPROFILER_PROJECT_FILE="cellprofilerinput/morphology_pipeline.cpproj"
+
+def run_cellprofiler(file_list:Path,image_directory:Path,output_directory:Path)->int:
+    """ run cellprofiler on the images listed in file_list, returns the exit code """
+    global cellprofiler_engine
+
+    if not CELLPROFILER_ENGINE:
+        return sp.run([
+            "venv/bin/python3","-m","cellprofiler","--run-headless","--run",
+            f"--project={CELLPROFILER_PROJECT_FILE}",
+            f"--file-list={file_list}",
+            f"--image-directory={image_directory}/",
+            f"--output-directory={output_directory}/",
+            "--conserve-memory","True",
+        ]).returncode
+
+    if cellprofiler_engine is None:
+        cellprofiler_engine=CellProfilerEngine(CELLPROFILER_PROJECT_FILE)
+    return cellprofiler_engine.run(
+        file_list=file_list,
+        image_directory=image_directory,
+        output_directory=output_directory,
+    )
+
+@worker_process_shutdown.connect
+def stop_cellprofiler_engine(**kwargs):
+    if cellprofiler_engine is not None:
+        cellprofiler_engine.close()
+
+MAP_SCRATCH_DIR=os.getenv("MAP_SCRATCH_DIR") or tempfile.gettempdir()
+""" directory in which each cp_map task creates its own scratch directory (for images and cellprofiler output) """
+MAP_SCRATCH_TMPFS_DIR=os.getenv("MAP_SCRATCH_TMPFS_DIR") or "/dev/shm"
+""" tmpfs mount that is used instead of MAP_SCRATCH_DIR while enough of it is free """
+MAP_SCRATCH_TMPFS_MIN_FREE_MB=float(os.getenv("MAP_SCRATCH_TMPFS_MIN_FREE_MB") or 512)
+""" tmpfs space that is kept free in addition to the space reserved by running tasks (files on tmpfs count against the memory limit of the container) """
+MAP_SCRATCH_BYTES_PER_INPUT_BYTE=float(os.getenv("MAP_SCRATCH_BYTES_PER_INPUT_BYTE") or 3)
+""" estimated scratch space of a cp_map task per byte of its input images (images, cellprofiler output tables, their parquet conversion) """
+SCRATCH_DIR_PREFIX="cp_map-"
+SCRATCH_RESERVATION_FILENAME=".reserved_bytes"
+""" file in a scratch directory on tmpfs that contains the number of bytes reserved for it """
+SCRATCH_LOCK_FILENAME=".cp_map-scratch.lock"
+
+def _remove_orphaned_scratch_dirs(parent_dir:Path):
+    """ remove scratch directories of processes that no longer exist (e.g. killed by the OOM killer) """
+    for path in parent_dir.glob(f"{SCRATCH_DIR_PREFIX}*"):
+        try:
+            pid=int(path.name[len(SCRATCH_DIR_PREFIX):].split("-",1)[0])
+        except ValueError:
+            continue
+        if not _process_exists(pid):
+            shutil.rmtree(path,ignore_errors=True)
+
+def _outstanding_reserved_bytes(parent_dir:Path)->int:
+    """ space reserved by the scratch directories in parent_dir that they do not use yet """
+    outstanding_bytes=0
+    for path in parent_dir.glob(f"{SCRATCH_DIR_PREFIX}*"):
+        try:
+            reserved_bytes=int((path/SCRATCH_RESERVATION_FILENAME).read_text())
+        except (FileNotFoundError,ValueError):
+            continue
+        used_bytes=0
+        for dirpath,_dirnames,filenames in os.walk(path):
+            for filename in filenames:
+                try:
+                    used_bytes+=os.stat(os.path.join(dirpath,filename)).st_size
+                except FileNotFoundError:
+                    pass
+        outstanding_bytes+=max(0,reserved_bytes-used_bytes)
+    return outstanding_bytes
+
+def create_scratch_dir(imageBatchID:int,input_bytes:tp.Optional[int]=None)->Path:
+    """
+        create an empty scratch directory for a single cp_map task, so that several tasks can run in the same container
+
+        the directory is created on tmpfs if the space the task is estimated to need (MAP_SCRATCH_BYTES_PER_INPUT_BYTE
+        times input_bytes) is free there, after the space reserved by the other tasks on tmpfs, and keeping
+        MAP_SCRATCH_TMPFS_MIN_FREE_MB free. the space is then reserved for this task until its directory is removed.
+        otherwise (or if input_bytes is not known), the directory is created in MAP_SCRATCH_DIR.
+        the caller must remove it (shutil.rmtree) when the task is done.
+
+        :param input_bytes: total size of the input images of the task
+    """
+    prefix=f"{SCRATCH_DIR_PREFIX}{os.getpid()}-{imageBatchID}-"
+
+    tmpfs_dir=Path(MAP_SCRATCH_TMPFS_DIR)
+    if input_bytes is not None and tmpfs_dir.is_dir():
+        required_bytes=int(input_bytes*MAP_SCRATCH_BYTES_PER_INPUT_BYTE)
+        try:
+            # checking the free space and reserving it must not interleave with other tasks
+            with open(tmpfs_dir/SCRATCH_LOCK_FILENAME,"a") as lock_file:
+                fcntl.flock(lock_file,fcntl.LOCK_EX)
+                _remove_orphaned_scratch_dirs(tmpfs_dir)
+
+                available_bytes=shutil.disk_usage(tmpfs_dir).free-_outstanding_reserved_bytes(tmpfs_dir)
+                if available_bytes-required_bytes>=MAP_SCRATCH_TMPFS_MIN_FREE_MB*1024*1024:
+                    scratch_dir=Path(tempfile.mkdtemp(prefix=prefix,dir=tmpfs_dir))
+                    (scratch_dir/SCRATCH_RESERVATION_FILENAME).write_text(str(required_bytes))
+                    return scratch_dir
+        except OSError as e:
+            print(f"warning - cannot use {tmpfs_dir} for scratch files: {e!r}")
+
+    parent_dir=Path(MAP_SCRATCH_DIR)
+    parent_dir.mkdir(parents=True,exist_ok=True)
+    _remove_orphaned_scratch_dirs(parent_dir)
+
+    return Path(tempfile.mkdtemp(prefix=prefix,dir=parent_dir))
+
+MAP_DOWNLOAD_CONCURRENCY=int(os.getenv("MAP_DOWNLOAD_CONCURRENCY") or 8)
+""" number of images of a batch that cp_map downloads at the same time """
+MAP_DOWNLOAD_ATTEMPTS=int(os.getenv("MAP_DOWNLOAD_ATTEMPTS") or 3)
+""" number of times cp_map tries to download each image before giving up """
+
+def download_map_inputs(objects:tp.List[tp.Tuple[str,str,Path]]):
+    """
+        download all images of a batch concurrently (or take them from the staging area, if they were prefetched)
+
+        if some downloads fail, only those are retried (with backoff), up to MAP_DOWNLOAD_ATTEMPTS times.
+
+        :param objects: (bucket, object name, local filename) for each image
+        :raises RuntimeError: if any image could not be downloaded
+    """
+    def fetch(bucket:str,object_name:str,local_filename:Path):
+        if input_staging is not None:
+            if input_staging.take(bucket,object_name,local_filename):
+                return
+            # not staged (yet), so a copy that is prefetched later would never be taken
+            input_staging.discard(bucket,object_name)
+        s3client.downloadFile(
+            object_name=object_name,
+            local_filename=str(local_filename),
+            bucket_override=bucket,
+            # the parallelism comes from downloading many images at the same time, not from ranged requests per image
+            transfer=TRANSFER_DEFAULT,
+        )
+
+    pending=list(objects)
+    failures:tp.Dict[tp.Tuple[str,str,Path],BaseException]={}
+    with ThreadPoolExecutor(max_workers=MAP_DOWNLOAD_CONCURRENCY,thread_name_prefix="cpmapdownload") as executor:
+        for attempt in range(MAP_DOWNLOAD_ATTEMPTS):
+            if attempt>0:
+                print(f"warning - retrying {len(pending)} failed image download(s), attempt {attempt+1}/{MAP_DOWNLOAD_ATTEMPTS}")
+                time.sleep(0.5*2**(attempt-1))
+
+            futures=[(obj,executor.submit(fetch,*obj)) for obj in pending]
+            failures={}
+            for obj,future in futures:
+                e=future.exception()
+                if e is not None:
+                    failures[obj]=e
+
+            if len(failures)==0:
+                return
+            pending=list(failures.keys())
+
+    failure_list="\n".join(f"  {bucket}/{object_name}: {e!r}" for (bucket,object_name,_local_filename),e in failures.items())
+    raise RuntimeError(f"{len(failures)} image download(s) failed:\n{failure_list}")
+
+@task_received.connect
+def prefetch_map_inputs(request=None,**kwargs):
+    """
+        start downloading the images of a cp_map task into the staging area as soon as the worker reserves it,
+        i.e. usually while the previous task is still running cellprofiler (runs in the main worker process)
+    """
+    if input_staging is None or request is None or request.name!="cp_map":
+        return
+
+    filelist=request.kwargs.get("filelist")
+    if filelist is None and len(request.args)>0:
+        filelist=request.args[0]
+    if filelist is None:
+        return
+
+    objects:tp.List[tp.Tuple[str,str]]=[]
+    for file in filelist:
+        s3bucketname,s3path=ObjectStorageFileReference(**file).s3path.split("/",1)
+        objects.append((s3bucketname,s3path))
+    input_staging.prefetch(objects)
+
+@contextmanager
+def timed_stage(timings:tp.Dict[str,StageTiming],stage:str):
+    """ add the time spent in the with-block to the duration of stage in timings (which may be entered several times) """
+    start_time=time.perf_counter()
+    try:
+        yield
+    finally:
+        timing=timings.setdefault(stage,StageTiming(stage=stage,duration_s=0.0))
+        timing.duration_s+=time.perf_counter()-start_time
+
+def add_stage_bytes(timings:tp.Dict[str,StageTiming],stage:str,num_bytes:int):
+    timing=timings.setdefault(stage,StageTiming(stage=stage,duration_s=0.0))
+    timing.num_bytes=(timing.num_bytes or 0)+num_bytes
+
 @tasks.task(name="cp_map",queue="map_queue")
+@metricsTag("cp_map")
 def cp_map(
     filelist:tp.List[tp.Union["ObjectStorageFileReference",dict]],
     project_name:str,
@@ -30,15 +288,26 @@ def cp_map(
     plate_name:str,
     imageBatchID:int,
     retry_attempt:int=0,
+    image_set_sizes:tp.Optional[tp.List[int]]=None,
+    input_bytes:tp.Optional[int]=None,
 ):
     """
         run cellprofiler on a batch of images
 
+        if cellprofiler runs out of memory, the batch is split in half (by image set) and both halves are
+        queued as new batches. a batch with a single image set that runs out of memory fails permanently.
+
         Args:
             filelist (tp.List['{filename:str,s3path:str}']): list of image files to process (objects of custom class are difficult to send over the network, so we use a small dictionary instead)
             project_name (str): project name
             plate_name (str): plate name
             imageBatchID (int): image batch id. This is used to identify the batch of images to process, result files are stored in the object storage with a key made from projectname+platename+batchid. a batch may contain any number of image sets
+            retry_attempt (int): number of times the images of this batch have been split after running out of memory
+            image_set_sizes (tp.List[int]): number of consecutive files in filelist that belong to each image set (default: all files form a single image set)
+            input_bytes (int): total size of the files in filelist, used to reserve scratch space on tmpfs (see create_scratch_dir, default: unknown, scratch files are not put on tmpfs)
+
+        the time spent in each stage (download, cellprofiler, convert, upload, register) is stored with the batch,
+        see DB.getStageTimingStatistics
 
     """
 
@@ -51,6 +320,8 @@ def cp_map(
 
     experimentid=mydb.getExperimentID(project_name,experiment_name)
 
+    stage_timings:tp.Dict[str,StageTiming]={}
+
     # Save the original signal handler
     original_handler = signal.getsignal(signal.SIGTERM)
 
@@ -59,13 +330,7 @@ def cp_map(
         print(f"warning - SIGTERM received during the processing of batch {imageBatchID}.")
 
         # update database entry for processing batch with status=terminated, and end_time
-        mydb.dbExec(f"""
-            UPDATE profile_results
-            SET end_time=CURRENT_TIMESTAMP,
-                status='terminated'
-            WHERE experimentid={experimentid}
-            AND batchid={imageBatchID};
-        """)
+        mydb.setBatchStatus(experimentid,imageBatchID,"terminated",set_end_time=True)
 
         # Call the original handler after custom handling, pass the signal and frame
         if callable(original_handler):
@@ -77,119 +342,158 @@ def cp_map(
     # Set the new signal handler
     signal.signal(signal.SIGTERM, shutdown_gracefully)
 
+    # all files of this task are created in its own directory, which is removed when the task ends (in any way)
+    scratch_dir=create_scratch_dir(imageBatchID,input_bytes=input_bytes)
+    input_dir=scratch_dir/"input"
+    output_dir=scratch_dir/"output"
+    input_dir.mkdir()
+    output_dir.mkdir()
+
     try:
         # download files to prepare for cellprofiler ingestion
-        cellprofilerInputFileListFilePath=Path("./cellprofilerinput/imagefilelist.txt")
+        cellprofilerInputFileListFilePath=input_dir/"imagefilelist.txt"
         local_files:tp.List[Path]=[]
-        with cellprofilerInputFileListFilePath.open("w+") as f:
-            for file in filelist:
-                assert type(file)==dict, f"{type(file)=} {file=}"
-                file=ObjectStorageFileReference(**file)
-
-                filename,s3path=file.filename,file.s3path
-
-                local_image_filename:Path=Path("./cellprofilerinput")/filename
-                s3bucketname, s3path = s3path.split("/",1)
-                # download image from s3
-                s3client.downloadFile(
-                    object_name=s3path, 
-                    local_filename=str(local_image_filename.absolute())
-                )
-                # write local image file path to cellprofiler input file
-                f.write(f"{str(local_image_filename.absolute())}\n")
-                # save image file path for later deletion
-                local_files.append(local_image_filename)
+        download_objects:tp.List[tp.Tuple[str,str,Path]]=[]
+        for file in filelist:
+            assert type(file)==dict, f"{type(file)=} {file=}"
+            file=ObjectStorageFileReference(**file)
+
+            filename,s3path=file.filename,file.s3path
+
+            local_image_filename:Path=input_dir/filename
+            s3bucketname, s3path = s3path.split("/",1)
+            download_objects.append((s3bucketname,s3path,local_image_filename))
+            # save image file path for later deletion
+            local_files.append(local_image_filename)
 
         def deleteLocalFiles():
             """ delete all local files again """
             for local_image_filename in local_files:
-                local_image_filename.unlink()
-            cellprofilerInputFileListFilePath.unlink()
+                local_image_filename.unlink(missing_ok=True)
+            cellprofilerInputFileListFilePath.unlink(missing_ok=True)
+
+        try:
+            with timed_stage(stage_timings,"download"):
+                download_map_inputs(download_objects)
+        except BaseException:
+            deleteLocalFiles()
+            raise
+        local_file_sizes=[local_image_filename.stat().st_size for local_image_filename in local_files]
+        add_stage_bytes(stage_timings,"download",sum(local_file_sizes))
+
+        # write local image file paths to cellprofiler input file (in the order of filelist, regardless of download order)
+        with cellprofilerInputFileListFilePath.open("w+") as f:
+            for local_image_filename in local_files:
+                f.write(f"{str(local_image_filename)}\n")
 
         # update database entry for processing batch with start time and status=processing
-        mydb.dbExec(f"""
-            UPDATE profile_results
-            SET start_time=CURRENT_TIMESTAMP,
-                status='processing images'
-            WHERE experimentid={experimentid}
-            AND batchid={imageBatchID};
-        """)
+        mydb.setBatchStatus(experimentid,imageBatchID,"processing images",set_start_time=True)
 
         # then actually run cellprofiler (and ignore exit code, for now)
-        cellprofiler_shell_command="venv/bin/python3 -m cellprofiler --run-headless --run --project=cellprofilerinput/morphology_pipeline.cpproj --file-list=cellprofilerinput/imagefilelist.txt --image-directory=cellprofilerinput/ --output-directory=cellprofileroutput/ --conserve-memory True"
-        cp_cmd=sp.run(cellprofiler_shell_command,shell=True)
-        if cp_cmd.returncode!=0:
+        with timed_stage(stage_timings,"cellprofiler"):
+            cp_returncode=run_cellprofiler(
+                file_list=cellprofilerInputFileListFilePath,
+                image_directory=input_dir,
+                output_directory=output_dir,
+            )
+        if cp_returncode!=0:
+            # split into image sets, the unit that cannot be split further
+            set_sizes=image_set_sizes if image_set_sizes is not None else [len(filelist)]
+            assert sum(set_sizes)==len(filelist), (set_sizes,len(filelist))
+
             # likely indicates OOM error
-            if cp_cmd.returncode==137:
+            if cp_returncode==OOM_EXIT_CODE and len(set_sizes)>1:
                 error_status=f"failed.OOM({retry_attempt})"
-                print(f"cellprofiler error - {error_status} -- OOM error, retrying for the {retry_attempt}th time")
+                print(f"cellprofiler error - {error_status} -- OOM error, splitting {len(set_sizes)} image sets into two batches")
                 do_attempt_retry=True
+            elif cp_returncode==OOM_EXIT_CODE:
+                error_status=f"failed.OOM({retry_attempt})"
+                print(f"cellprofiler error - {error_status} -- OOM error on a single image set, not retrying")
+                do_attempt_retry=False
             else:
-                error_status=f"failed.{cp_cmd.returncode}"
+                error_status=f"failed.{cp_returncode}"
                 print(f"cellprofiler error - {error_status}")
                 do_attempt_retry=False
 
             # set status of batch to failed.exitcode (for tracking purposes)
             # set end_time to current time (to indicate that this batch is done, regardless of success or failure)
-            mydb.dbExec(f"""
-                UPDATE profile_results
-                SET end_time=CURRENT_TIMESTAMP,
-                    status='{error_status}'
-                WHERE experimentid={experimentid}
-                AND batchid={imageBatchID};
-            """)
+            mydb.setBatchStatus(experimentid,imageBatchID,error_status,set_end_time=True)
+            # keep the timings of failed batches too, e.g. to see how long batches run before running out of memory
+            mydb.insertBatchStageTimings(experimentid,imageBatchID,list(stage_timings.values()))
+
+            if do_attempt_retry and input_staging is not None:
+                # the halves can reuse the images instead of downloading them again (if they run in this container)
+                for s3bucketname,s3path,local_image_filename in download_objects:
+                    if local_image_filename.exists():
+                        input_staging.put(s3bucketname,s3path,local_image_filename)
 
             deleteLocalFiles()
 
             if do_attempt_retry:
-                # generate new batch id (do not overwrite existing batch id, which contains error information in its status)
-                new_batch_id=mydb.getProcessingBatchID(project_name,experiment_name)
-                # retry with new batch id
-                return cp_map(
-                    filelist=filelist,
-                    project_name=project_name,
-                    experiment_name=experiment_name,
-                    plate_name=plate_name,
-                    imageBatchID=new_batch_id,
-                    retry_attempt=retry_attempt+1
-                )
+                num_first_half_sets=len(set_sizes)//2
+                num_first_half_files=sum(set_sizes[:num_first_half_sets])
+                halves=[
+                    (filelist[:num_first_half_files],set_sizes[:num_first_half_sets],sum(local_file_sizes[:num_first_half_files])),
+                    (filelist[num_first_half_files:],set_sizes[num_first_half_sets:],sum(local_file_sizes[num_first_half_files:])),
+                ]
+
+                # generate new batch ids (do not overwrite existing batch id, which contains error information in its status)
+                new_batch_ids=mydb.reserveProcessingBatchIDs(project_name,experiment_name,len(halves))
+                # queue the halves instead of running them here, so that they can run on other workers
+                for new_batch_id,(half_filelist,half_set_sizes,half_input_bytes) in zip(new_batch_ids,halves):
+                    cp_map.apply_async(
+                        kwargs=dict(
+                            filelist=half_filelist,
+                            project_name=project_name,
+                            experiment_name=experiment_name,
+                            plate_name=plate_name,
+                            imageBatchID=new_batch_id,
+                            retry_attempt=retry_attempt+1,
+                            image_set_sizes=half_set_sizes,
+                            input_bytes=half_input_bytes,
+                        ),
+                        queue="map_queue",
+                    )
+                return
             else:
-                raise ValueError(f"cellprofiler command failed with exit code {cp_cmd.returncode}")
+                raise ValueError(f"cellprofiler command failed with exit code {cp_returncode}")
 
         deleteLocalFiles()
 
         # update database entry for processing batch with status=uploading
-        mydb.dbExec(f"""
-            UPDATE profile_results
-            SET status='uploading results to storage'
-            WHERE experimentid={experimentid}
-            AND batchid={imageBatchID};
-        """)
+        mydb.setBatchStatus(experimentid,imageBatchID,"uploading results to storage")
 
         # output files are the following
         outputFilepaths=[
-            "cellprofileroutput/Experiment.csv",
-            "cellprofileroutput/Image.csv",
-            "cellprofileroutput/cytoplasm.csv",
-            "cellprofileroutput/nucleus.csv",
+            output_dir/"Experiment.csv",
+            output_dir/"Image.csv",
+            output_dir/"cytoplasm.csv",
+            output_dir/"nucleus.csv",
         ]
 
         ret_filepaths:tp.List[ObjectStorageFileReference]=[]
-        well_site_list:tp.List[WellSite]=[]
+        well_sites:tp.List[pd.DataFrame]=[]
         for file in outputFilepaths:
             file_csv=Path(file)
             assert file_csv.exists(), str(file_csv)
 
-            # convert file to parquet using pandas before upload
-            df=pd.read_csv(file_csv)
+            # convert file to parquet before upload
             file_parquet=file_csv.with_suffix(".parquet")
-            df.to_parquet(file_parquet)
+            with timed_stage(stage_timings,"convert"):
+                convert_csv_to_parquet(file_csv,file_parquet)
+
+                file_well_sites=extract_well_sites(file_parquet)
+                if file_well_sites is not None:
+                    well_sites.append(file_well_sites)
+            add_stage_bytes(stage_timings,"convert",file_csv.stat().st_size)
 
             s3Filename = f"{project_name}/{plate_name}/{imageBatchID}/{file_parquet.name}"
-            s3client.uploadFile(
-                file=str(file_parquet),
-                object_name=s3Filename
-            )
+            with timed_stage(stage_timings,"upload"):
+                s3client.uploadFile(
+                    file=str(file_parquet),
+                    object_name=s3Filename
+                )
+            add_stage_bytes(stage_timings,"upload",file_parquet.stat().st_size)
 
             # delete both local files
             file_csv.unlink()
@@ -200,14 +504,15 @@ def cp_map(
                 s3path=s3Filename,
             ))
 
-            target_colname="FileName_nucleus"
-            if target_colname in df.columns:
-                # go through each row in target column, split by underscore, first segment is well, second is site, rest is ignored
-                for row in df[target_colname]:
-                    # TODO this should be handled better! just splitting is not very stable
-                    well,site,_ignore=row.split("_",2)
-                    site=int(site[1:]) # strip leading 's', and ensure the rest is an integer
-                    well_site_list.append(WellSite(well=well,site=site))
+        # one entry per (well, site), regardless of how many tables and rows mention it
+        well_site_list:tp.List[WellSite]=[]
+        if len(well_sites)>0:
+            unique_well_sites=pd.concat(well_sites,ignore_index=True).drop_duplicates()
+            well_site_list=[
+                WellSite(well=well,site=int(site))
+                for well,site
+                in unique_well_sites.itertuples(index=False)
+            ]
 
         res=Result_cp_map(
             resultfiles=ret_filepaths,
@@ -216,27 +521,26 @@ def cp_map(
 
         # write result file information back to db
 
-        mydb.insertProfileResultBatch(
-            project_name,
-            experiment_name=experiment_name,
-            batchid=imageBatchID,
-            result_file_paths=res.resultfiles,
-            well_site_list=res.wells,
-        )
+        with timed_stage(stage_timings,"register"):
+            mydb.insertProfileResultBatch(
+                project_name,
+                experiment_name=experiment_name,
+                batchid=imageBatchID,
+                result_file_paths=res.resultfiles,
+                well_site_list=res.wells,
+            )
+        mydb.insertBatchStageTimings(experimentid,imageBatchID,list(stage_timings.values()))
 
         # update database entry for processing batch with end time and status=done
-        mydb.dbExec(f"""
-            UPDATE profile_results
-            SET end_time=CURRENT_TIMESTAMP,
-                status='done'
-            WHERE experimentid={experimentid}
-            AND batchid={imageBatchID};
-        """)
+        mydb.setBatchStatus(experimentid,imageBatchID,"done",set_end_time=True)
     finally:
+        shutil.rmtree(scratch_dir,ignore_errors=True)
+
         # restore original signal handler
         signal.signal(signal.SIGTERM, original_handler)
 
 @tasks.task(name="cp_reduce",queue="reduce_queue")
+@metricsTag("cp_reduce")
 def cp_reduce(
     project_name:str,
     experiment_name:str,
@@ -262,24 +566,9 @@ def cp_reduce(
     experiment_id=mydb.getExperimentID(project_name,experiment_name)
 
     # get result file locations
-    resultfiles_res=mydb.dbExec(f"""
-        SELECT s3path,filename
-        FROM profile_result_files
-        WHERE profile_resultid IN (
-            SELECT id
-            FROM profile_results
-            WHERE experimentid = {experiment_id}
-        );
-    """)
-    assert type(resultfiles_res)==list
-    if len(resultfiles_res)==0:
+    resultfiles=mydb.getResultFiles(experiment_id)
+    if len(resultfiles)==0:
         return None
-    
-    resultfiles=[
-        ObjectStorageFileReference(s3path=s3path,filename=filename)
-        for s3path,filename
-        in resultfiles_res
-    ]
 
     # group files by filename
     file_list:tp.Dict[str,tp.List[str]]={}
@@ -305,29 +594,30 @@ def cp_reduce(
             raise ValueError(f"unexpected filename {filename}")
 
         filename_suffix=Path(filename).suffix
-        for s3path in s3paths:
-            tempFile=io.BytesIO()
 
-            # get merged frames from s3 as in-memory file
-            s3client.downloadFileObj(
-                object_name=s3path,
-                fileobj=tempFile,
-            )
-            tempFile.seek(0)
+        # get frames of all batches from s3 at the same time, as in-memory files
+        file_contents=asyncio.run(async_s3client.get_many(s3paths))
+
+        file_dataframes:tp.List[pd.DataFrame]=[]
+        for s3path in s3paths:
+            file_buffer=file_contents[s3path]
+            assert file_buffer is not None
 
             # read into dataframe, accounting for csv/parquet
             df=None
             if filename_suffix==".csv":
-                df=pd.read_csv(tempFile)
+                df=pd.read_csv(io.BytesIO(file_buffer))
             elif filename_suffix==".parquet":
-                df=pd.read_parquet(tempFile)
+                # read directly from the download buffer, without copying it
+                df=pd.read_parquet(pa.BufferReader(file_buffer))
             else:
                 raise ValueError(f"unexpected file extension {filename_suffix} in {filename}")
-            
-            if filename in dataframes:
-                dataframes[filename]=pd.concat([dataframes[filename],df])
-            else:
-                dataframes[filename]=df
+
+            file_dataframes.append(df)
+
+        # release the download buffers before concatenating
+        del file_contents, file_buffer
+        dataframes[filename]=pd.concat(file_dataframes)
 
         if False:
             print(f"processing {filename}")
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the worker modules are not installed, they are copied next to each other into the worker images
+sys.path.insert(0,str(Path(__file__).absolute().parents[1]))
@@ -0,0 +1,96 @@
+"""
+    csv to parquet conversion of cellprofiler output tables, including the fallbacks for columns whose
+    type changes after the first block, and reading wells and sites from the converted tables
+"""
+
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import cp_output
+
+NUM_ROWS=3000
+
+@pytest.fixture(autouse=True)
+def small_blocks(monkeypatch):
+    # a few rows per block, so that later blocks can contradict the types inferred from the first one
+    monkeypatch.setattr(cp_output,"CSV_BLOCK_SIZE_BYTES",4096)
+    monkeypatch.setattr(cp_output,"MAP_PARQUET_ROW_GROUP_ROWS",1000)
+    monkeypatch.setattr(cp_output,"MAP_PARQUET_FLOAT32",True)
+
+def write_csv(path:Path,rows:list)->Path:
+    with path.open("w") as f:
+        f.write("ImageNumber,Metadata_Well,Metadata_Site,AreaShape_Area,Texture\n")
+        for row in rows:
+            f.write(",".join(str(value) for value in row)+"\n")
+    return path
+
+def well_site_rows(num_rows:int,area,texture)->list:
+    return [
+        (i,f"B0{i%3+1}",i%4+1,area(i),texture(i))
+        for i
+        in range(num_rows)
+    ]
+
+def test_integer_column_turns_fractional(tmp_path:Path):
+    rows=well_site_rows(NUM_ROWS,area=lambda i:i if i<NUM_ROWS-1 else f"{i}.5",texture=lambda i:f"{i}.25")
+    file_csv=write_csv(tmp_path/"nucleus.csv",rows)
+    file_parquet=tmp_path/"nucleus.parquet"
+
+    cp_output.convert_csv_to_parquet(file_csv,file_parquet)
+
+    parquet_file=pq.ParquetFile(file_parquet)
+    schema=parquet_file.schema_arrow
+    # integer columns are widened to floating point, and stored as float32
+    assert schema.field("AreaShape_Area").type==pa.float32()
+    assert schema.field("Metadata_Site").type==pa.float32()
+    assert [parquet_file.metadata.row_group(i).num_rows for i in range(parquet_file.num_row_groups)]==[1000,1000,1000]
+
+    table=pq.read_table(file_parquet).to_pandas()
+    assert len(table)==NUM_ROWS
+    assert table["AreaShape_Area"].iloc[-1]==pytest.approx(NUM_ROWS-1+0.5)
+
+def test_numeric_column_turns_to_text(tmp_path:Path):
+    rows=well_site_rows(NUM_ROWS,area=lambda i:i,texture=lambda i:f"{i}.25" if i<NUM_ROWS-1 else "bright")
+    file_csv=write_csv(tmp_path/"cytoplasm.csv",rows)
+    file_parquet=tmp_path/"cytoplasm.parquet"
+
+    cp_output.convert_csv_to_parquet(file_csv,file_parquet)
+
+    schema=pq.read_schema(file_parquet)
+    assert schema.field("Texture").type==pa.string()
+    # other columns keep their (widened) numeric types
+    assert schema.field("AreaShape_Area").type==pa.float32()
+
+    table=pq.read_table(file_parquet).to_pandas()
+    assert len(table)==NUM_ROWS
+    assert table["Texture"].iloc[-1]=="bright"
+
+@pytest.mark.parametrize("area",[
+    pytest.param(lambda i:i,id="inferred"),
+    pytest.param(lambda i:i if i<NUM_ROWS-1 else f"{i}.5",id="widened"),
+])
+def test_extract_well_sites_after_conversion(tmp_path:Path,area):
+    rows=well_site_rows(NUM_ROWS,area=area,texture=lambda i:f"{i}.25")
+    file_csv=write_csv(tmp_path/"nucleus.csv",rows)
+    file_parquet=tmp_path/"nucleus.parquet"
+    cp_output.convert_csv_to_parquet(file_csv,file_parquet)
+
+    well_sites=cp_output.extract_well_sites(file_parquet)
+
+    assert well_sites is not None
+    expected={(f"B0{i%3+1}",i%4+1) for i in range(NUM_ROWS)}
+    assert set(well_sites.itertuples(index=False,name=None))==expected
+    assert pd.api.types.is_integer_dtype(well_sites["site"])
+
+def test_extract_well_sites_with_prefixed_sites(tmp_path:Path):
+    file_parquet=tmp_path/"image.parquet"
+    pq.write_table(pa.table({"Metadata_Well":["B02","B02","C03"],"Metadata_Site":["s1","s2","s1"]}),file_parquet)
+
+    well_sites=cp_output.extract_well_sites(file_parquet)
+
+    assert well_sites is not None
+    assert set(well_sites.itertuples(index=False,name=None))=={("B02",1),("B02",2),("C03",1)}
@@ -10,10 +10,11 @@ import io
 from dataclasses import dataclass
 
 from celery.result import AsyncResult
-from dbi import DB, BUCKET_NAME, S3Client, ObjectStorageFileReference, ImageMetadata
+from dbi import DB, BUCKET_NAME, S3Client, ObjectStorageFileReference, ImageMetadata, UploadError, STORAGE_METRICS
+from werkzeug.datastructures import FileStorage
 
 mydb=DB()
-s3client=S3Client()
+s3client=S3Client(metrics_tag="webfrontend")
 
 STATIC_FILE_DIR = './static'
 
@@ -67,6 +68,11 @@ def get_file_mimetype(filename:str)->str:
     }
     return switcher.get(Path(filename).suffix.lower(),"application/octet-stream")
 
+@app.route('/metrics')
+def metrics():
+    """ object storage request metrics of this process, in the prometheus text format """
+    return Response(STORAGE_METRICS.renderText(),mimetype="text/plain; version=0.0.4")
+
 @app.route('/static/<name>')
 def serveStaticFile(name:str)->tp.Tuple[Response,Status]:
     mimetype=get_file_mimetype(name)
@@ -75,14 +81,16 @@ def serveStaticFile(name:str)->tp.Tuple[Response,Status]:
     response.headers["Content-Type"]=mimetype
     return response,Status.OK
 
+DOWNLOAD_CHUNK_SIZE=1024*1024
+
 @app.route('/download/<bucket>/<path:filename>')
 def download_file(bucket:str, filename:str):
     def generate_file():
-        with io.BytesIO() as file_stream:
-            s3client.handle.download_fileobj(Bucket=bucket, Key=filename, Fileobj=file_stream)
-            file_stream.seek(0)  # Go to the beginning of the file-like object
-            while chunk := file_stream.read(4096):  # Read in chunks of 4KB
-                yield chunk
+        # object is read into a single buffer of its exact size, then sent in chunks
+        file_contents=s3client.getBuffer(filename,bucket_override=bucket)
+        for chunk_start in range(0,len(file_contents),DOWNLOAD_CHUNK_SIZE):
+            # wsgi requires bytes
+            yield bytes(file_contents[chunk_start:chunk_start+DOWNLOAD_CHUNK_SIZE])
 
     response = Response(stream_with_context(generate_file()), content_type='application/octet-stream')
     response.headers['Content-Disposition'] = f'attachment; filename={filename}'
@@ -91,11 +99,10 @@ def download_file(bucket:str, filename:str):
 @app.route('/serve/<bucket>/<path:filename>')
 def serve_s3_file(bucket:str, filename:str):
     # download file from s3 and serve it (NOT as download!)
-    file_contents=io.BytesIO()
-    s3client.handle.download_fileobj(Bucket=bucket, Key=filename, Fileobj=file_contents)
-    file_contents.seek(0)
+    file_contents=s3client.getBuffer(filename,bucket_override=bucket)
     mimetype=get_file_mimetype(filename)
-    response=make_response(file_contents.read())
+    # wsgi requires bytes
+    response=make_response(bytes(file_contents))
     response.headers["Content-Type"]=mimetype
     return response,Status.OK
 
@@ -137,6 +144,20 @@ def getExperimentProgress():
     ret:str=progress.model_dump_json(exclude={"resultfiles":True})
     return ret,Status.OK
 
+@app.route("/api/get_experiment_stage_timings",methods=["GET"])
+def getExperimentStageTimings():
+    projectname=request.args.get("projectname",type=str)
+    experimentname=request.args.get("experimentname",type=str)
+    assert projectname is not None
+    assert experimentname is not None
+    stage_timings=mydb.getStageTimingStatistics(
+        project_name=projectname,
+        experiment_name=experimentname
+    )
+    # to_json writes missing values (e.g. bytes of stages without byte counts) as null, not as invalid NaN
+    ret:str=stage_timings.to_json(orient="records")
+    return ret,Status.OK
+
 def cp_reduce(*args,**kwargs)->AsyncResult:
     """
     wrapper for async call to cp_reduce
@@ -166,6 +187,52 @@ def getExperimentResults():
     ]}
     return jsonify(res),Status.OK
 
+MAP_BATCH_MEMORY_BUDGET_MB=float(os.getenv("MAP_BATCH_MEMORY_BUDGET_MB") or 2048)
+""" estimated memory that a single cp_map task may use, image sets are grouped into tasks up to this limit """
+MAP_MEMORY_PER_INPUT_BYTE=float(os.getenv("MAP_MEMORY_PER_INPUT_BYTE") or 8)
+""" estimated cellprofiler memory use per byte of input images (decoded images, intermediate images, objects) """
+MAP_BATCH_MAX_IMAGE_SETS=int(os.getenv("MAP_BATCH_MAX_IMAGE_SETS") or 16)
+""" upper limit of image sets per cp_map task, so that a plate is still spread across all map workers """
+
+def get_file_size(file:FileStorage)->int:
+    """ get size of an uploaded file, without reading it """
+    pos=file.stream.tell()
+    size=file.stream.seek(0,io.SEEK_END)
+    file.stream.seek(pos)
+    return size
+
+def plan_map_batches(
+    imageSets:tp.Dict[str,tp.List[ImageMetadata]],
+    image_sizes:tp.Dict[str,int],
+)->tp.List[tp.List[tp.List[ImageMetadata]]]:
+    """
+        group image sets into cp_map tasks
+
+        consecutive image sets are coalesced into one task while the estimated memory use of the task
+        stays within MAP_BATCH_MEMORY_BUDGET_MB (and it has at most MAP_BATCH_MAX_IMAGE_SETS sets).
+        an image set that exceeds the budget on its own gets a task of its own.
+
+        :param image_sizes: size in bytes of each image, by real filename
+        :returns: list of tasks, each a list of image sets
+    """
+    budget_bytes=MAP_BATCH_MEMORY_BUDGET_MB*1024*1024
+
+    batches:tp.List[tp.List[tp.List[ImageMetadata]]]=[]
+    batch_estimate_bytes=0.0
+    for imageSet in imageSets.values():
+        set_estimate_bytes=MAP_MEMORY_PER_INPUT_BYTE*sum(image_sizes.get(image.real_filename,0) for image in imageSet)
+
+        if len(batches)==0 \
+            or len(batches[-1])>=MAP_BATCH_MAX_IMAGE_SETS \
+            or batch_estimate_bytes+set_estimate_bytes>budget_bytes:
+            batches.append([])
+            batch_estimate_bytes=0.0
+
+        batches[-1].append(imageSet)
+        batch_estimate_bytes+=set_estimate_bytes
+
+    return batches
+
 @app.route('/api/upload', methods=['POST'])
 def uploadFile():
     # check if the post request has the file part
@@ -198,41 +265,53 @@ def uploadFile():
     experiment_name=experiment["experiment_name"]
     assert compound_layout_file.filename is not None
     compound_layout_s3_filename=f"{project_name}/{experiment_name}/{Path(compound_layout_file.filename).name}"
-    s3client.uploadFile(compound_layout_file,compound_layout_s3_filename)
+    skipped_files:tp.List[str]=[]
+    if not s3client.uploadFileIfChanged(compound_layout_file,compound_layout_s3_filename):
+        skipped_files.append(f"{BUCKET_NAME}/{compound_layout_s3_filename}")
 
     # image files
     image_files=request.files.getlist("image_files")
     if len(image_files)==0:
         return jsonify({"error":"no image files provided"}),Status.BAD_REQUEST
+    image_sizes={str(file.filename):get_file_size(file) for file in image_files}
     
-    imageSets=mydb.insertExperimentMetadata(
-        experiment,
-        coordinates,
-        compound_layout_s3_filename,
-        images=image_files,
-        image_s3_bucketname=BUCKET_NAME,
+    try:
+        imageSets=mydb.insertExperimentMetadata(
+            experiment,
+            coordinates,
+            compound_layout_s3_filename,
+            images=image_files,
+            image_s3_bucketname=BUCKET_NAME,
+            skipped_files=skipped_files,
+        )
+    except UploadError as e:
+        return jsonify({
+            "error":"failed to upload image files to storage",
+            "failed_files":{object_name:str(failure) for object_name,failure in e.failures.items()},
+        }),Status.BAD_GATEWAY
+
+    # group image sets into processing batches, then reserve and register all batches at once
+    batches=plan_map_batches(imageSets,image_sizes)
+    batch_ids=mydb.reserveProcessingBatchIDs(experiment["project_name"],experiment_name,len(batches))
+    mydb.registerBatches(
+        project_name=experiment["project_name"],
+        experiment_name=experiment_name,
+        batchids=batch_ids,
     )
 
     imageFileList=[]
-    for _setName,imageSet in imageSets.items():
-        batch_id=mydb.getProcessingBatchID(experiment["project_name"],experiment_name)
-
+    for batch_id,batch in zip(batch_ids,batches):
+        batch_images=[image for imageSet in batch for image in imageSet]
         print(
-            "registering batch with id",batch_id,
+            "registered batch with id",batch_id,
             "for experiment",experiment_name,
             "in project",experiment["project_name"],
-            "for well",imageSet[0].wellname,
-            "for site",imageSet[0].site,
-            "with",len(imageSet),"images"
-        )
-        
-        mydb.registerBatch(
-            project_name=experiment["project_name"],
-            experiment_name=experiment_name,
-            batchid=batch_id
+            "for",len(batch),"image sets",
+            "(wells/sites",", ".join(f"{imageSet[0].wellname}/{imageSet[0].site}" for imageSet in batch),")",
+            "with",len(batch_images),"images"
         )
 
-        imageFileList.extend(imageSet)
+        imageFileList.extend(batch_images)
 
         cp_map(
             [
@@ -241,12 +320,14 @@ def uploadFile():
                     s3path=image.storage_filename,
                 ).model_dump()
                 for image
-                in imageSet
+                in batch_images
             ],
             project_name=experiment["project_name"],
             experiment_name=experiment_name,
             plate_name=experiment["plate_name"],
             imageBatchID=batch_id,
+            image_set_sizes=[len(imageSet) for imageSet in batch],
+            input_bytes=sum(image_sizes.get(image.real_filename,0) for image in batch_images),
         )
 
     # redirect to display last uploaded file
@@ -260,6 +341,8 @@ def uploadFile():
             for image
             in imageFileList
         ],
+        # files that were not uploaded again because identical objects already exist in storage
+        skipped_files=skipped_files,
     )),Status.OK
 
 _WEB_FRONTEND_PORT_ENV=os.getenv("WEB_FRONTEND_PORT") ; assert _WEB_FRONTEND_PORT_ENV is not None